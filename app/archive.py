@@ -0,0 +1,195 @@
+"""Cold storage for old chat history.
+
+Messages older than a room's threshold are moved out of the hot store into
+immutable gzip-compressed NDJSON segments kept in the `archive` GridFS bucket.
+Each segment is indexed in `message_segments` by its time range, so reads only
+download and decompress the segments a page actually needs.
+
+Archiving is safe to repeat: a segment records the ids it holds, only those
+ids are then removed from the hot store, and messages a stopped run already
+wrote to a segment are not written again.
+"""
+import gzip
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId, json_util
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING
+
+from app.config import settings
+
+
+def get_archive_fs(db: AsyncIOMotorDatabase) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name="archive")
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    await db.message_segments.create_index(
+        [("chat_room_id", ASCENDING), ("last_at", DESCENDING)]
+    )
+    await db.message_segments.create_index(
+        [("chat_room_id", ASCENDING), ("last_seq", ASCENDING)], sparse=True
+    )
+    await db.message_segments.create_index(
+        [("chat_room_id", ASCENDING), ("message_ids", ASCENDING)]
+    )
+
+
+async def upload_segment(
+    db: AsyncIOMotorDatabase, chat_room_id: ObjectId, messages: list[dict]
+) -> dict:
+    """Store `messages` as a segment file, return the segment's fields."""
+    ndjson = b"".join(
+        json_util.dumps(message, json_options=json_util.CANONICAL_JSON_OPTIONS).encode()
+        + b"\n"
+        for message in messages
+    )
+    file_id = await get_archive_fs(db).upload_from_stream(
+        f"{chat_room_id}-{messages[0]['_id']}.ndjson.gz",
+        gzip.compress(ndjson),
+        metadata={"content_type": "application/x-ndjson", "encoding": "gzip"},
+    )
+    segment = {
+        "chat_room_id": chat_room_id,
+        "file_id": file_id,
+        "first_at": messages[0]["created_at"],
+        "last_at": messages[-1]["created_at"],
+        "count": len(messages),
+        "message_ids": [message["_id"] for message in messages],
+    }
+    seqs = [message["seq"] for message in messages if "seq" in message]
+    if seqs:
+        segment.update(first_seq=min(seqs), last_seq=max(seqs))
+    return segment
+
+
+async def write_segment(
+    db: AsyncIOMotorDatabase, chat_room_id: ObjectId, messages: list[dict]
+):
+    await db.message_segments.insert_one(await upload_segment(db, chat_room_id, messages))
+
+
+async def rewrite_segment(db: AsyncIOMotorDatabase, segment: dict, messages: list[dict]):
+    """Replace a segment's file with `messages`, the same messages changed."""
+    await db.message_segments.update_one(
+        {"_id": segment["_id"]},
+        {"$set": await upload_segment(db, segment["chat_room_id"], messages)},
+    )
+    await get_archive_fs(db).delete(segment["file_id"])
+
+
+async def read_segment(db: AsyncIOMotorDatabase, file_id: ObjectId):
+    # Decompress chunk by chunk so a segment is never fully held in memory
+    grid_out = await get_archive_fs(db).open_download_stream(file_id)
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)  # gzip header
+    pending = b""
+    while chunk := await grid_out.readchunk():
+        pending += decompressor.decompress(chunk)
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line:
+                yield json_util.loads(line)
+    pending += decompressor.flush()
+    if pending.strip():
+        yield json_util.loads(pending)
+
+
+async def iter_archived_messages(db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+    cursor = db.message_segments.find({"chat_room_id": chat_room_id}).sort("last_at", 1)
+    async for segment in cursor:
+        async for message in read_segment(db, segment["file_id"]):
+            yield message
+
+
+async def archive_chat_room(
+    db: AsyncIOMotorDatabase, message_store, chat_room: dict, now: datetime
+) -> int:
+    after_days = chat_room.get("archive_after_days", settings.archive_after_days)
+    cutoff = now - timedelta(days=after_days)
+    archived = 0
+    segment = []
+    async for message in message_store.iter_messages_before(db, chat_room["_id"], cutoff):
+        segment.append(message)
+        if len(segment) >= settings.archive_segment_size:
+            archived += await archive_segment(db, message_store, chat_room["_id"], segment)
+            segment = []
+    if segment:
+        archived += await archive_segment(db, message_store, chat_room["_id"], segment)
+    return archived
+
+
+async def archive_segment(
+    db: AsyncIOMotorDatabase, message_store, chat_room_id: ObjectId, messages: list[dict]
+) -> int:
+    """Move `messages` into a segment and return how many were written."""
+    ids = [message["_id"] for message in messages]
+    # Left behind by a run that stopped between writing and deleting
+    already_archived = set(
+        await db.message_segments.distinct(
+            "message_ids", {"chat_room_id": chat_room_id, "message_ids": {"$in": ids}}
+        )
+    )
+    fresh = [message for message in messages if message["_id"] not in already_archived]
+    if fresh:
+        await write_segment(db, chat_room_id, fresh)
+        # Reads must consult the archive before anything leaves the hot store
+        await db.chat_rooms.update_one({"_id": chat_room_id}, {"$set": {"archived": True}})
+    # By id, as messages stamped before the cutoff may have arrived meanwhile
+    await message_store.delete_messages(db, chat_room_id, ids)
+    return len(fresh)
+
+
+async def archive_messages(db: AsyncIOMotorDatabase, message_store) -> int:
+    now = datetime.now(timezone.utc)
+    archived = 0
+    async for chat_room in db.chat_rooms.find({}, {"archive_after_days": 1}):
+        archived += await archive_chat_room(db, message_store, chat_room, now)
+    return archived
+
+
+async def get_archived_messages(
+    db: AsyncIOMotorDatabase,
+    chat_room_id: ObjectId,
+    skip: int = 0,
+    limit: int = 25,
+    before: datetime | None = None,
+) -> list[dict]:
+    if before and before.tzinfo:
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    query = {"chat_room_id": chat_room_id}
+    if before:
+        query["first_at"] = {"$lt": before}
+    needed = skip + limit
+    messages = []
+    async for segment in db.message_segments.find(query).sort("last_at", -1):
+        # Segments come newest first, stop once older ones cannot reach the page
+        if len(messages) >= needed and segment["last_at"] < messages[needed - 1]["created_at"]:
+            break
+        async for message in read_segment(db, segment["file_id"]):
+            if before is None or message["created_at"] < before:
+                messages.append(message)
+        messages.sort(key=lambda message: message["created_at"], reverse=True)
+    return messages[skip:needed]
+
+
+async def get_archived_messages_by_seq(
+    db: AsyncIOMotorDatabase, chat_room_id: ObjectId, from_seq: int, to_seq: int, limit: int
+) -> list[dict]:
+    messages = []
+    cursor = db.message_segments.find(
+        {
+            "chat_room_id": chat_room_id,
+            "last_seq": {"$gte": from_seq},
+            "first_seq": {"$lte": to_seq},
+        }
+    ).sort("last_seq", 1)
+    async for segment in cursor:
+        # Stop once later segments hold only numbers past the page
+        if len(messages) >= limit and segment["first_seq"] > messages[limit - 1]["seq"]:
+            break
+        async for message in read_segment(db, segment["file_id"]):
+            if from_seq <= message.get("seq", 0) <= to_seq:
+                messages.append(message)
+        messages.sort(key=lambda message: message["seq"])
+    return messages[:limit]
@@ -0,0 +1,205 @@
+"""Resumable uploads of message attachments.
+
+A client opens an upload session for a file of known length, then PUTs the
+bytes from the offset the session reports. Each complete GridFS chunk is
+written straight into `fs.chunks` under the session id as it arrives, so a
+dropped connection only loses the partial chunk in flight and the file is
+never held in memory. Completing the session writes the `fs.files` document,
+after which the file reads like any other GridFS file.
+"""
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException, Request, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from app.config import settings
+
+# GridFS' default, so completed files are indistinguishable from ones
+# written by `upload_from_stream`
+CHUNK_SIZE = 255 * 1024
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    await db.upload_sessions.create_index([("created_at", ASCENDING)])
+
+
+async def create_upload_session(
+    db: AsyncIOMotorDatabase,
+    user_id: ObjectId,
+    chat_room_id: ObjectId,
+    filename: str,
+    content_type: str,
+    length: int,
+) -> dict:
+    if length > settings.attachment_max_bytes:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Attachments are limited to {settings.attachment_max_bytes} bytes",
+        )
+    await delete_expired_sessions(db)
+    session = {
+        "user_id": user_id,
+        "chat_room_id": chat_room_id,
+        "filename": filename,
+        "content_type": content_type,
+        "length": length,
+        "chunk_size": CHUNK_SIZE,
+        "received": 0,
+        "created_at": datetime.now(timezone.utc),
+    }
+    res = await db.upload_sessions.insert_one(session)
+    return {"_id": res.inserted_id, **session}
+
+
+async def get_upload_session(
+    db: AsyncIOMotorDatabase, session_id: str, user_id: ObjectId
+) -> dict:
+    if not ObjectId.is_valid(session_id):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    session = await db.upload_sessions.find_one(
+        {"_id": ObjectId(session_id), "user_id": user_id}
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+async def write_chunks(
+    db: AsyncIOMotorDatabase,
+    session: dict,
+    offset: int,
+    request: Request,
+    checksum: str | None = None,
+) -> dict:
+    """Append the request body at `offset` and return the updated session.
+
+    Only whole chunks (or the final one) are kept, the session's `received`
+    tells the client where to resume. If `checksum` is given it must be the
+    hex SHA-256 of the body, otherwise nothing from this request is kept.
+    """
+    if offset != session["received"]:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Expected offset {session['received']}",
+        )
+    chunk_size = session["chunk_size"]
+    first_n = n = offset // chunk_size
+    digest = hashlib.sha256()
+    pending = bytearray()
+    received = offset
+
+    async def flush(data: bytes):
+        nonlocal n, received
+        # Upsert so a chunk re-sent after a failed request replaces the old one
+        await db["fs.chunks"].replace_one(
+            {"files_id": session["_id"], "n": n},
+            {"files_id": session["_id"], "n": n, "data": Binary(data)},
+            upsert=True,
+        )
+        n += 1
+        received += len(data)
+
+    async for data in request.stream():
+        digest.update(data)
+        pending += data
+        if received + len(pending) > session["length"]:
+            await discard_chunks(db, session["_id"], first_n)
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="Upload exceeds the declared length",
+            )
+        while len(pending) >= chunk_size:
+            await flush(bytes(pending[:chunk_size]))
+            del pending[:chunk_size]
+    if pending and received + len(pending) == session["length"]:
+        await flush(bytes(pending))
+    if checksum and checksum.lower() != digest.hexdigest():
+        await discard_chunks(db, session["_id"], first_n)
+        raise HTTPException(status_code=400, detail="Checksum mismatch")
+
+    res = await db.upload_sessions.update_one(
+        {"_id": session["_id"], "received": offset}, {"$set": {"received": received}}
+    )
+    if res.modified_count == 0 and received != offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Concurrent upload to session"
+        )
+    return {**session, "received": received}
+
+
+async def discard_chunks(db: AsyncIOMotorDatabase, files_id: ObjectId, from_n: int = 0):
+    await db["fs.chunks"].delete_many({"files_id": files_id, "n": {"$gte": from_n}})
+
+
+async def complete_upload(db: AsyncIOMotorDatabase, session: dict) -> dict:
+    if session["received"] != session["length"]:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload incomplete, {session['received']} of {session['length']} bytes",
+        )
+    # Same document `upload_from_stream` would write, keyed by the session id
+    file = {
+        "_id": session["_id"],
+        "length": session["length"],
+        "chunkSize": session["chunk_size"],
+        "uploadDate": datetime.now(timezone.utc),
+        "filename": session["filename"],
+        "metadata": {
+            "content_type": session["content_type"],
+            "user_id": session["user_id"],
+            "chat_room_id": session["chat_room_id"],
+        },
+    }
+    try:
+        await db["fs.files"].insert_one(file)
+    except DuplicateKeyError:
+        # A concurrent completion of the same session got there first
+        file = await db["fs.files"].find_one({"_id": session["_id"]})
+    await db.upload_sessions.delete_one({"_id": session["_id"]})
+    return file
+
+
+async def get_attachments(
+    db: AsyncIOMotorDatabase,
+    attachment_ids: list[str],
+    user_id: ObjectId,
+    chat_room_id: ObjectId,
+) -> list[dict]:
+    """Resolve the caller's completed uploads into the form embedded in messages."""
+    try:
+        ids = [ObjectId(attachment_id) for attachment_id in attachment_ids]
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Unknown attachment")
+    files = await db["fs.files"].find(
+        {
+            "_id": {"$in": ids},
+            "metadata.user_id": user_id,
+            "metadata.chat_room_id": chat_room_id,
+        }
+    ).to_list(length=None)
+    if len(files) != len(set(ids)):
+        raise HTTPException(status_code=400, detail="Unknown attachment")
+    files_by_id = {file["_id"]: file for file in files}
+    return [
+        {
+            "_id": file["_id"],
+            "filename": file["filename"],
+            "content_type": file["metadata"]["content_type"],
+            "size": file["length"],
+        }
+        for file in map(files_by_id.get, dict.fromkeys(ids))
+    ]
+
+
+async def delete_expired_sessions(db: AsyncIOMotorDatabase):
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.upload_session_ttl_seconds
+    )
+    async for session in db.upload_sessions.find({"created_at": {"$lt": cutoff}}, {"_id": 1}):
+        await discard_chunks(db, session["_id"])
+        await db.upload_sessions.delete_one({"_id": session["_id"]})
@@ -0,0 +1,148 @@
+"""Content-addressed avatar files.
+
+An uploaded avatar is hashed first and only written to GridFS if no stored
+file has the same SHA-256, so identical pictures are kept once. Each stored
+file has an `avatar_blobs` document, keyed by the hash, counting the users
+that show it. When the count drops to zero the file is kept for a grace
+period, as clients may still hold its URL, and then removed by
+`sweep_avatars`. Avatar files uploaded before blobs were tracked are marked
+with `metadata.avatar_released_at` when their user replaces them, and swept
+after the same grace period unless a user shows them again.
+"""
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from fastapi import UploadFile
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.attachments import CHUNK_SIZE
+from app.config import settings
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    await db.avatar_blobs.create_index([("file_id", ASCENDING)])
+    await db.avatar_blobs.create_index([("refs", ASCENDING), ("released_at", ASCENDING)])
+    await db.users.create_index([("avatar_file_id", ASCENDING)], sparse=True)
+    await db["fs.files"].create_index(
+        [("metadata.avatar_released_at", ASCENDING)], sparse=True
+    )
+
+
+async def hash_upload(file: UploadFile) -> str:
+    digest = hashlib.sha256()
+    while data := await file.read(CHUNK_SIZE):
+        digest.update(data)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def acquire(db: AsyncIOMotorDatabase, digest: str) -> dict | None:
+    return await db.avatar_blobs.find_one_and_update(
+        {"_id": digest},
+        {"$inc": {"refs": 1}, "$unset": {"released_at": ""}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def store_avatar(
+    db: AsyncIOMotorDatabase, fs: AsyncIOMotorGridFSBucket, file: UploadFile
+) -> ObjectId:
+    """Return the id of a GridFS file holding `file`, taking a reference to it."""
+    digest = await hash_upload(file)
+    blob = await acquire(db, digest)
+    if blob:
+        return blob["file_id"]
+    file_id = await fs.upload_from_stream(
+        file.filename,
+        file.file,
+        metadata={"content_type": file.content_type, "sha256": digest},
+    )
+    try:
+        blob = await db.avatar_blobs.find_one_and_update(
+            {"_id": digest},
+            {
+                "$setOnInsert": {"file_id": file_id, "created_at": datetime.now(timezone.utc)},
+                "$inc": {"refs": 1},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        blob = await acquire(db, digest)
+    if blob["file_id"] != file_id:
+        # The same picture was stored concurrently, keep that copy
+        await fs.delete(file_id)
+    return blob["file_id"]
+
+
+async def release_avatar(db: AsyncIOMotorDatabase, file_id: ObjectId | None):
+    if file_id is None:
+        return
+    now = datetime.now(timezone.utc)
+    res = await db.avatar_blobs.update_one(
+        {"file_id": file_id}, {"$inc": {"refs": -1}, "$set": {"released_at": now}}
+    )
+    if not res.matched_count:
+        # Stored before blobs were tracked, mark it for `sweep_untracked_avatars`
+        await db["fs.files"].update_one(
+            {"_id": file_id, "metadata.sha256": {"$exists": False}},
+            {"$set": {"metadata.avatar_released_at": now}},
+        )
+
+
+async def sweep_avatars(
+    db: AsyncIOMotorDatabase, fs: AsyncIOMotorGridFSBucket, batch_size: int
+) -> int:
+    """Delete avatar files released longer than the grace period ago, and
+    untracked ones no user shows, `batch_size` at a time."""
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.avatar_gc_grace_seconds
+    )
+    deleted = 0
+    while True:
+        blobs = await db.avatar_blobs.find(
+            {"refs": {"$lte": 0}, "released_at": {"$lt": cutoff}}, {"_id": 1}
+        ).to_list(length=batch_size)
+        for blob in blobs:
+            # Re-checked atomically, an upload may have taken it back meanwhile
+            blob = await db.avatar_blobs.find_one_and_delete(
+                {"_id": blob["_id"], "refs": {"$lte": 0}}
+            )
+            if blob:
+                await fs.delete(blob["file_id"])
+                deleted += 1
+        if len(blobs) < batch_size:
+            break
+    return deleted + await sweep_untracked_avatars(db, fs, batch_size, cutoff)
+
+
+async def sweep_untracked_avatars(
+    db: AsyncIOMotorDatabase, fs: AsyncIOMotorGridFSBucket, batch_size: int, cutoff: datetime
+) -> int:
+    # Only files released as avatars, other uses of the bucket are never marked
+    query = {
+        "metadata.sha256": {"$exists": False},
+        "metadata.avatar_released_at": {"$lt": cutoff},
+    }
+    deleted = 0
+    last_id = None
+    while True:
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        files = await db["fs.files"].find(query, {"_id": 1}).sort("_id", 1).to_list(
+            length=batch_size
+        )
+        if not files:
+            return deleted
+        ids = [file["_id"] for file in files]
+        referenced = set(
+            await db.users.distinct("avatar_file_id", {"avatar_file_id": {"$in": ids}})
+        )
+        for file_id in ids:
+            if file_id not in referenced:
+                await fs.delete(file_id)
+                deleted += 1
+        last_id = ids[-1]
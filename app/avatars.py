@@ -0,0 +1,44 @@
+import hashlib
+from functools import lru_cache
+from html import escape
+
+PALETTE = [
+    "#1abc9c",
+    "#2ecc71",
+    "#3498db",
+    "#9b59b6",
+    "#34495e",
+    "#16a085",
+    "#27ae60",
+    "#2980b9",
+    "#8e44ad",
+    "#e67e22",
+    "#e74c3c",
+    "#d35400",
+]
+
+
+def get_initials(name: str) -> str:
+    words = name.split()
+    if not words:
+        return "?"
+    if len(words) == 1:
+        return words[0][:2].upper()
+    return (words[0][0] + words[-1][0]).upper()
+
+
+@lru_cache(maxsize=4096)
+def render_initials_avatar(name: str, seed: str) -> tuple[bytes, str]:
+    """Render a deterministic SVG avatar and return it with its strong ETag."""
+    digest = hashlib.sha256(seed.encode()).digest()
+    background = PALETTE[digest[0] % len(PALETTE)]
+    svg = (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="128" height="128" '
+        'viewBox="0 0 128 128">'
+        f'<rect width="128" height="128" fill="{background}"/>'
+        '<text x="50%" y="50%" dy=".35em" text-anchor="middle" fill="#ffffff" '
+        'font-family="Helvetica, Arial, sans-serif" font-size="52">'
+        f"{escape(get_initials(name))}</text></svg>"
+    ).encode()
+    etag = f'"{hashlib.sha256(svg).hexdigest()[:32]}"'
+    return svg, etag
@@ -0,0 +1,36 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded in-process cache whose entries expire `ttl` seconds after set."""
+
+    def __init__(self, max_size: int, ttl: float, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < self.clock():
+            del self.entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock() + self.ttl, value)
+        # Entries are kept in insertion order, so the oldest go first
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self.entries.clear()
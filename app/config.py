@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from pydantic_settings import BaseSettings
 
 
@@ -9,21 +11,144 @@ class Settings(BaseSettings):
     mongo_testdb: str
     mongo_host: str
     mongo_port: int = 27017
+    mongo_replica_set: str = ""
+    # GET /messages, /users, /users/{id} and /images/{id} read from secondaries
+    # lagging at most this much (90 is the smallest Mongo accepts)
+    read_from_secondaries: bool = False
+    read_max_staleness_seconds: int = 90
     jwt_secret: str
     jwt_algorithm: str = "HS256"
+    # "documents" keeps one document per message, "buckets" groups them
+    message_storage: str = "documents"
+    message_bucket_size: int = 200
+    message_bucket_span_seconds: int = 24 * 60 * 60
+    # Messages older than this move to compressed archive segments, rooms can
+    # override it with their own `archive_after_days`. 0 interval disables.
+    archive_after_days: int = 365
+    archive_segment_size: int = 5000
+    archive_interval_seconds: int = 0
+    message_import_batch_size: int = 1000
+    message_dedupe_window_seconds: int = 300
+    message_dedupe_max_size: int = 50_000
+    # Websockets are closed in batches over this many seconds on shutdown and
+    # told to reconnect after a random delay of up to reconnect_max_delay
+    shutdown_drain_seconds: float = 10
+    shutdown_close_batch_size: int = 200
+    reconnect_max_delay_seconds: float = 30
+    # Websockets are pinged every interval and dropped after `timeout` seconds
+    # without any frame from the client. 0 interval disables heartbeats.
+    heartbeat_interval_seconds: float = 30
+    heartbeat_timeout_seconds: float = 90
+    # Rooms broadcasting more messages a second than the threshold get them
+    # in batch frames every interval instead, 0 threshold disables batching
+    broadcast_batch_threshold_per_second: float = 50
+    broadcast_batch_interval_seconds: float = 0.005
+    version_cache_ttl_seconds: float = 2
+    # Sync tokens trail the clock by this much so writes committed out of
+    # order by other workers are picked up on the next sync
+    sync_settle_seconds: float = 5
+    attachment_max_bytes: int = 100 * 1024 * 1024
+    # Unfinished uploads are discarded after this long
+    upload_session_ttl_seconds: int = 24 * 60 * 60
+    # Avatars no user shows any more are deleted after the grace period by a
+    # sweep job run every interval, 0 disables
+    avatar_gc_grace_seconds: int = 24 * 60 * 60
+    avatar_sweep_interval_seconds: int = 60 * 60
+    avatar_sweep_batch_size: int = 500
+    # Profile this fraction of requests, and any sent with `X-Profile: <token>`
+    profile_sample_rate: float = 0
+    profile_token: str = ""
+    profile_dir: str = "profiles"
+    profile_interval_seconds: float = 0.005
+    # Mongo commands slower than this are logged with their plan, 0 disables.
+    # Each slow command runs an extra `explain`, so this is off by default.
+    slow_op_threshold_ms: float = 0
+    loop_lag_interval_seconds: float = 1
+    loop_lag_warn_seconds: float = 0.1
+    # Mongo URIs including the database name, e.g. mongodb://host/chat_p0.
+    # Empty keeps messages in the main database.
+    message_partitions: list[str] = []
+    partition_cache_ttl_seconds: float = 5
+    # Checked by app.scripts.startup_benchmark
+    startup_import_budget_seconds: float = 1.5
+    startup_ready_budget_seconds: float = 5
+    # Job worker coroutines per app process, 0 leaves jobs to
+    # app.scripts.run_jobs. Rate limits are jobs started per second by type.
+    job_workers: int = 2
+    job_lease_seconds: float = 60
+    job_poll_interval_seconds: float = 1
+    job_max_attempts: int = 5
+    job_retry_base_seconds: float = 2
+    job_retry_max_seconds: float = 600
+    job_rate_limits: dict[str, float] = {}
+    # Finished jobs are kept this long for status checks
+    job_retention_seconds: int = 7 * 24 * 60 * 60
+    # app.server: 0 workers starts one per available core. Websocket fan-out,
+    # rate limits and the dedupe cache live in each process, so clients on
+    # different workers would not see each other's live events: keep one
+    # worker per instance until fan-out goes through a shared channel.
+    # uvloop and httptools fall back to uvicorn's defaults when not installed.
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    server_workers: int = 1
+    server_loop: str = "uvloop"
+    server_http: str = "httptools"
+    server_backlog: int = 2048
+    # Longer than the load balancer's idle timeout, so it closes first
+    server_keep_alive_seconds: int = 75
+    server_ws_ping_interval_seconds: float = 20
+    server_ws_ping_timeout_seconds: float = 20
+    server_access_log: bool = False
+    # Workers restart after this many requests plus up to `jitter`, 0 never
+    server_max_requests: int = 0
+    server_max_requests_jitter: int = 0
+    # Connections each worker opens to Mongo before taking traffic
+    mongo_min_pool_size: int = 10
+    # Token buckets: `rate` tokens per second refill up to `burst`
+    message_rate_per_user: float = 5
+    message_burst_per_user: int = 20
+    message_rate_per_room: float = 50
+    message_burst_per_room: int = 200
+    # Charged only by failed logins, per username and host and per host
+    login_rate_per_user: float = 0.1
+    login_burst_per_user: int = 5
+    login_rate_per_host: float = 1
+    login_burst_per_host: int = 20
     # redis_host: str
     # redis_port: int
     # redis_password: str
 
     @property
     def mongo_uri(self):
-        return (
+        uri = (
             f"mongodb://{self.mongo_username}:{self.mongo_password}"
             f"@{self.mongo_host}:{self.mongo_port}"
         )
+        if self.mongo_replica_set:
+            uri += f"/?replicaSet={self.mongo_replica_set}"
+        return uri
 
     class Config:
         env_file = ".env"
 
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+class LazySettings:
+    """Reads the environment on first use rather than at import, so importing
+    the app is cheap and works before the environment is complete."""
+
+    def __getattr__(self, name):
+        return getattr(get_settings(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_settings(), name, value)
+
+    def __delattr__(self, name):
+        delattr(get_settings(), name)
+
+
+settings = LazySettings()
@@ -1,21 +1,302 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from contextlib import contextmanager
+
 from fastapi import WebSocket
 
+# "Service Restart": the client should reconnect, to another instance if any
+SERVICE_RESTART = 1012
+# "Going Away": used when a connection missed its heartbeats
+GOING_AWAY = 1001
+PING = json.dumps({"type": "ping"})
+
+logger = logging.getLogger("app.connection_manager")
+
+
+def batch_frame(messages: list[str]) -> str:
+    # The events are already JSON, splice them in rather than re-encode
+    return '{"type": "batch", "events": [' + ", ".join(messages) + "]}"
+
+
+class ChannelTraffic:
+    """Broadcast rate of one channel, as an exponentially decaying average
+    over roughly `window` seconds, and what was sent for it."""
+
+    def __init__(self, window: float, now: float):
+        self.window = window
+        self.rate = 0.0
+        self.updated = now
+        self.batching = False
+        self.messages = 0
+        self.frames = 0
+        self.max_batch = 0
+
+    def record(self, now: float) -> float:
+        self.rate = self.rate * math.exp((self.updated - now) / self.window) + 1 / self.window
+        self.updated = now
+        return self.rate
+
+    def sent(self, messages: int):
+        self.messages += messages
+        self.frames += 1
+        self.max_batch = max(self.max_batch, messages)
+
+    def stats(self) -> dict:
+        return {
+            "rate": round(self.rate, 1),
+            "batching": self.batching,
+            "messages": self.messages,
+            "frames": self.frames,
+            "avg_batch": round(self.messages / self.frames, 2) if self.frames else 0,
+            "max_batch": self.max_batch,
+        }
+
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        wheel_size: int = 10,
+        batch_threshold: float = 50,
+        batch_interval: float = 0.005,
+        rate_window: float = 1,
+        clock=time.monotonic,
+    ):
         self.active_connections: dict[str, list[WebSocket]] = {}
+        # Every open socket, including those not subscribed to a channel yet
+        self.accepted: set[WebSocket] = set()
+        self.draining = False
+        self.in_flight = 0
+        # Heartbeats run off a single timer wheel: every socket sits in one
+        # slot and each tick visits one slot, so a socket is checked once per
+        # heartbeat interval without a task of its own.
+        self.wheel: list[set[WebSocket]] = [set() for _ in range(wheel_size)]
+        self.wheel_cursor = 0
+        self.slots: dict[WebSocket, int] = {}
+        self.channels: dict[WebSocket, str] = {}
+        self.last_seen: dict[WebSocket, float] = {}
+        self.reaped_total = 0
+        # Channels broadcasting more than `batch_threshold` messages a second
+        # send them as one batch frame every `batch_interval` seconds, until
+        # the rate falls below half the threshold again. Only sockets in
+        # `batch_clients` asked for batch frames, the rest get the same
+        # messages one frame each.
+        self.batch_threshold = batch_threshold
+        self.batch_interval = batch_interval
+        self.rate_window = rate_window
+        self.clock = clock
+        self.traffic: dict[str, ChannelTraffic] = {}
+        self.batch_clients: set[WebSocket] = set()
+        self.pending: dict[str, list[str]] = {}
+        self.flushes: dict[str, asyncio.Task] = {}
 
-    async def connect(self, websocket: WebSocket, channel_id: str):
+    async def accept(self, websocket: WebSocket) -> bool:
         await websocket.accept()
+        if self.draining:
+            await self.close_for_reconnect(websocket, 1)
+            return False
+        self.accepted.add(websocket)
+        return True
+
+    async def connect(
+        self, websocket: WebSocket, channel_id: str, batch: bool = False
+    ) -> bool:
+        if not await self.accept(websocket):
+            return False
+        self.subscribe(websocket, channel_id, batch)
+        return True
+
+    def subscribe(self, websocket: WebSocket, channel_id: str, batch: bool = False):
+        """Start broadcasting `channel_id` to an accepted socket."""
+        if websocket in self.channels:
+            return
+        if batch:
+            self.batch_clients.add(websocket)
         if channel_id not in self.active_connections:
             self.active_connections[channel_id] = []
         self.active_connections[channel_id].append(websocket)
+        # The slot just behind the cursor comes up again one full turn later
+        slot = (self.wheel_cursor - 1) % len(self.wheel)
+        self.wheel[slot].add(websocket)
+        self.slots[websocket] = slot
+        self.channels[websocket] = channel_id
+        self.last_seen[websocket] = self.clock()
 
     def disconnect(self, websocket: WebSocket, channel_id: str):
+        self.accepted.discard(websocket)
+        if websocket not in self.active_connections.get(channel_id, []):
+            return
         self.active_connections[channel_id].remove(websocket)
         if not self.active_connections[channel_id]:
             self.active_connections.pop(channel_id)
+            self.traffic.pop(channel_id, None)
+        self.wheel[self.slots.pop(websocket)].discard(websocket)
+        self.channels.pop(websocket, None)
+        self.last_seen.pop(websocket, None)
+        self.batch_clients.discard(websocket)
+
+    def touch(self, websocket: WebSocket):
+        """Record that a frame (a pong or anything else) arrived from the client."""
+        if websocket in self.last_seen:
+            self.last_seen[websocket] = self.clock()
+
+    async def reap(self, websocket: WebSocket):
+        channel_id = self.channels.get(websocket)
+        if channel_id is None:
+            return  # Its own handler disconnected it while we were reaping others
+        self.disconnect(websocket, channel_id)
+        self.reaped_total += 1
+        try:
+            # A half-open peer never acknowledges, do not wait on it for long
+            await asyncio.wait_for(websocket.close(code=GOING_AWAY), timeout=1)
+        except Exception:
+            pass
+
+    async def check_heartbeats(self, timeout: float):
+        """Visit the next wheel slot: reap silent sockets and ping the rest."""
+        slot = self.wheel[self.wheel_cursor]
+        self.wheel_cursor = (self.wheel_cursor + 1) % len(self.wheel)
+        deadline = self.clock() - timeout
+        stale = [websocket for websocket in slot if self.last_seen[websocket] < deadline]
+        for websocket in stale:
+            await self.reap(websocket)
+        # A peer that stopped reading would block its send, bound each ping
+        await asyncio.gather(
+            *(
+                asyncio.wait_for(websocket.send_text(PING), timeout=1)
+                for websocket in list(slot)
+            ),
+            return_exceptions=True,
+        )
+
+    async def run_heartbeat(self, interval: float, timeout: float):
+        while True:
+            await asyncio.sleep(interval / len(self.wheel))
+            try:
+                await self.check_heartbeats(timeout)
+            except Exception as e:
+                # One bad tick must not stop heartbeats for the life of the process
+                logger.warning(json.dumps({"event": "heartbeat_error", "error": repr(e)}))
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.channels),
+            "channels": len(self.active_connections),
+            "reaped_total": self.reaped_total,
+        }
+
+    def channel_stats(self, limit: int = 50) -> dict[str, dict]:
+        """The busiest channels' broadcast rates and batch sizes."""
+        busiest = sorted(
+            self.traffic.items(), key=lambda item: item[1].rate, reverse=True
+        )[:limit]
+        return {channel_id: traffic.stats() for channel_id, traffic in busiest}
+
+    def should_batch(self, channel_id: str) -> bool:
+        if not self.batch_threshold:
+            return False
+        now = self.clock()
+        traffic = self.traffic.get(channel_id)
+        if traffic is None:
+            traffic = self.traffic[channel_id] = ChannelTraffic(self.rate_window, now)
+        rate = traffic.record(now)
+        if rate >= self.batch_threshold:
+            traffic.batching = True
+        elif rate < self.batch_threshold / 2:
+            traffic.batching = False
+        return traffic.batching
 
     async def broadcast(self, message: str, channel_id: str):
-        for connection in self.active_connections.get(channel_id, []):
-            await connection.send_text(message)
+        if channel_id not in self.active_connections:
+            return
+        # Queue behind a pending batch even once calm, to keep the order
+        if self.should_batch(channel_id) or channel_id in self.pending:
+            self.pending.setdefault(channel_id, []).append(message)
+            if channel_id not in self.flushes:
+                self.flushes[channel_id] = asyncio.create_task(self.flush_later(channel_id))
+            return
+        await self.send_to_channel(channel_id, [message])
+
+    async def flush_later(self, channel_id: str):
+        await asyncio.sleep(self.batch_interval)
+        await self.flush(channel_id)
+
+    async def flush(self, channel_id: str):
+        self.flushes.pop(channel_id, None)
+        messages = self.pending.pop(channel_id, [])
+        if messages:
+            await self.send_to_channel(channel_id, messages)
+
+    async def send_to_channel(self, channel_id: str, messages: list[str]):
+        # Only sockets that are currently connected are in the channel, so the
+        # fan-out cost follows online listeners rather than room membership.
+        # Sends run concurrently so one slow client does not stall the rest.
+        connections = list(self.active_connections.get(channel_id, []))
+        if channel_id in self.traffic:
+            self.traffic[channel_id].sent(len(messages))
+        batch = batch_frame(messages) if len(messages) > 1 else None
+        await asyncio.gather(
+            *(self.send_frames(connection, messages, batch) for connection in connections),
+            return_exceptions=True,
+        )
+
+    async def send_frames(
+        self, websocket: WebSocket, messages: list[str], batch: str | None
+    ):
+        if batch and websocket in self.batch_clients:
+            await websocket.send_text(batch)
+            return
+        for message in messages:
+            await websocket.send_text(message)
+
+    @contextmanager
+    def busy(self):
+        """Mark a received frame as being handled so draining waits for it."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def close_for_reconnect(self, websocket: WebSocket, max_delay: float):
+        # A random delay per client spreads the reconnects of a whole
+        # instance over `max_delay` instead of landing in the same second.
+        reason = json.dumps({"reconnect_after_ms": random.randint(0, int(max_delay * 1000))})
+        try:
+            await websocket.close(code=SERVICE_RESTART, reason=reason)
+        except RuntimeError:
+            pass  # Already closed
+
+    async def drain(self, deadline: float, batch_size: int, max_reconnect_delay: float):
+        """Stop accepting sockets, finish in-flight frames, then close every
+        connection in staggered batches within `deadline` seconds."""
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        end = loop.time() + deadline
+        # Give pending work up to half of the deadline to finish
+        while self.in_flight and loop.time() < end - deadline / 2:
+            await asyncio.sleep(0.05)
+        for channel_id in list(self.pending):
+            await self.flush(channel_id)
+
+        # Sockets still waiting to authenticate are told to reconnect as well
+        connections = list(self.accepted)
+        random.shuffle(connections)
+        batches = [
+            connections[i : i + batch_size]
+            for i in range(0, len(connections), batch_size)
+        ]
+        for i, batch in enumerate(batches):
+            await asyncio.gather(
+                *(
+                    self.close_for_reconnect(websocket, max_reconnect_delay)
+                    for websocket in batch
+                ),
+                return_exceptions=True,
+            )
+            remaining_batches = len(batches) - i - 1
+            if remaining_batches:
+                await asyncio.sleep(max(end - loop.time(), 0) / (remaining_batches + 1))
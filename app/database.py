@@ -1,14 +1,50 @@
+from functools import lru_cache
 from typing import AsyncGenerator
+from pymongo import ASCENDING
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from app import archive, attachments, avatar_store, jobs, profiling
 from app.config import settings
+from app.message_store import get_message_store
 
 
-client = AsyncIOMotorClient(settings.mongo_uri)
-main_db = client[settings.mongo_maindb]
+@lru_cache
+def get_client() -> AsyncIOMotorClient:
+    # Built on first use, normally by the lifespan hook, not at import
+    return AsyncIOMotorClient(
+        settings.mongo_uri,
+        minPoolSize=settings.mongo_min_pool_size,
+        event_listeners=(
+            [profiling.get_slow_op_listener()] if settings.slow_op_threshold_ms else []
+        ),
+    )
+
+
+def get_main_db() -> AsyncIOMotorDatabase:
+    return get_client()[settings.mongo_maindb]
 
 
 async def get_db() -> AsyncGenerator[AsyncIOMotorDatabase, None]:
-    return main_db
+    return get_main_db()
 
 async def get_fs() -> AsyncGenerator[AsyncIOMotorGridFSBucket, None]:
-    return AsyncIOMotorGridFSBucket(main_db)
+    return AsyncIOMotorGridFSBucket(get_main_db())
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    # Every authenticated request looks its user up by email
+    await db.users.create_index([("email", ASCENDING)])
+    await db.chat_rooms.create_index([("user_ids", ASCENDING)])
+    await db.chat_room_members.create_index(
+        [("chat_room_id", ASCENDING), ("user_id", ASCENDING)], unique=True
+    )
+    await db.chat_room_members.create_index(
+        [("user_id", ASCENDING), ("chat_room_id", ASCENDING)]
+    )
+    await db.chat_room_invites.create_index(
+        [("chat_room_id", ASCENDING), ("user_id", ASCENDING)], unique=True
+    )
+    await get_message_store().create_indexes(db)
+    await archive.create_indexes(db)
+    await attachments.create_indexes(db)
+    await avatar_store.create_indexes(db)
+    await jobs.create_indexes(db)
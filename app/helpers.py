@@ -0,0 +1,347 @@
+import base64
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from bson import ObjectId
+from fastapi import HTTPException, Request, Response, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.cache import TTLCache
+from app.config import settings
+from app.schemas import ChatRoomTypeEnum
+
+@lru_cache
+def get_message_dedupe_cache() -> TTLCache:
+    # Recently stored messages by (user_id, client_message_id), so most
+    # retries are answered without touching the database.
+    return TTLCache(
+        settings.message_dedupe_max_size, settings.message_dedupe_window_seconds
+    )
+
+
+async def is_chat_room_member(
+    db: AsyncIOMotorDatabase, chat_room: dict, user_id: ObjectId
+) -> bool:
+    # Group membership lives in its own collection so the check is a single
+    # indexed point lookup, no matter how many members the room has.
+    if chat_room.get("type") == ChatRoomTypeEnum.GROUP:
+        member = await db.chat_room_members.find_one(
+            {"chat_room_id": chat_room["_id"], "user_id": user_id}, {"_id": 1}
+        )
+        return member is not None
+    return user_id in chat_room.get("user_ids", [])
+
+
+_last_sync_seq = 0
+
+
+def next_sync_seq() -> int:
+    """Change sequence number stamped as `sync_seq` on every written document.
+
+    Microseconds since the epoch, bumped to stay strictly increasing within
+    this process. Writers in other processes can commit slightly out of order,
+    which `GET /sync` covers by re-reading a short settle window.
+    """
+    global _last_sync_seq
+    _last_sync_seq = max(time.time_ns() // 1000, _last_sync_seq + 1)
+    return _last_sync_seq
+
+
+async def get_member_chat_room(
+    db: AsyncIOMotorDatabase, chat_room_id: str, user_id: ObjectId
+) -> dict:
+    chat_room = None
+    if ObjectId.is_valid(chat_room_id):
+        chat_room = await db.chat_rooms.find_one({"_id": ObjectId(chat_room_id)})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await is_chat_room_member(db, chat_room, user_id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    return chat_room
+
+
+def encode_sync_token(seq: int) -> str:
+    return base64.urlsafe_b64encode(f"v1:{seq}".encode()).decode()
+
+
+def decode_sync_token(token: str) -> int:
+    try:
+        version, seq = base64.urlsafe_b64decode(token.encode()).decode().split(":")
+        if version != "v1":
+            raise ValueError(version)
+        return int(seq)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid sync token"
+        )
+
+
+async def allocate_message_seqs(
+    db: AsyncIOMotorDatabase, chat_room_id: ObjectId, count: int = 1, session=None
+) -> int:
+    """Reserve `count` consecutive per-room message numbers, return the first.
+
+    Unlike `sync_seq` these count up from 1 in each room, from a counter on
+    the chat room, so a reader holding message `n` knows `n + 1` is next. A
+    number is skipped for good only when its write fails for another reason
+    than a duplicate, or a duplicate's number could not be handed back by
+    `release_message_seqs`: a range read that lacks it shows it will never
+    arrive.
+    """
+    chat_room = await db.chat_rooms.find_one_and_update(
+        {"_id": chat_room_id},
+        {"$inc": {"last_message_seq": count}},
+        projection={"last_message_seq": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    return chat_room["last_message_seq"] - count + 1
+
+
+async def release_message_seqs(
+    db: AsyncIOMotorDatabase,
+    chat_room_id: ObjectId,
+    first_seq: int,
+    count: int = 1,
+    session=None,
+) -> bool:
+    """Hand back numbers taken by `allocate_message_seqs` for a write that
+    certainly failed. Only possible while no later number was taken."""
+    res = await db.chat_rooms.update_one(
+        {"_id": chat_room_id, "last_message_seq": first_seq + count - 1},
+        {"$inc": {"last_message_seq": -count}},
+        session=session,
+    )
+    return res.modified_count == 1
+
+
+def check_same_chat_room(stored: dict, chat_room_id: ObjectId):
+    # Client message ids are unique per user, not per room
+    if stored["chat_room_id"] != chat_room_id:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="client_message_id was already used in another chat room",
+        )
+
+
+def get_recent_message(
+    user_id: ObjectId, chat_room_id: ObjectId, client_message_id: str
+) -> dict | None:
+    """The message recently stored under `client_message_id`, if cached."""
+    stored = get_message_dedupe_cache().get((user_id, client_message_id))
+    if stored:
+        check_same_chat_room(stored, chat_room_id)
+    return stored
+
+
+async def insert_message_once(
+    db: AsyncIOMotorDatabase, message_store, message: dict, session=None
+) -> tuple[dict, bool]:
+    """Store `message` unless its client message id was already used.
+
+    Returns the stored message and whether it was created by this call.
+    """
+    message["sync_seq"] = next_sync_seq()
+    client_message_id = message.get("client_message_id")
+    key = (message["user_id"], client_message_id)
+    if client_message_id:
+        stored = get_recent_message(
+            message["user_id"], message["chat_room_id"], client_message_id
+        )
+        if not stored:
+            # Found before a number is taken, so retries leave no gaps
+            stored = await message_store.find_by_client_message_id(
+                db, message["chat_room_id"], message["user_id"], client_message_id
+            )
+            if stored:
+                check_same_chat_room(stored, message["chat_room_id"])
+                get_message_dedupe_cache().set(key, stored)
+        if stored:
+            return stored, False
+
+    message["seq"] = await allocate_message_seqs(db, message["chat_room_id"], session=session)
+    try:
+        stored = await message_store.insert_message(db, message, session)
+    except DuplicateKeyError:
+        # Nothing was written, give the number back if it is still the last
+        await release_message_seqs(
+            db, message["chat_room_id"], message["seq"], session=session
+        )
+        if not client_message_id:
+            raise
+        stored = await message_store.find_by_client_message_id(
+            db, message["chat_room_id"], message["user_id"], client_message_id
+        )
+        if not stored:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Message with this client_message_id is still being stored",
+            )
+        check_same_chat_room(stored, message["chat_room_id"])
+        get_message_dedupe_cache().set(key, stored)
+        return stored, False
+    if client_message_id:
+        get_message_dedupe_cache().set(key, stored)
+    return stored, True
+
+
+def message_patch(message: dict, patch: dict) -> dict:
+    """A `message_patch` event carrying only the fields that changed.
+
+    `version` grows with every change, so clients drop patches older than the
+    copy they hold. `reactions` is merged key by key rather than replaced.
+    """
+    return {
+        "type": "message_patch",
+        "message_id": str(message["_id"]),
+        "chat_room_id": str(message["chat_room_id"]),
+        "version": message.get("version", 0),
+        "patch": patch,
+    }
+
+
+async def update_message(
+    db: AsyncIOMotorDatabase,
+    message_store,
+    chat_room_id: ObjectId,
+    message_id: ObjectId,
+    update: dict,
+    match: dict | None = None,
+) -> dict | None:
+    update.setdefault("$set", {})["sync_seq"] = next_sync_seq()
+    update.setdefault("$inc", {})["version"] = 1
+    return await message_store.update_message(db, chat_room_id, message_id, update, match)
+
+
+async def edit_message(
+    db: AsyncIOMotorDatabase,
+    message_store,
+    chat_room_id: ObjectId,
+    message_id: ObjectId,
+    user_id: ObjectId,
+    content: str,
+) -> dict:
+    edited_at = datetime.now(timezone.utc)
+    message = await update_message(
+        db,
+        message_store,
+        chat_room_id,
+        message_id,
+        {"$set": {"content": content, "edited_at": edited_at}},
+        match={"user_id": user_id, "deleted": {"$ne": True}},
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message_patch(message, {"content": content, "edited_at": edited_at.isoformat()})
+
+
+async def delete_message(
+    db: AsyncIOMotorDatabase,
+    message_store,
+    chat_room_id: ObjectId,
+    message_id: ObjectId,
+    user_id: ObjectId,
+) -> dict:
+    # Kept as a tombstone so clients and sync can drop their copy
+    message = await update_message(
+        db,
+        message_store,
+        chat_room_id,
+        message_id,
+        {"$set": {"deleted": True, "content": "", "attachments": []}},
+        match={"user_id": user_id, "deleted": {"$ne": True}},
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message_patch(message, {"deleted": True, "content": "", "attachments": []})
+
+
+async def react_to_message(
+    db: AsyncIOMotorDatabase,
+    message_store,
+    chat_room_id: ObjectId,
+    message_id: ObjectId,
+    user_id: ObjectId,
+    emoji: str,
+    add: bool = True,
+) -> tuple[dict, bool]:
+    """Add or remove the user's `emoji` reaction.
+
+    Returns the patch and whether anything changed; reacting twice, or
+    removing a reaction that is not there, changes nothing.
+    """
+    if not 0 < len(emoji) <= 32 or any(c in emoji for c in ".$ "):
+        raise HTTPException(status_code=400, detail="Invalid reaction")
+    reactors = f"reactors.{emoji}"
+    if add:
+        match = {reactors: {"$ne": user_id}, "deleted": {"$ne": True}}
+        update = {"$addToSet": {reactors: user_id}, "$inc": {f"reactions.{emoji}": 1}}
+    else:
+        match = {reactors: user_id}
+        update = {"$pull": {reactors: user_id}, "$inc": {f"reactions.{emoji}": -1}}
+    message = await update_message(
+        db, message_store, chat_room_id, message_id, update, match
+    )
+    changed = message is not None
+    if not changed:
+        message = await message_store.find_message(db, chat_room_id, message_id)
+        if not message:
+            raise HTTPException(status_code=404, detail="Message not found")
+    count = message.get("reactions", {}).get(emoji, 0)
+    return message_patch(message, {"reactions": {emoji: count}}), changed
+
+
+@lru_cache
+def get_version_cache() -> TTLCache:
+    # Versions of users and chat rooms recently seen by this process, keyed by
+    # (collection, _id). Other workers may bump a version at any time, so
+    # entries only live for a couple of seconds; local writes drop them right away.
+    return TTLCache(50_000, settings.version_cache_ttl_seconds)
+
+
+async def get_version(
+    db: AsyncIOMotorDatabase, collection: str, _id: ObjectId, session=None
+) -> int | None:
+    version_cache = get_version_cache()
+    version = version_cache.get((collection, _id))
+    if version is None:
+        document = await db[collection].find_one({"_id": _id}, {"version": 1}, session=session)
+        if document is None:
+            return None
+        version = document.get("version", 0)
+        version_cache.set((collection, _id), version)
+    return version
+
+
+async def bump_direct_chat_rooms(db: AsyncIOMotorDatabase, user_id: ObjectId):
+    # Direct rooms show the partner's name and avatar, so they change with them
+    get_version_cache().pop(("users", user_id))
+    await db.chat_rooms.update_many(
+        {"type": "direct", "user_ids": user_id},
+        {"$inc": {"version": 1}, "$set": {"sync_seq": next_sync_seq()}},
+    )
+
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # If-None-Match compares weakly, so a `W/` prefix does not matter
+    candidates = [
+        candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")
+    ]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
@@ -0,0 +1,330 @@
+"""Background jobs persisted in the `jobs` collection.
+
+Request handlers `enqueue` work and return at once. Worker coroutines,
+started by the lifespan hook or by `python -m app.scripts.run_jobs` in
+processes of their own, lease the highest priority job that is due and run
+the handler registered for its type.
+
+A leased job's `run_at` doubles as its lease expiry, so a job whose worker
+died is simply due again and another worker picks it up. Failures are
+retried with exponential backoff until `max_attempts`. A job enqueued with a
+`key` that matches one still queued is not added twice, the queued one is
+returned instead. With `exclusive` the key stays taken until the job has
+finished, so at most one such job is queued or running at any time.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app import archive, avatar_store, helpers
+from app.config import settings
+from app.message_store import get_message_store
+from app.partitions import move_chat_room
+from app.rate_limiter import RateLimiter
+
+logger = logging.getLogger("app.jobs")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+Handler = Callable[[AsyncIOMotorDatabase, dict], Awaitable[dict | None]]
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    await db.jobs.create_index(
+        [("status", ASCENDING), ("priority", DESCENDING), ("run_at", ASCENDING)]
+    )
+    # Only queued jobs carry `queued_key`, so a key can be reused once started
+    await db.jobs.create_index([("queued_key", ASCENDING)], unique=True, sparse=True)
+    # Exclusive jobs carry `active_key` until they finish
+    await db.jobs.create_index([("active_key", ASCENDING)], unique=True, sparse=True)
+    await db.jobs.create_index(
+        [("finished_at", ASCENDING)], expireAfterSeconds=settings.job_retention_seconds
+    )
+
+
+async def enqueue(
+    db: AsyncIOMotorDatabase,
+    type: str,
+    payload: dict | None = None,
+    priority: int = 0,
+    key: str | None = None,
+    user_id: ObjectId | None = None,
+    delay: float = 0,
+    max_attempts: int | None = None,
+    exclusive: bool = False,
+) -> dict:
+    now = datetime.now(timezone.utc)
+    job = {
+        "type": type,
+        "payload": payload or {},
+        "priority": priority,
+        "status": QUEUED,
+        "attempts": 0,
+        "max_attempts": max_attempts or settings.job_max_attempts,
+        "user_id": user_id,
+        "run_at": now + timedelta(seconds=delay),
+        "created_at": now,
+    }
+    if key is None:
+        res = await db.jobs.insert_one(job)
+        return {"_id": res.inserted_id, **job}
+    job["key"] = key
+    key_field = "active_key" if exclusive else "queued_key"
+    while True:
+        try:
+            return await db.jobs.find_one_and_update(
+                {key_field: key},
+                {"$setOnInsert": job},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            continue  # Lost the race to insert it, the next round finds it
+
+
+async def get_job(db: AsyncIOMotorDatabase, job_id: ObjectId) -> dict | None:
+    return await db.jobs.find_one({"_id": job_id})
+
+
+async def lease_job(
+    db: AsyncIOMotorDatabase,
+    worker: str,
+    lease_seconds: float,
+    exclude_types: list[str] | None = None,
+) -> dict | None:
+    now = datetime.now(timezone.utc)
+    query = {"status": {"$in": [QUEUED, RUNNING]}, "run_at": {"$lte": now}}
+    if exclude_types:
+        query["type"] = {"$nin": exclude_types}
+    return await db.jobs.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "status": RUNNING,
+                "worker": worker,
+                "run_at": now + timedelta(seconds=lease_seconds),
+                "started_at": now,
+            },
+            "$unset": {"queued_key": ""},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("priority", DESCENDING), ("run_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def leased(job: dict) -> dict:
+    # Matches the job only while this lease of it is current
+    return {"_id": job["_id"], "worker": job["worker"], "attempts": job["attempts"]}
+
+
+async def renew_lease(db: AsyncIOMotorDatabase, job: dict, lease_seconds: float):
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        run_at = datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)
+        await db.jobs.update_one(
+            {**leased(job), "status": RUNNING}, {"$set": {"run_at": run_at}}
+        )
+
+
+async def release_job(db: AsyncIOMotorDatabase, job: dict, delay: float = 0):
+    """Put the job back without counting the attempt."""
+    await db.jobs.update_one(
+        leased(job),
+        {
+            "$set": {
+                "status": QUEUED,
+                "run_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+            },
+            "$inc": {"attempts": -1},
+        },
+    )
+
+
+async def complete_job(db: AsyncIOMotorDatabase, job: dict, result: dict | None):
+    await db.jobs.update_one(
+        leased(job),
+        {
+            "$set": {
+                "status": DONE,
+                "result": result,
+                "error": None,
+                "finished_at": datetime.now(timezone.utc),
+            },
+            "$unset": {"active_key": ""},
+        },
+    )
+
+
+async def fail_job(db: AsyncIOMotorDatabase, job: dict, error: str):
+    now = datetime.now(timezone.utc)
+    if job["attempts"] >= job["max_attempts"]:
+        update = {
+            "$set": {"status": FAILED, "error": error, "finished_at": now},
+            "$unset": {"active_key": ""},
+        }
+    else:
+        backoff = min(
+            settings.job_retry_base_seconds * 2 ** (job["attempts"] - 1),
+            settings.job_retry_max_seconds,
+        )
+        update = {
+            "$set": {"status": QUEUED, "error": error, "run_at": now + timedelta(seconds=backoff)}
+        }
+    await db.jobs.update_one(leased(job), update)
+
+
+class JobRunner:
+    """Runs `concurrency` worker coroutines against the jobs in `db`.
+
+    `rate_limits` caps how many jobs of a type start per second in this
+    process; a type over its limit is skipped when leasing until it refills.
+    """
+
+    def __init__(
+        self,
+        db: AsyncIOMotorDatabase,
+        handlers: dict[str, Handler],
+        concurrency: int,
+        lease_seconds: float = 60,
+        poll_interval: float = 1,
+        rate_limits: dict[str, float] | None = None,
+    ):
+        self.db = db
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.limiters = {
+            type: RateLimiter(rate, max(1, int(rate)))
+            for type, rate in (rate_limits or {}).items()
+        }
+        self.limited_until: dict[str, float] = {}
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    def limited_types(self) -> list[str]:
+        now = asyncio.get_running_loop().time()
+        return [type for type, until in self.limited_until.items() if until > now]
+
+    async def run_once(self, worker: str) -> bool:
+        """Lease and run one job, return whether there was one."""
+        job = await lease_job(self.db, worker, self.lease_seconds, self.limited_types())
+        if job is None:
+            return False
+        limiter = self.limiters.get(job["type"])
+        retry_after = limiter.hit(job["type"]) if limiter else 0
+        if retry_after:
+            self.limited_until[job["type"]] = asyncio.get_running_loop().time() + retry_after
+            await release_job(self.db, job, retry_after)
+            return True
+        await self.run_job(job)
+        return True
+
+    async def run_job(self, job: dict):
+        renewer = asyncio.create_task(renew_lease(self.db, job, self.lease_seconds))
+        try:
+            handler = self.handlers.get(job["type"])
+            if handler is None:
+                raise LookupError(f"No handler for job type {job['type']!r}")
+            result = await handler(self.db, job["payload"])
+        except asyncio.CancelledError:
+            # Shutting down, let another worker have it straight away
+            await asyncio.shield(release_job(self.db, job))
+            raise
+        except Exception as e:
+            logger.warning(
+                json.dumps(
+                    {
+                        "event": "job_failed",
+                        "job_id": str(job["_id"]),
+                        "type": job["type"],
+                        "attempt": job["attempts"],
+                        "error": repr(e),
+                    }
+                )
+            )
+            await fail_job(self.db, job, repr(e))
+        else:
+            await complete_job(self.db, job, result)
+        finally:
+            renewer.cancel()
+
+    async def run_worker(self, worker: str):
+        while True:
+            try:
+                if await self.run_once(worker):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(json.dumps({"event": "job_worker_error", "error": repr(e)}))
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> list[asyncio.Task]:
+        return [
+            asyncio.create_task(self.run_worker(f"{self.worker_prefix}:{i}"))
+            for i in range(self.concurrency)
+        ]
+
+
+async def run_periodically(db: AsyncIOMotorDatabase, type: str, interval: float, **kwargs):
+    """Enqueue a `type` job every `interval` seconds. Every app process may
+    run this, the shared exclusive key keeps runs from overlapping."""
+    while True:
+        try:
+            await enqueue(db, type, key=type, exclusive=True, **kwargs)
+        except Exception as e:
+            logger.warning(json.dumps({"event": "job_schedule_error", "type": type, "error": repr(e)}))
+        await asyncio.sleep(interval)
+
+
+async def run_archive_messages(db: AsyncIOMotorDatabase, payload: dict) -> dict:
+    return {"archived": await archive.archive_messages(db, get_message_store())}
+
+
+async def run_sweep_avatars(db: AsyncIOMotorDatabase, payload: dict) -> dict:
+    deleted = await avatar_store.sweep_avatars(
+        db, AsyncIOMotorGridFSBucket(db), settings.avatar_sweep_batch_size
+    )
+    return {"deleted": deleted}
+
+
+async def run_bump_direct_chat_rooms(db: AsyncIOMotorDatabase, payload: dict) -> None:
+    await helpers.bump_direct_chat_rooms(db, ObjectId(payload["user_id"]))
+
+
+async def run_move_chat_room(db: AsyncIOMotorDatabase, payload: dict) -> None:
+    await move_chat_room(
+        db, get_message_store(), ObjectId(payload["chat_room_id"]), payload["partition"]
+    )
+
+
+@lru_cache
+def get_handlers() -> dict[str, Handler]:
+    return {
+        "archive_messages": run_archive_messages,
+        "bump_direct_chat_rooms": run_bump_direct_chat_rooms,
+        "move_chat_room": run_move_chat_room,
+        "sweep_avatars": run_sweep_avatars,
+    }
+
+
+def get_runner(db: AsyncIOMotorDatabase, concurrency: int | None = None) -> JobRunner:
+    return JobRunner(
+        db,
+        get_handlers(),
+        settings.job_workers if concurrency is None else concurrency,
+        lease_seconds=settings.job_lease_seconds,
+        poll_interval=settings.job_poll_interval_seconds,
+        rate_limits=settings.job_rate_limits,
+    )
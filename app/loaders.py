@@ -0,0 +1,53 @@
+import asyncio
+
+from bson import ObjectId
+from fastapi import Depends
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.database import get_db
+
+USER_PROJECTION = {"display_name": 1, "avatar_file_id": 1, "version": 1}
+
+
+class UserLoader:
+    """Batches and deduplicates user lookups made while handling one request.
+
+    Every `load` issued in the same event loop iteration is answered by a
+    single `$in` query, and each id is fetched at most once per loader.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.db = db
+        self.results: dict[ObjectId, asyncio.Future] = {}
+        self.queue: list[ObjectId] = []
+
+    async def load(self, user_id: ObjectId | str) -> dict | None:
+        user_id = ObjectId(user_id)
+        if user_id not in self.results:
+            loop = asyncio.get_running_loop()
+            self.results[user_id] = loop.create_future()
+            self.queue.append(user_id)
+            if len(self.queue) == 1:
+                loop.call_soon(lambda: loop.create_task(self.dispatch()))
+        return await self.results[user_id]
+
+    async def load_many(self, user_ids) -> list[dict | None]:
+        return await asyncio.gather(*(self.load(user_id) for user_id in user_ids))
+
+    async def dispatch(self):
+        user_ids, self.queue = self.queue, []
+        try:
+            users = await self.db.users.find(
+                {"_id": {"$in": user_ids}}, USER_PROJECTION
+            ).to_list(length=None)
+        except Exception as e:
+            for user_id in user_ids:
+                self.results[user_id].set_exception(e)
+            return
+        users_by_id = {user["_id"]: user for user in users}
+        for user_id in user_ids:
+            self.results[user_id].set_result(users_by_id.get(user_id))
+
+
+def get_user_loader(db=Depends(get_db)) -> UserLoader:
+    return UserLoader(db)
@@ -1,12 +1,16 @@
+import asyncio
+import signal
 from contextlib import asynccontextmanager
 from io import BytesIO
 import json
+from urllib.parse import quote
 from bson import ObjectId, json_util
-import uvicorn
+from bson.errors import InvalidId
 from fastapi import (
     FastAPI,
     Depends,
     File,
+    Header,
     HTTPException,
     Request,
     UploadFile,
@@ -14,23 +18,136 @@ from fastapi import (
     WebSocketDisconnect,
     status,
 )
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import ValidationError
 
 
-from app import oauth2, schemas, utils
+from app import (
+    archive,
+    attachments,
+    avatar_store,
+    avatars,
+    helpers,
+    jobs,
+    oauth2,
+    profiling,
+    rate_limiter,
+    replicas,
+    schemas,
+    server,
+    utils,
+)
 from app.connection_manager import ConnectionManager
-from app.database import get_db, get_fs
+from app.database import create_indexes, get_client, get_db, get_fs
+from app.loaders import get_user_loader
+from app.message_store import get_message_store
+from app.partitions import check_layout, get_router
 from app.config import settings
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from datetime import datetime, timezone
 
 
+manager = ConnectionManager()
+
+
+async def drain_connections():
+    await manager.drain(
+        deadline=settings.shutdown_drain_seconds,
+        batch_size=settings.shutdown_close_batch_size,
+        max_reconnect_delay=settings.reconnect_max_delay_seconds,
+    )
+
+
+def drain_before_exit():
+    # Servers close every websocket at once as soon as they get SIGTERM, before
+    # the lifespan shutdown runs. Drain first, then hand the signal on.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            async def drain_then_exit():
+                await drain_connections()
+                if callable(previous):
+                    previous(signum, frame)
+
+            if manager.draining:  # Second signal, stop waiting
+                if callable(previous):
+                    previous(signum, frame)
+                return
+            manager.draining = True
+            loop.call_soon_threadsafe(loop.create_task, drain_then_exit())
+
+        try:
+            signal.signal(sig, handler)
+        except ValueError:
+            pass  # Not running in the main thread
+
+
+async def warm_up(db: AsyncIOMotorDatabase):
+    """Do what the first requests would otherwise wait for. Uvicorn only
+    lets a worker accept connections once the lifespan startup is done."""
+    # Concurrent pings each check out a connection, filling the pool
+    await asyncio.gather(*(db.command("ping") for _ in range(settings.mongo_min_pool_size)))
+    for partition in get_router().partitions:
+        await partition.command("ping")
+    utils.get_pwd_context()
+    helpers.get_message_dedupe_cache()
+    helpers.get_version_cache()
+    rate_limiter.get_limiters()
+    jobs.get_handlers()
+    get_message_store()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # on startup
+    # on startup: singletons are built here rather than at import, so the
+    # first request does not pay for them
+    drain_before_exit()
+    manager.batch_threshold = settings.broadcast_batch_threshold_per_second
+    manager.batch_interval = settings.broadcast_batch_interval_seconds
+    db = await get_db()
+    await create_indexes(db)
+    await check_layout(db, get_router())
+    await warm_up(db)
+    profiling.get_slow_op_listener().attach(asyncio.get_running_loop(), get_client())
+    loop_lag = asyncio.create_task(profiling.get_loop_lag_monitor().run())
+    heartbeat = None
+    if settings.heartbeat_interval_seconds:
+        heartbeat = asyncio.create_task(
+            manager.run_heartbeat(
+                settings.heartbeat_interval_seconds, settings.heartbeat_timeout_seconds
+            )
+        )
+    archiver = None
+    if settings.archive_interval_seconds:
+        archiver = asyncio.create_task(
+            jobs.run_periodically(
+                db, "archive_messages", settings.archive_interval_seconds, priority=-10
+            )
+        )
+    avatar_sweeper = None
+    if settings.avatar_sweep_interval_seconds:
+        avatar_sweeper = asyncio.create_task(
+            jobs.run_periodically(
+                db, "sweep_avatars", settings.avatar_sweep_interval_seconds, priority=-10
+            )
+        )
+    job_workers = jobs.get_runner(db).start()
     yield
     # on shutdown
+    await drain_connections()
+    loop_lag.cancel()
+    if heartbeat:
+        heartbeat.cancel()
+    if archiver:
+        archiver.cancel()
+    if avatar_sweeper:
+        avatar_sweeper.cancel()
+    for worker in job_workers:
+        worker.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
 
 
 app = FastAPI(lifespan=lifespan)
@@ -41,12 +158,15 @@ origins = [
     "https://livechat-react.pages.dev"
 ]
 
+app.add_middleware(server.MaxRequestsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[replicas.CAUSAL_TOKEN_HEADER, "ETag", "Retry-After"],
 )
 
 
@@ -55,6 +175,21 @@ async def root():
     return {"message": "Hello You"}
 
 
+@app.get("/stats/connections", dependencies=[Depends(profiling.require_profile_token)])
+async def connection_stats():
+    return manager.stats()
+
+
+@app.get("/stats/channels", dependencies=[Depends(profiling.require_profile_token)])
+async def channel_stats(limit: int = 50):
+    return manager.channel_stats(min(limit, 500))
+
+
+@app.get("/stats/loop", dependencies=[Depends(profiling.require_profile_token)])
+async def loop_stats():
+    return profiling.get_loop_lag_monitor().stats()
+
+
 @app.get("/db")
 async def db_healthcheck(db: AsyncIOMotorDatabase = Depends(get_db)):
     try:
@@ -93,6 +228,7 @@ async def register(
             "email": payload.email,
             "password_hash": utils.hash(payload.password),
             "display_name": "New User",
+            "sync_seq": helpers.next_sync_seq(),
         }
     )
     return {"user_id": str(res.inserted_id)}
@@ -116,12 +252,11 @@ async def login(
     else:
         raise HTTPException(status_code=400, detail="Unsupported content type")
 
+    client_host = request.client.host if request.client else None
+    rate_limiter.check_login_rate(username, client_host)
     user = await db.users.find_one({"email": username})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials"
-        )
-    if not utils.verify(password, user["password_hash"]):
+    if not user or not utils.verify(password, user["password_hash"]):
+        rate_limiter.record_login_failure(username, client_host)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Credentials"
         )
@@ -132,72 +267,194 @@ async def login(
 
 @app.get("/auth/me")
 async def me(
+    request: Request,
+    response: Response,
     user=Depends(oauth2.get_current_user),
 ) -> schemas.UserResponse:
+    etag = helpers.make_etag("me", user["_id"], user.get("version", 0))
+    if helpers.etag_matches(request, etag):
+        return helpers.not_modified(etag)
+    response.headers["ETag"] = etag
     return schemas.UserResponse(**user)
 
 
+async def enqueue_direct_chat_room_bump(db: AsyncIOMotorDatabase, user_id: ObjectId) -> dict:
+    # The user's own version is read back at once, the fan-out to every
+    # direct room can wait for a worker
+    helpers.get_version_cache().pop(("users", user_id))
+    return await jobs.enqueue(
+        db,
+        "bump_direct_chat_rooms",
+        {"user_id": str(user_id)},
+        priority=10,
+        key=f"bump_direct_chat_rooms:{user_id}",
+        user_id=user_id,
+    )
+
+
 @app.put("/users/me/display_name")
 async def change_user_display_name(
     payload: schemas.UserChangeDisplayName,
+    response: Response,
     db=Depends(get_db),
+    session=Depends(replicas.get_write_session),
     user=Depends(oauth2.get_current_user),
 ):
     updated_result = await db.users.update_one(
-        {"_id": user.get("_id")}, {"$set": {"display_name": payload.display_name}}
+        {"_id": user.get("_id"), "display_name": {"$ne": payload.display_name}},
+        {
+            "$set": {
+                "display_name": payload.display_name,
+                "sync_seq": helpers.next_sync_seq(),
+            },
+            "$inc": {"version": 1},
+        },
+        session=session,
     )
     if updated_result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found or no changes made")
-    return {"message": "Display name updated successfully"}
+    job = await enqueue_direct_chat_room_bump(db, user.get("_id"))
+    replicas.set_causal_token(response, session)
+    return {"message": "Display name updated successfully", "job_id": str(job["_id"])}
 
 
 @app.put("/users/me/avatar")
 async def change_user_avatar(
+    response: Response,
     db=Depends(get_db),
     fs=Depends(get_fs),
+    session=Depends(replicas.get_write_session),
     user=Depends(oauth2.get_current_user),
     file: UploadFile = File(...),
 ):
-    file_id = await fs.upload_from_stream(
-        file.filename, file.file, metadata={"content_type": file.content_type}
-    )
-    updated_result = await db.users.update_one(
-        {"_id": user.get("_id")}, {"$set": {"avatar_file_id": file_id}}
-    )
-    if updated_result.modified_count == 0:
+    file_id = await avatar_store.store_avatar(db, fs, file)
+    try:
+        previous = await db.users.find_one_and_update(
+            {"_id": user.get("_id")},
+            {
+                "$set": {"avatar_file_id": file_id, "sync_seq": helpers.next_sync_seq()},
+                "$inc": {"version": 1},
+            },
+            projection={"avatar_file_id": 1},
+            session=session,
+        )
+    except Exception:
+        await avatar_store.release_avatar(db, file_id)
+        raise
+    if previous is None:
+        await avatar_store.release_avatar(db, file_id)
         raise HTTPException(status_code=404, detail="User not found or no changes made")
-    return {"file_id": str(file_id)}
+    await avatar_store.release_avatar(db, previous.get("avatar_file_id"))
+    job = await enqueue_direct_chat_room_bump(db, user.get("_id"))
+    replicas.set_causal_token(response, session)
+    return {"file_id": str(file_id), "job_id": str(job["_id"])}
+
+
+@app.get("/jobs/{id}")
+async def get_job(
+    id: str,
+    db=Depends(get_db),
+    user=Depends(oauth2.get_current_user),
+):
+    try:
+        job = await jobs.get_job(db, ObjectId(id))
+    except InvalidId:
+        job = None
+    # Only the user who started a job can see it
+    if not job or job.get("user_id") != user.get("_id"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return schemas.JobResponse(**job)
 
 
 @app.get("/users")
 async def search_users(
-    search: str = None, db=Depends(get_db)
-) -> schemas.UsersListResponse:
+    request: Request,
+    search: str = None,
+    ids: str = None,
+    db=Depends(replicas.get_secondary_db),
+    session=Depends(replicas.get_read_session),
+) -> schemas.UsersListResponse | schemas.UserSummariesListResponse:
+    if ids is not None:
+        # Batch profile lookup, e.g. every distinct sender on a page of messages.
+        # Signed-in users only, and display fields only, no contact data
+        await oauth2.get_current_user(await oauth2.oauth2_scheme(request), db)
+        try:
+            user_ids = list({ObjectId(user_id) for user_id in ids.split(",") if user_id})
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid user id")
+        if len(user_ids) > 300:
+            raise HTTPException(status_code=400, detail="At most 300 ids per request")
+        users = await db.users.find(
+            {"_id": {"$in": user_ids}},
+            {"display_name": 1, "avatar_file_id": 1},
+            session=session,
+        ).to_list(length=None)
+        return schemas.UserSummariesListResponse(
+            users=[schemas.UserSummaryResponse(**user) for user in users]
+        )
     users = await db.users.find(
-        {"email": {"$regex": f"^{search}", "$options": "i"}}
+        {"email": {"$regex": f"^{search}", "$options": "i"}}, session=session
     ).to_list(length=10)
     return {"users": [schemas.UserResponse(**user) for user in users]}
 
 
 @app.get("/users/{id}")
-async def get_user(id: str, db=Depends(get_db)) -> schemas.UserDisplayResponse:
-    user = await db.users.find_one({"_id": ObjectId(id)})
+async def get_user(
+    id: str,
+    request: Request,
+    response: Response,
+    db=Depends(replicas.get_secondary_db),
+    session=Depends(replicas.get_read_session),
+) -> schemas.UserDisplayResponse:
+    version = await helpers.get_version(db, "users", ObjectId(id), session)
+    if version is not None:
+        etag = helpers.make_etag("user", id, version)
+        if helpers.etag_matches(request, etag):
+            return helpers.not_modified(etag)
+    user = await db.users.find_one({"_id": ObjectId(id)}, session=session)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = helpers.make_etag("user", id, user.get("version", 0))
     return schemas.UserDisplayResponse(display_name=user.get("display_name"))
 
 
 @app.get("/images/{id}")
-async def show_image(id: str, fs=Depends(get_fs)):
-    grid_out = await fs.open_download_stream(ObjectId(id))
+async def show_image(
+    id: str,
+    fs=Depends(replicas.get_secondary_fs),
+    session=Depends(replicas.get_read_session),
+):
+    grid_out = await fs.open_download_stream(ObjectId(id), session=session)
+    if (grid_out.metadata or {}).get("chat_room_id"):
+        # Attachments share the bucket, they are only served to room members
+        raise HTTPException(status_code=404, detail="Image not found")
     image_bytes = await grid_out.read()
-    return StreamingResponse(BytesIO(image_bytes), media_type="image/jpeg")
+    return StreamingResponse(
+        BytesIO(image_bytes),
+        media_type="image/jpeg",
+        # A file id always names the same bytes
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+@app.get("/avatars/initials")
+async def show_initials_avatar(request: Request, name: str = "", id: str = None):
+    body, etag = avatars.render_initials_avatar(name, id or name)
+    headers = {
+        "ETag": etag,
+        # The URL fully determines the image, so it never needs revalidating
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if helpers.etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type="image/svg+xml", headers=headers)
 
 
 @app.post("/chat_rooms/direct", status_code=status.HTTP_201_CREATED)
 async def create_direct_chat_room(
     payload: schemas.DirectChatRoomCreate,
     db=Depends(get_db),
+    user_loader=Depends(get_user_loader),
     current_user=Depends(oauth2.get_current_user),
 ) -> schemas.ChatRoomResponse:
     if str(current_user.get("_id")) not in payload.user_ids:
@@ -208,6 +465,9 @@ async def create_direct_chat_room(
     pipeline = [
         {
             "$match": {
+                # Narrows to the rooms of both users by index, $expr alone
+                # would be evaluated against every room
+                "user_ids": {"$all": user_ids},
                 "$expr": {
                     "$and": [
                         {
@@ -227,14 +487,16 @@ async def create_direct_chat_room(
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT, detail="Chat room already exists"
         )
-    res = await db.chat_rooms.insert_one({"type": "direct", "user_ids": user_ids})
+    res = await db.chat_rooms.insert_one(
+        {"type": "direct", "user_ids": user_ids, "sync_seq": helpers.next_sync_seq()}
+    )
 
     chat_partner_id = (
         payload.user_ids[0]
-        if payload.user_ids[1] == current_user.get("_id")
+        if payload.user_ids[1] == str(current_user.get("_id"))
         else payload.user_ids[1]
     )
-    chat_partner = await db.users.find_one({"_id": ObjectId(chat_partner_id)})
+    chat_partner = await user_loader.load(chat_partner_id)
     response = await db.chat_rooms.find_one({"_id": res.inserted_id})
     return schemas.ChatRoomResponse(
         **response,
@@ -247,12 +509,18 @@ async def create_direct_chat_room(
 
 @app.get("/chat_rooms/direct")
 async def get_direct_chat_room(
-    partner_id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+    partner_id: str,
+    db=Depends(get_db),
+    user_loader=Depends(get_user_loader),
+    current_user=Depends(oauth2.get_current_user),
 ) -> schemas.ChatRoomResponse:
     user_ids = [ObjectId(partner_id), ObjectId(current_user["_id"])]
     pipeline = [
         {
             "$match": {
+                # Narrows to the rooms of both users by index, $expr alone
+                # would be evaluated against every room
+                "user_ids": {"$all": user_ids},
                 "$expr": {
                     "$and": [
                         {
@@ -272,40 +540,276 @@ async def get_direct_chat_room(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Chat room not found"
         )
-    partner = await db.users.find_one({"_id": ObjectId(partner_id)})
+    partner = await user_loader.load(partner_id)
     name = partner.get("display_name")
     avatar_url = utils.get_avatar_url(partner.get("avatar_file_id"), name)
     return schemas.ChatRoomResponse(**chat_rooms[0], name=name, avatar_url=avatar_url)
 
 
-@app.get("/chat_rooms/{id}")
-async def get_chat_room(
-    id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+@app.post("/chat_rooms/group", status_code=status.HTTP_201_CREATED)
+async def create_group_chat_room(
+    payload: schemas.GroupChatRoomCreate,
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
 ) -> schemas.ChatRoomResponse:
-    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(id)})
+    member_ids = {current_user.get("_id")}
+    member_ids.update(ObjectId(user_id) for user_id in payload.user_ids)
+    existing_count = await db.users.count_documents({"_id": {"$in": list(member_ids)}})
+    if existing_count != len(member_ids):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    now = datetime.now(timezone.utc)
+    chat_room = {
+        "type": "group",
+        "name": payload.name,
+        "owner_id": current_user.get("_id"),
+        "public": payload.public,
+        "member_count": len(member_ids),
+        "created_at": now,
+        "sync_seq": helpers.next_sync_seq(),
+    }
+    res = await db.chat_rooms.insert_one(chat_room)
+    await db.chat_room_members.insert_many(
+        [
+            {"chat_room_id": res.inserted_id, "user_id": user_id, "joined_at": now}
+            for user_id in member_ids
+        ],
+        ordered=False,
+    )
+    return schemas.ChatRoomResponse(
+        **chat_room, avatar_url=utils.get_avatar_url(None, payload.name)
+    )
+
+
+@app.post("/chat_rooms/{id}/invites", status_code=status.HTTP_201_CREATED)
+async def invite_to_group_chat_room(
+    id: str,
+    payload: schemas.ChatRoomInviteCreate,
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
+):
+    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(id)}, {"type": 1})
     if not chat_room:
         raise HTTPException(status_code=404, detail="Chat room not found")
-    if current_user.get("_id") not in chat_room.get("user_ids"):
+    if chat_room.get("type") != "group":
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only group chat rooms take invites",
+        )
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    if not ObjectId.is_valid(payload.user_id) or not await db.users.find_one(
+        {"_id": ObjectId(payload.user_id)}, {"_id": 1}
+    ):
+        raise HTTPException(status_code=404, detail="User not found")
+    await db.chat_room_invites.update_one(
+        {"chat_room_id": chat_room["_id"], "user_id": ObjectId(payload.user_id)},
+        {
+            "$setOnInsert": {
+                "invited_by": current_user.get("_id"),
+                "created_at": datetime.now(timezone.utc),
+            }
+        },
+        upsert=True,
+    )
+    return {"message": "Invited to chat room successfully"}
+
+
+@app.post("/chat_rooms/{id}/join")
+async def join_group_chat_room(
+    id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+):
+    chat_room = await db.chat_rooms.find_one(
+        {"_id": ObjectId(id)}, {"type": 1, "public": 1}
+    )
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if chat_room.get("type") != "group":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only group chat rooms can be joined",
+        )
+    invite = {"chat_room_id": chat_room["_id"], "user_id": current_user.get("_id")}
+    if (
+        not chat_room.get("public")
+        and not await db.chat_room_invites.find_one(invite)
+        and not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id"))
+    ):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    res = await db.chat_room_members.update_one(
+        {"chat_room_id": chat_room["_id"], "user_id": current_user.get("_id")},
+        {"$setOnInsert": {"joined_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    if res.upserted_id:
+        await db.chat_rooms.update_one(
+            {"_id": chat_room["_id"]},
+            {
+                "$inc": {"member_count": 1, "version": 1},
+                "$set": {"sync_seq": helpers.next_sync_seq()},
+            },
+        )
+    await db.chat_room_invites.delete_one(invite)
+    return {"message": "Joined chat room successfully"}
+
+
+@app.post("/chat_rooms/{id}/leave")
+async def leave_group_chat_room(
+    id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+):
+    res = await db.chat_room_members.delete_one(
+        {"chat_room_id": ObjectId(id), "user_id": current_user.get("_id")}
+    )
+    if res.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Membership not found")
+    await db.chat_rooms.update_one(
+        {"_id": ObjectId(id)},
+        {
+            "$inc": {"member_count": -1, "version": 1},
+            "$set": {"sync_seq": helpers.next_sync_seq()},
+        },
+    )
+    return {"message": "Left chat room successfully"}
+
+
+@app.get("/chat_rooms/{id}/members")
+async def get_group_chat_room_members(
+    id: str,
+    after: str = None,
+    page_size: int = 50,
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.ChatRoomMembersListResponse:
+    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(id)}, {"type": 1})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if chat_room.get("type") != "group":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only group chat rooms have a member list",
+        )
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    match = {"chat_room_id": chat_room["_id"]}
+    if after:
+        match["user_id"] = {"$gt": ObjectId(after)}  # Keyset pagination
+    page_size = min(page_size, 200)
+    members = []
+    async for member in db.chat_room_members.aggregate(
+        [
+            {"$match": match},
+            {"$sort": {"user_id": 1}},
+            {"$limit": page_size},
+            {
+                "$lookup": {
+                    "from": "users",
+                    "localField": "user_id",
+                    "foreignField": "_id",
+                    "pipeline": [{"$project": {"display_name": 1, "avatar_file_id": 1}}],
+                    "as": "user",
+                }
+            },
+            {"$unwind": "$user"},
+        ]
+    ):
+        name = member["user"].get("display_name")
+        members.append(
+            schemas.ChatRoomMemberResponse(
+                user_id=member["user_id"],
+                display_name=name,
+                avatar_url=utils.get_avatar_url(
+                    member["user"].get("avatar_file_id"), name
+                ),
+                joined_at=member["joined_at"],
+            )
         )
+    return schemas.ChatRoomMembersListResponse(members=members)
+
+
+async def chat_room_response(
+    chat_room: dict, current_user: dict, user_loader
+) -> schemas.ChatRoomResponse:
     if chat_room.get("type") == "direct":
         partner_id = (
             chat_room.get("user_ids")[0]
             if chat_room.get("user_ids")[1] == current_user.get("_id")
             else chat_room.get("user_ids")[1]
         )
-        partner = await db.users.find_one({"_id": ObjectId(partner_id)})
+        partner = await user_loader.load(partner_id)
         name = partner.get("display_name")
         avatar_url = utils.get_avatar_url(partner.get("avatar_file_id"), name)
         return schemas.ChatRoomResponse(**chat_room, name=name, avatar_url=avatar_url)
-    return schemas.ChatRoomResponse(**chat_room)
+    return schemas.ChatRoomResponse(
+        **chat_room, avatar_url=utils.get_avatar_url(None, chat_room.get("name"))
+    )
+
+
+@app.get("/chat_rooms/{id}")
+async def get_chat_room(
+    id: str,
+    request: Request,
+    response: Response,
+    db=Depends(get_db),
+    user_loader=Depends(get_user_loader),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.ChatRoomResponse:
+    # Just what the membership check and the ETag need, the room and its
+    # partner are only loaded when the client's copy is stale
+    chat_room = await db.chat_rooms.find_one(
+        {"_id": ObjectId(id)}, {"type": 1, "user_ids": 1, "version": 1}
+    )
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    etag = helpers.make_etag(
+        "chat_room", chat_room["_id"], current_user["_id"], chat_room.get("version", 0)
+    )
+    if helpers.etag_matches(request, etag):
+        return helpers.not_modified(etag)
+    chat_room = await db.chat_rooms.find_one({"_id": chat_room["_id"]})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    response.headers["ETag"] = helpers.make_etag(
+        "chat_room", chat_room["_id"], current_user["_id"], chat_room.get("version", 0)
+    )
+    return await chat_room_response(chat_room, current_user, user_loader)
 
 
 @app.get("/chat_rooms")
 async def get_chat_rooms(
-    db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+    request: Request,
+    response: Response,
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
 ) -> schemas.ChatRoomsListResponse:
+    memberships = await db.chat_room_members.find(
+        {"user_id": current_user.get("_id")}, {"chat_room_id": 1}
+    ).to_list(length=None)
+    group_chat_room_ids = [member["chat_room_id"] for member in memberships]
+    # The list only changes when a room is added, removed or has its version
+    # bumped, so compare (id, version) pairs before doing the full lookup.
+    versions = await db.chat_rooms.find(
+        {
+            "$or": [
+                {"type": "direct", "user_ids": current_user.get("_id")},
+                {"_id": {"$in": group_chat_room_ids}, "type": "group"},
+            ]
+        },
+        {"version": 1},
+    ).to_list(length=None)
+    etag = helpers.make_etag(
+        "chat_rooms",
+        current_user["_id"],
+        sorted((str(room["_id"]), room.get("version", 0)) for room in versions),
+    )
+    if helpers.etag_matches(request, etag):
+        return helpers.not_modified(etag)
+    response.headers["ETag"] = etag
+
     chat_rooms = []
     # query direct, group rieng
     pipeline = [
@@ -336,28 +840,309 @@ async def get_chat_rooms(
         )
         chat_rooms.append(chat_room)
 
+    if group_chat_room_ids:
+        async for chat_room in db.chat_rooms.find(
+            {"_id": {"$in": group_chat_room_ids}, "type": "group"}
+        ):
+            chat_room["avatar_url"] = utils.get_avatar_url(None, chat_room["name"])
+            chat_rooms.append(chat_room)
+
     return schemas.ChatRoomsListResponse(chat_rooms=chat_rooms)
 
 
+@app.get("/sync")
+async def sync(
+    since: str = None,
+    message_limit: int = 50,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    user_loader=Depends(get_user_loader),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.SyncResponse:
+    since_seq = helpers.decode_sync_token(since) if since else None
+    message_limit = min(message_limit, 200)
+    # Taken before reading so nothing written meanwhile can fall behind it
+    next_seq = helpers.next_sync_seq() - int(settings.sync_settle_seconds * 1_000_000)
+    if since_seq is not None:
+        next_seq = max(next_seq, since_seq)
+
+    memberships = await db.chat_room_members.find(
+        {"user_id": current_user.get("_id")}, {"chat_room_id": 1}
+    ).to_list(length=None)
+    direct_chat_rooms = await db.chat_rooms.find(
+        {"type": "direct", "user_ids": current_user.get("_id")}, {"_id": 1}
+    ).to_list(length=None)
+    chat_room_ids = [member["chat_room_id"] for member in memberships] + [
+        chat_room["_id"] for chat_room in direct_chat_rooms
+    ]
+
+    changed_query = {"_id": {"$in": chat_room_ids}}
+    if since_seq is not None:
+        changed_query["sync_seq"] = {"$gt": since_seq}
+    chat_rooms = [
+        await chat_room_response(chat_room, current_user, user_loader)
+        async for chat_room in db.chat_rooms.find(changed_query)
+    ]
+
+    truncated_seqs = []
+
+    async def room_messages(chat_room_id):
+        if since_seq is None:
+            # Cold start: only the latest page of each room
+            messages = await message_store.get_messages(db, chat_room_id, limit=message_limit)
+            messages.reverse()
+            has_more = len(messages) == message_limit
+        else:
+            messages = await message_store.get_messages_since(
+                db, chat_room_id, since_seq, message_limit + 1
+            )
+            has_more = len(messages) > message_limit
+            messages = messages[:message_limit]
+            if has_more:
+                truncated_seqs.append(messages[-1]["sync_seq"])
+        return schemas.SyncChatRoomMessages(
+            chat_room_id=str(chat_room_id), messages=messages, has_more=has_more
+        )
+
+    # One indexed range read per room; rooms without changes return nothing
+    messages = [
+        room
+        for room in await asyncio.gather(*map(room_messages, chat_room_ids))
+        if room.messages
+    ]
+    if truncated_seqs:
+        # A truncated room continues after its last message on the next sync,
+        # from one before it in case another message shares its sync_seq
+        next_seq = min(next_seq, min(truncated_seqs) - 1)
+    me = None
+    if since_seq is None or current_user.get("sync_seq", 0) > since_seq:
+        me = schemas.UserResponse(**current_user)
+    return schemas.SyncResponse(
+        next_token=helpers.encode_sync_token(next_seq),
+        chat_room_ids=[str(chat_room_id) for chat_room_id in chat_room_ids],
+        chat_rooms=chat_rooms,
+        messages=messages,
+        me=me,
+    )
+
+
+@app.post("/uploads", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    payload: schemas.UploadSessionCreate,
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.UploadSessionResponse:
+    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(payload.chat_room_id)})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    session = await attachments.create_upload_session(
+        db,
+        current_user.get("_id"),
+        chat_room["_id"],
+        payload.filename,
+        payload.content_type,
+        payload.length,
+    )
+    return schemas.UploadSessionResponse(**session)
+
+
+@app.get("/uploads/{id}")
+async def get_upload(
+    id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+) -> schemas.UploadSessionResponse:
+    session = await attachments.get_upload_session(db, id, current_user.get("_id"))
+    return schemas.UploadSessionResponse(**session)
+
+
+@app.put("/uploads/{id}")
+async def upload_chunks(
+    id: str,
+    offset: int,
+    request: Request,
+    x_chunk_sha256: str | None = Header(None),
+    db=Depends(get_db),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.UploadSessionResponse:
+    session = await attachments.get_upload_session(db, id, current_user.get("_id"))
+    session = await attachments.write_chunks(db, session, offset, request, x_chunk_sha256)
+    return schemas.UploadSessionResponse(**session)
+
+
+@app.post("/uploads/{id}/complete", status_code=status.HTTP_201_CREATED)
+async def complete_upload(
+    id: str, db=Depends(get_db), current_user=Depends(oauth2.get_current_user)
+) -> schemas.AttachmentResponse:
+    session = await attachments.get_upload_session(db, id, current_user.get("_id"))
+    file = await attachments.complete_upload(db, session)
+    return schemas.AttachmentResponse(
+        _id=file["_id"],
+        filename=file["filename"],
+        content_type=file["metadata"]["content_type"],
+        size=file["length"],
+    )
+
+
+@app.get("/attachments/{id}")
+async def download_attachment(
+    id: str,
+    db=Depends(get_db),
+    fs=Depends(get_fs),
+    current_user=Depends(oauth2.get_current_user),
+):
+    file = await db["fs.files"].find_one({"_id": ObjectId(id)})
+    if not file or "chat_room_id" not in file.get("metadata", {}):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    chat_room = await db.chat_rooms.find_one({"_id": file["metadata"]["chat_room_id"]})
+    if not chat_room or not await helpers.is_chat_room_member(
+        db, chat_room, current_user.get("_id")
+    ):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    grid_out = await fs.open_download_stream(file["_id"])
+
+    async def chunks():
+        while chunk := await grid_out.readchunk():
+            yield chunk
+
+    return StreamingResponse(
+        chunks(),
+        media_type=file["metadata"]["content_type"],
+        headers={
+            "Content-Length": str(file["length"]),
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file['filename'])}",
+        },
+    )
+
+
 @app.post("/messages", status_code=status.HTTP_201_CREATED)
 async def post_message(
     payload: schemas.MessageCreate,
+    response: Response,
     db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    session=Depends(replicas.get_write_session),
     current_user=Depends(oauth2.get_current_user),
 ) -> schemas.MessageResponse:
     chat_room = await db.chat_rooms.find_one({"_id": ObjectId(payload.chat_room_id)})
-    if current_user.get("_id") not in chat_room.get("user_ids"):
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    res = await db.messages.insert_one(
-        {
-            **payload.model_dump(),
-            "chat_room_id": ObjectId(payload.chat_room_id),
-            "user_id": current_user.get("_id"),
-        }
+    if payload.client_message_id:
+        # A retry of a recent send costs no rate limit
+        message = helpers.get_recent_message(
+            current_user.get("_id"), chat_room["_id"], payload.client_message_id
+        )
+        if message:
+            return schemas.MessageResponse(**message)
+    rate_limiter.check_message_rate(current_user.get("_id"), payload.chat_room_id)
+    message = {
+        **payload.model_dump(exclude_none=True, exclude={"attachment_ids"}),
+        "chat_room_id": ObjectId(payload.chat_room_id),
+        "user_id": current_user.get("_id"),
+    }
+    if payload.attachment_ids:
+        # Embedded so history renders without a lookup per attachment
+        message["attachments"] = await attachments.get_attachments(
+            db, payload.attachment_ids, current_user.get("_id"), chat_room["_id"]
+        )
+    message, _ = await helpers.insert_message_once(db, message_store, message, session)
+    replicas.set_causal_token(response, session)
+    return schemas.MessageResponse(**message)
+
+
+def parse_message_id(id: str) -> ObjectId:
+    if not ObjectId.is_valid(id):
+        raise HTTPException(status_code=404, detail="Message not found")
+    return ObjectId(id)
+
+
+@app.patch("/messages/{id}")
+async def edit_message(
+    id: str,
+    payload: schemas.MessageEdit,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.MessagePatch:
+    chat_room = await helpers.get_member_chat_room(
+        db, payload.chat_room_id, current_user.get("_id")
+    )
+    patch = await helpers.edit_message(
+        db,
+        message_store,
+        chat_room["_id"],
+        parse_message_id(id),
+        current_user.get("_id"),
+        payload.content,
     )
+    await manager.broadcast(json.dumps(patch), f"chat_room_{payload.chat_room_id}")
+    return patch
 
-    message = await db.messages.find_one({"_id": res.inserted_id})
-    return schemas.MessageResponse(**message)
+
+@app.delete("/messages/{id}")
+async def delete_message(
+    id: str,
+    chat_room_id: str,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.MessagePatch:
+    chat_room = await helpers.get_member_chat_room(db, chat_room_id, current_user.get("_id"))
+    patch = await helpers.delete_message(
+        db, message_store, chat_room["_id"], parse_message_id(id), current_user.get("_id")
+    )
+    await manager.broadcast(json.dumps(patch), f"chat_room_{chat_room_id}")
+    return patch
+
+
+@app.post("/messages/{id}/reactions")
+async def add_reaction(
+    id: str,
+    payload: schemas.ReactionCreate,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.MessagePatch:
+    chat_room = await helpers.get_member_chat_room(
+        db, payload.chat_room_id, current_user.get("_id")
+    )
+    patch, changed = await helpers.react_to_message(
+        db,
+        message_store,
+        chat_room["_id"],
+        parse_message_id(id),
+        current_user.get("_id"),
+        payload.emoji,
+    )
+    if changed:
+        await manager.broadcast(json.dumps(patch), f"chat_room_{payload.chat_room_id}")
+    return patch
+
+
+@app.delete("/messages/{id}/reactions/{emoji}")
+async def remove_reaction(
+    id: str,
+    emoji: str,
+    chat_room_id: str,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+) -> schemas.MessagePatch:
+    chat_room = await helpers.get_member_chat_room(db, chat_room_id, current_user.get("_id"))
+    patch, changed = await helpers.react_to_message(
+        db,
+        message_store,
+        chat_room["_id"],
+        parse_message_id(id),
+        current_user.get("_id"),
+        emoji,
+        add=False,
+    )
+    if changed:
+        await manager.broadcast(json.dumps(patch), f"chat_room_{chat_room_id}")
+    return patch
 
 
 @app.get("/messages")
@@ -365,28 +1150,203 @@ async def get_messages(
     chat_room_id: str,
     page: int = 1,
     page_size: int = 25,
+    before: datetime = None,
+    from_seq: int = None,
+    to_seq: int = None,
+    include_users: bool = False,
     db=Depends(get_db),
+    read_db=Depends(replicas.get_secondary_db),
+    session=Depends(replicas.get_read_session),
+    message_store=Depends(get_message_store),
+    user_loader=Depends(get_user_loader),
     current_user=Depends(oauth2.get_current_user),
 ) -> schemas.MessagesListResponse:
     chat_room = await db.chat_rooms.find_one({"_id": ObjectId(chat_room_id)})
     if not chat_room:
         raise HTTPException(status_code=404, detail="Chat room not found")
-    if current_user.get("_id") not in chat_room.get("user_ids"):
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden"
         )
     skip = (page - 1) * page_size
-    messages = await db.messages.aggregate(
-        [
-            {
-                "$match": {"chat_room_id": ObjectId(chat_room_id)}
-            },  # Filter messages by chat room
-            {"$sort": {"created_at": -1}},  # Sort by timestamp in descending order
-            {"$skip": skip},  # Skip the first (page - 1) * page_size messages
-            {"$limit": page_size},  # Limit the number of results to page_size
-        ]
-    ).to_list(length=page_size)
-    return schemas.MessagesListResponse(messages=messages)
+    if from_seq is not None:
+        # An exact range by room sequence number, oldest first
+        messages = await get_messages_by_seq(
+            read_db, message_store, chat_room, from_seq, to_seq, page_size, session
+        )
+    else:
+        # History tolerates replica lag, the session still shows the caller's own writes
+        messages = await message_store.get_messages(
+            read_db, chat_room["_id"], skip=skip, limit=page_size, before=before, session=session
+        )
+    if from_seq is None and len(messages) < page_size and chat_room.get("archived"):
+        # The page runs past the hot range, continue into the archive
+        hot_count = (
+            skip + len(messages)
+            if messages
+            else await message_store.count_messages(
+                read_db, chat_room["_id"], before, session=session
+            )
+        )
+        messages += await archive.get_archived_messages(
+            read_db,
+            chat_room["_id"],
+            skip=max(skip - hot_count, 0),
+            limit=page_size - len(messages),
+            before=before,
+        )
+    if include_users:
+        # Sender display info, so one round trip renders the whole page
+        users = await user_loader.load_many({message["user_id"] for message in messages})
+        return schemas.MessagesListResponse(
+            messages=messages,
+            users=[user for user in users if user],
+            last_seq=chat_room.get("last_message_seq", 0),
+        )
+    return schemas.MessagesListResponse(
+        messages=messages, last_seq=chat_room.get("last_message_seq", 0)
+    )
+
+
+async def get_messages_by_seq(
+    db, message_store, chat_room: dict, from_seq: int, to_seq: int | None, limit: int, session
+) -> list[dict]:
+    to_seq = from_seq + limit - 1 if to_seq is None else min(to_seq, from_seq + limit - 1)
+    if to_seq < from_seq:
+        return []
+    messages = await message_store.get_messages_by_seq(
+        db, chat_room["_id"], from_seq, to_seq, limit, session=session
+    )
+    if chat_room.get("archived") and (
+        len(messages) < to_seq - from_seq + 1 or messages[0]["seq"] > from_seq
+    ):
+        # Part of the range may have been moved out to the archive
+        archived = await archive.get_archived_messages_by_seq(
+            db, chat_room["_id"], from_seq, to_seq, limit
+        )
+        seen = {message["_id"] for message in messages}
+        messages += [message for message in archived if message["_id"] not in seen]
+        messages.sort(key=lambda message: message["seq"])
+    return messages[:limit]
+
+
+@app.get("/chat_rooms/{id}/messages/export")
+async def export_messages(
+    id: str,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+):
+    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(id)})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    async def ndjson_lines():
+        # Oldest first: archived segments, then the hot store. Lines are sent
+        # in small groups so memory stays flat however long the history is.
+        sources = [message_store.iter_messages(db, chat_room["_id"])]
+        if chat_room.get("archived"):
+            sources.insert(0, archive.iter_archived_messages(db, chat_room["_id"]))
+        lines = []
+        for source in sources:
+            async for message in source:
+                lines.append(schemas.MessageResponse(**message).model_dump_json(by_alias=True))
+                if len(lines) >= 500:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return StreamingResponse(
+        ndjson_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{id}.ndjson"'},
+    )
+
+
+@app.post("/chat_rooms/{id}/messages/import")
+async def import_messages(
+    id: str,
+    request: Request,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
+    current_user=Depends(oauth2.get_current_user),
+):
+    chat_room = await db.chat_rooms.find_one({"_id": ObjectId(id)})
+    if not chat_room:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if not await helpers.is_chat_room_member(db, chat_room, current_user.get("_id")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+    received = 0
+    imported = 0
+    batch = []
+    pending = b""
+    # Only the owner of a group may import on behalf of its current members
+    authors = {current_user["_id"]: True}
+
+    async def flush():
+        # Awaiting the write before reading more of the body is the backpressure
+        nonlocal batch, imported
+        # One counter bump numbers the whole batch, in file order
+        first_seq = await helpers.allocate_message_seqs(db, chat_room["_id"], len(batch))
+        for seq, document in enumerate(batch, first_seq):
+            document["seq"] = seq
+        imported += await message_store.insert_messages(db, batch)
+        batch = []
+
+    async def author_id(user_id: str | None) -> ObjectId:
+        if user_id is None:
+            return current_user["_id"]
+        user_id = ObjectId(user_id)
+        if user_id not in authors:
+            authors[user_id] = chat_room.get(
+                "owner_id"
+            ) == current_user["_id"] and await helpers.is_chat_room_member(
+                db, chat_room, user_id
+            )
+        if not authors[user_id]:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Cannot import messages of another user on line {received + 1}",
+            )
+        return user_id
+
+    async def parse(line: bytes) -> dict:
+        # Ids are always assigned here, never taken from the file
+        message = schemas.MessageImport.model_validate_json(line)
+        return {
+            "content": message.content,
+            "chat_room_id": chat_room["_id"],
+            "user_id": await author_id(message.user_id),
+            "created_at": message.created_at,
+            "sync_seq": helpers.next_sync_seq(),
+        }
+
+    try:
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                batch.append(await parse(line))
+                received += 1
+                if len(batch) >= settings.message_import_batch_size:
+                    await flush()
+        if pending.strip():
+            batch.append(await parse(pending))
+            received += 1
+    except (ValueError, InvalidId) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid message on line {received + 1}: {e}",
+        )
+    if batch:
+        await flush()
+    return {"imported": imported, "skipped": received - imported}
 
 
 # exclude for prod later
@@ -405,60 +1365,199 @@ async def test_db(db=Depends(get_db)):
     return res
 
 
-manager = ConnectionManager()
+async def apply_message_action(
+    db, message_store, current_user: dict, data: dict
+) -> tuple[dict, bool]:
+    chat_room = await helpers.get_member_chat_room(
+        db, data.get("chat_room_id", ""), current_user.get("_id")
+    )
+    message_id = parse_message_id(data.get("message_id", ""))
+    if data["type"] == "edit":
+        patch = await helpers.edit_message(
+            db,
+            message_store,
+            chat_room["_id"],
+            message_id,
+            current_user.get("_id"),
+            str(data.get("content", "")),
+        )
+        return patch, True
+    if data["type"] == "delete":
+        patch = await helpers.delete_message(
+            db, message_store, chat_room["_id"], message_id, current_user.get("_id")
+        )
+        return patch, True
+    return await helpers.react_to_message(
+        db,
+        message_store,
+        chat_room["_id"],
+        message_id,
+        current_user.get("_id"),
+        str(data.get("emoji", "")),
+        add=data["type"] == "react",
+    )
 
 
 @app.websocket("/ws/chat_rooms/{chat_room_id}")
 async def websocket_endpoint(
-    websocket: WebSocket, chat_room_id: str, db=Depends(get_db)
+    websocket: WebSocket,
+    chat_room_id: str,
+    db=Depends(get_db),
+    message_store=Depends(get_message_store),
 ):
     channel_id = f"chat_room_{chat_room_id}"
-    await manager.connect(websocket, channel_id)
+    if not await manager.accept(websocket):
+        return
+    current_user = None
     try:
         while True:
-            data = await websocket.receive_text()
-            data = json.loads(data)
-            if data["type"] == "auth":
-                current_user = await oauth2.get_current_user(data["token"], db)
-                print(current_user)
-            elif data["type"] == "message":
-                message = data["message"]
-                chat_room = await db.chat_rooms.find_one(
-                    {"_id": ObjectId(message.get("chat_room_id"))}
+            if current_user is None:
+                # Not subscribed yet, so heartbeats do not cover the socket
+                data = await asyncio.wait_for(
+                    websocket.receive_text(), timeout=settings.heartbeat_timeout_seconds
                 )
-                if current_user.get("_id") not in chat_room.get("user_ids"):
+            else:
+                data = await websocket.receive_text()
+            manager.touch(websocket)
+            with manager.busy():
+                data = json.loads(data)
+                if data["type"] == "pong":
+                    continue
+                if data["type"] == "auth":
+                    current_user = await oauth2.get_current_user(data["token"], db)
+                    print(current_user)
+                    chat_room = (
+                        await db.chat_rooms.find_one({"_id": ObjectId(chat_room_id)})
+                        if ObjectId.is_valid(chat_room_id)
+                        else None
+                    )
+                    if not chat_room or not await helpers.is_chat_room_member(
+                        db, chat_room, current_user.get("_id")
+                    ):
+                        raise HTTPException(
+                            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden"
+                        )
+                    # Only members that authenticated receive the room's broadcasts,
+                    # in batch frames only for clients that understand them
+                    manager.subscribe(
+                        websocket, channel_id, batch=data.get("batch") is True
+                    )
+                elif current_user is None:
                     raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden"
+                        status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+                    )
+                elif data["type"] == "message":
+                    try:
+                        payload = schemas.MessageCreate.model_validate(data["message"])
+                    except ValidationError as e:
+                        await websocket.send_text(
+                            json.dumps(
+                                {
+                                    "type": "error",
+                                    "status": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                    "detail": e.errors(include_url=False, include_input=False),
+                                }
+                            )
+                        )
+                        continue
+                    chat_room = await db.chat_rooms.find_one(
+                        {"_id": ObjectId(payload.chat_room_id)}
                     )
-                res = await db.messages.insert_one(
-                    {
-                        "content": message.get("content"),
-                        "chat_room_id": ObjectId(message.get("chat_room_id")),
+                    if not chat_room or not await helpers.is_chat_room_member(
+                        db, chat_room, current_user.get("_id")
+                    ):
+                        raise HTTPException(
+                            status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden"
+                        )
+                    try:
+                        rate_limiter.check_message_rate(
+                            current_user.get("_id"), payload.chat_room_id
+                        )
+                    except HTTPException as e:
+                        await websocket.send_text(
+                            json.dumps(
+                                {
+                                    "type": "error",
+                                    "status": e.status_code,
+                                    "detail": e.detail,
+                                    "retry_after": int(e.headers["Retry-After"]),
+                                }
+                            )
+                        )
+                        continue
+                    message = {
+                        "content": payload.content,
+                        "chat_room_id": ObjectId(payload.chat_room_id),
                         "user_id": current_user.get("_id"),
                         "created_at": datetime.now(timezone.utc),
                     }
-                )
-
-                message = await db.messages.find_one({"_id": res.inserted_id})
-                print(message)
-                await manager.broadcast(
-                    json_util.dumps(
+                    if payload.client_message_id:
+                        message["client_message_id"] = payload.client_message_id
+                    if payload.attachment_ids:
+                        message["attachments"] = await attachments.get_attachments(
+                            db,
+                            payload.attachment_ids,
+                            current_user.get("_id"),
+                            chat_room["_id"],
+                        )
+                    async with replicas.write_session(db) as session:
+                        message, created = await helpers.insert_message_once(
+                            db, message_store, message, session
+                        )
+                        token = replicas.causal_token(session)
+                    print(message)
+                    event = json_util.dumps(
                         {
                             "type": "message",
                             "message": schemas.MessageResponse(**message).model_dump(by_alias=True),
                         }
-                    ),
-                    channel_id,
-                )
+                    )
+                    if created:
+                        await manager.broadcast(event, channel_id)
+                    else:
+                        # A retry: everyone else already has it, only echo it back
+                        await websocket.send_text(event)
+                    if token:
+                        await websocket.send_text(
+                            json.dumps(
+                                {
+                                    "type": "ack",
+                                    "message_id": str(message["_id"]),
+                                    "causal_token": token,
+                                }
+                            )
+                        )
+                elif data["type"] in ("edit", "delete", "react", "unreact"):
+                    try:
+                        patch, changed = await apply_message_action(
+                            db, message_store, current_user, data
+                        )
+                    except HTTPException as e:
+                        await websocket.send_text(
+                            json.dumps(
+                                {"type": "error", "status": e.status_code, "detail": e.detail}
+                            )
+                        )
+                        continue
+                    if changed:
+                        await manager.broadcast(
+                            json.dumps(patch), f"chat_room_{data['chat_room_id']}"
+                        )
+                    else:
+                        await websocket.send_text(json.dumps(patch))
     except WebSocketDisconnect:
         print("Disconnected")
+    except asyncio.TimeoutError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
     except HTTPException as e:
         if e.status_code == status.HTTP_401_UNAUTHORIZED:
             print("Unauthorized")
             await websocket.close()
+        elif e.status_code == status.HTTP_403_FORBIDDEN:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
     finally:
         manager.disconnect(websocket, channel_id)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    server.run()
@@ -0,0 +1,482 @@
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from app.config import settings
+from app.partitions import PartitionedMessageStore, get_router
+
+
+def _as_naive_utc(value: datetime | None) -> datetime | None:
+    # Motor hands back naive UTC datetimes, so compare against the same kind
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class DocumentMessageStore:
+    """One document per message in the `messages` collection."""
+
+    async def create_indexes(self, db: AsyncIOMotorDatabase):
+        await db.messages.create_index(
+            [("chat_room_id", ASCENDING), ("created_at", DESCENDING)]
+        )
+        await db.messages.create_index([("chat_room_id", ASCENDING), ("sync_seq", ASCENDING)])
+        await db.messages.create_index([("chat_room_id", ASCENDING), ("seq", ASCENDING)])
+        await db.messages.create_index(
+            [("user_id", ASCENDING), ("client_message_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"client_message_id": {"$type": "string"}},
+        )
+
+    async def insert_message(self, db: AsyncIOMotorDatabase, message: dict, session=None) -> dict:
+        """Raises `DuplicateKeyError` if the client message id was already used."""
+        res = await db.messages.insert_one(message, session=session)
+        return await db.messages.find_one({"_id": res.inserted_id}, session=session)
+
+    async def find_by_client_message_id(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        user_id: ObjectId,
+        client_message_id: str,
+    ) -> dict | None:
+        return await db.messages.find_one(
+            {"user_id": user_id, "client_message_id": client_message_id}
+        )
+
+    async def find_message(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_id: ObjectId
+    ) -> dict | None:
+        return await db.messages.find_one({"_id": message_id, "chat_room_id": chat_room_id})
+
+    async def update_message(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        message_id: ObjectId,
+        update: dict,
+        match: dict | None = None,
+    ) -> dict | None:
+        """Apply `update` if the message also satisfies `match`, return it updated."""
+        return await db.messages.find_one_and_update(
+            {"_id": message_id, "chat_room_id": chat_room_id, **(match or {})},
+            update,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def insert_messages(self, db: AsyncIOMotorDatabase, messages: list[dict]) -> int:
+        # Unordered so one duplicate _id does not stop the rest of the batch
+        try:
+            res = await db.messages.insert_many(messages, ordered=False)
+            return len(res.inserted_ids)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            return e.details["nInserted"]
+
+    async def get_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        skip: int = 0,
+        limit: int = 25,
+        before: datetime | None = None,
+        session=None,
+    ) -> list[dict]:
+        match = {"chat_room_id": chat_room_id}
+        if before:
+            match["created_at"] = {"$lt": before}
+        return await db.messages.aggregate(
+            [
+                {"$match": match},  # Filter messages by chat room
+                {"$sort": {"created_at": -1}},  # Sort by timestamp in descending order
+                {"$skip": skip},  # Skip the first (page - 1) * page_size messages
+                {"$limit": limit},  # Limit the number of results to page_size
+            ],
+            session=session,
+        ).to_list(length=limit)
+
+    async def get_messages_since(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, since_seq: int, limit: int
+    ) -> list[dict]:
+        return await db.messages.find(
+            {"chat_room_id": chat_room_id, "sync_seq": {"$gt": since_seq}}
+        ).sort("sync_seq", 1).to_list(length=limit)
+
+    async def get_messages_by_seq(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        from_seq: int,
+        to_seq: int,
+        limit: int,
+        session=None,
+    ) -> list[dict]:
+        return await db.messages.find(
+            {"chat_room_id": chat_room_id, "seq": {"$gte": from_seq, "$lte": to_seq}},
+            session=session,
+        ).sort("seq", 1).to_list(length=limit)
+
+    async def count_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        before: datetime | None = None,
+        session=None,
+    ) -> int:
+        query = {"chat_room_id": chat_room_id}
+        if before:
+            query["created_at"] = {"$lt": before}
+        return await db.messages.count_documents(query, session=session)
+
+    async def iter_messages(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+        cursor = db.messages.find({"chat_room_id": chat_room_id}).sort("created_at", 1)
+        async for message in cursor.batch_size(1000):
+            yield message
+
+    async def iter_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        cursor = db.messages.find(
+            {"chat_room_id": chat_room_id, "created_at": {"$lt": cutoff}}
+        ).sort("created_at", 1)
+        async for message in cursor.batch_size(1000):
+            yield message
+
+    async def delete_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        await db.messages.delete_many(
+            {"chat_room_id": chat_room_id, "created_at": {"$lt": cutoff}}
+        )
+
+    async def delete_messages(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_ids: list[ObjectId]
+    ):
+        await db.messages.delete_many({"chat_room_id": chat_room_id, "_id": {"$in": message_ids}})
+
+
+class BucketMessageStore:
+    """Messages grouped per chat room into bounded `message_buckets` documents.
+
+    A bucket holds at most `bucket_size` messages spanning at most
+    `bucket_span` of time, so a page of history is read from one or two
+    documents and the index has one entry per bucket instead of per message.
+    """
+
+    def __init__(self, bucket_size: int = 200, bucket_span: timedelta = timedelta(days=1)):
+        self.bucket_size = bucket_size
+        self.bucket_span = bucket_span
+
+    async def create_indexes(self, db: AsyncIOMotorDatabase):
+        # Appends look up the open bucket, reads walk buckets newest first
+        await db.message_buckets.create_index(
+            [("chat_room_id", ASCENDING), ("count", ASCENDING), ("first_at", ASCENDING)]
+        )
+        await db.message_buckets.create_index(
+            [("chat_room_id", ASCENDING), ("last_at", DESCENDING)]
+        )
+        await db.message_buckets.create_index(
+            [("chat_room_id", ASCENDING), ("last_seq", ASCENDING)]
+        )
+        await db.message_buckets.create_index(
+            [("chat_room_id", ASCENDING), ("messages.seq", ASCENDING)]
+        )
+        # A unique index cannot see duplicates inside one bucket's array, so
+        # client message ids are claimed in a collection of their own.
+        await db.message_client_ids.create_index(
+            [("user_id", ASCENDING), ("client_message_id", ASCENDING)], unique=True
+        )
+
+    async def insert_message(self, db: AsyncIOMotorDatabase, message: dict, session=None) -> dict:
+        """Raises `DuplicateKeyError` if the client message id was already used."""
+        message = {"_id": ObjectId(), **message}
+        created_at = message["created_at"]
+        if message.get("client_message_id"):
+            await db.message_client_ids.insert_one(
+                {
+                    "user_id": message["user_id"],
+                    "client_message_id": message["client_message_id"],
+                    "chat_room_id": message["chat_room_id"],
+                    "message_id": message["_id"],
+                },
+                session=session,
+            )
+        try:
+            await db.message_buckets.update_one(
+                {
+                    "chat_room_id": message["chat_room_id"],
+                    "count": {"$lt": self.bucket_size},
+                    "first_at": {"$gt": created_at - self.bucket_span},
+                },
+                {
+                    "$push": {"messages": message},
+                    "$inc": {"count": 1},
+                    "$min": {"first_at": created_at},
+                    "$max": {"last_at": created_at, "last_seq": message.get("sync_seq", 0)},
+                },
+                upsert=True,
+                session=session,
+            )
+        except Exception:
+            # Release the claim so the client's retry is not mistaken for a duplicate
+            if message.get("client_message_id"):
+                await db.message_client_ids.delete_one(
+                    {"message_id": message["_id"]}, session=session
+                )
+            raise
+        return message
+
+    async def insert_messages(self, db: AsyncIOMotorDatabase, messages: list[dict]) -> int:
+        messages = sorted(messages, key=lambda message: message["created_at"])
+        by_chat_room = {}
+        for message in messages:
+            by_chat_room.setdefault(message["chat_room_id"], []).append(message)
+        inserted = 0
+        for chat_room_id, chat_room_messages in by_chat_room.items():
+            # Skip ids the room already has, like the unique _id does for documents
+            ids = [message["_id"] for message in chat_room_messages if "_id" in message]
+            existing = {
+                message["_id"]
+                async for bucket in db.message_buckets.find(
+                    {"chat_room_id": chat_room_id, "messages._id": {"$in": ids}},
+                    {"messages._id": 1},
+                )
+                for message in bucket["messages"]
+            }
+            chat_room_messages = [
+                message for message in chat_room_messages if message.get("_id") not in existing
+            ]
+            for i in range(0, len(chat_room_messages), self.bucket_size):
+                await self.insert_bucket(
+                    db, chat_room_id, chat_room_messages[i : i + self.bucket_size]
+                )
+            inserted += len(chat_room_messages)
+        return inserted
+
+    async def find_by_client_message_id(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        user_id: ObjectId,
+        client_message_id: str,
+    ) -> dict | None:
+        claim = await db.message_client_ids.find_one(
+            {"user_id": user_id, "client_message_id": client_message_id}
+        )
+        if not claim:
+            return None
+        # Retries arrive soon after the original, so look in the newest buckets first
+        bucket = await db.message_buckets.find_one(
+            {"chat_room_id": claim["chat_room_id"], "messages._id": claim["message_id"]},
+            {"messages": {"$elemMatch": {"_id": claim["message_id"]}}},
+            sort=[("last_at", -1)],
+        )
+        return bucket["messages"][0] if bucket else None
+
+    async def find_message(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_id: ObjectId
+    ) -> dict | None:
+        bucket = await db.message_buckets.find_one(
+            {"chat_room_id": chat_room_id, "messages._id": message_id},
+            {"messages": {"$elemMatch": {"_id": message_id}}},
+        )
+        return bucket["messages"][0] if bucket else None
+
+    async def update_message(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        message_id: ObjectId,
+        update: dict,
+        match: dict | None = None,
+    ) -> dict | None:
+        """Apply `update` if the message also satisfies `match`, return it updated."""
+        # Same update, aimed at the matched array element
+        bucket_update = {
+            operator: {f"messages.$.{field}": value for field, value in fields.items()}
+            for operator, fields in update.items()
+        }
+        sync_seq = update.get("$set", {}).get("sync_seq")
+        if sync_seq:
+            bucket_update["$max"] = {"last_seq": sync_seq}
+        bucket = await db.message_buckets.find_one_and_update(
+            {
+                "chat_room_id": chat_room_id,
+                "messages": {"$elemMatch": {"_id": message_id, **(match or {})}},
+            },
+            bucket_update,
+            projection={"messages": {"$elemMatch": {"_id": message_id}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["messages"][0] if bucket else None
+
+    async def get_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        skip: int = 0,
+        limit: int = 25,
+        before: datetime | None = None,
+        session=None,
+    ) -> list[dict]:
+        before = _as_naive_utc(before)
+        query = {"chat_room_id": chat_room_id}
+        if before:
+            query["first_at"] = {"$lt": before}
+        needed = skip + limit
+        messages = []
+        cursor = db.message_buckets.find(query, session=session).sort("last_at", -1).batch_size(4)
+        async for bucket in cursor:
+            # Buckets come newest first, so once enough messages are collected
+            # a bucket ending before the oldest of them cannot contribute.
+            if len(messages) >= needed and bucket["last_at"] < messages[needed - 1]["created_at"]:
+                break
+            messages.extend(
+                message
+                for message in bucket["messages"]
+                if before is None or message["created_at"] < before
+            )
+            messages.sort(key=lambda message: message["created_at"], reverse=True)
+        return messages[skip:needed]
+
+    async def get_messages_since(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, since_seq: int, limit: int
+    ) -> list[dict]:
+        messages = []
+        cursor = db.message_buckets.find(
+            {"chat_room_id": chat_room_id, "last_seq": {"$gt": since_seq}}
+        )
+        async for bucket in cursor:
+            messages.extend(
+                message
+                for message in bucket["messages"]
+                if message.get("sync_seq", 0) > since_seq
+            )
+        messages.sort(key=lambda message: message["sync_seq"])
+        return messages[:limit]
+
+    async def get_messages_by_seq(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        from_seq: int,
+        to_seq: int,
+        limit: int,
+        session=None,
+    ) -> list[dict]:
+        in_range = {"$gte": from_seq, "$lte": to_seq}
+        messages = []
+        cursor = db.message_buckets.find(
+            {"chat_room_id": chat_room_id, "messages": {"$elemMatch": {"seq": in_range}}},
+            session=session,
+        )
+        async for bucket in cursor:
+            messages.extend(
+                message
+                for message in bucket["messages"]
+                if from_seq <= message.get("seq", 0) <= to_seq
+            )
+        messages.sort(key=lambda message: message["seq"])
+        return messages[:limit]
+
+    async def count_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        before: datetime | None = None,
+        session=None,
+    ) -> int:
+        pipeline = [{"$match": {"chat_room_id": chat_room_id}}]
+        if before:
+            pipeline += [
+                {"$match": {"first_at": {"$lt": before}}},
+                {"$unwind": "$messages"},
+                {"$match": {"messages.created_at": {"$lt": before}}},
+                {"$count": "count"},
+            ]
+        else:
+            pipeline.append({"$group": {"_id": None, "count": {"$sum": "$count"}}})
+        result = await db.message_buckets.aggregate(pipeline, session=session).to_list(length=1)
+        return result[0]["count"] if result else 0
+
+    async def iter_messages(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+        cursor = db.message_buckets.find({"chat_room_id": chat_room_id}).sort("last_at", 1)
+        async for bucket in cursor.batch_size(4):
+            for message in sorted(bucket["messages"], key=lambda m: m["created_at"]):
+                yield message
+
+    async def iter_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        # Only whole buckets are handed out, so the hot range always starts at
+        # a bucket boundary.
+        cursor = db.message_buckets.find(
+            {"chat_room_id": chat_room_id, "last_at": {"$lt": cutoff}}
+        ).sort("last_at", 1)
+        async for bucket in cursor.batch_size(4):
+            for message in sorted(bucket["messages"], key=lambda m: m["created_at"]):
+                yield message
+
+    async def delete_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        await db.message_buckets.delete_many(
+            {"chat_room_id": chat_room_id, "last_at": {"$lt": cutoff}}
+        )
+
+    async def delete_messages(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_ids: list[ObjectId]
+    ):
+        ids = set(message_ids)
+        query = {"chat_room_id": chat_room_id, "messages._id": {"$in": message_ids}}
+        while bucket := await db.message_buckets.find_one(query):
+            remaining = [message for message in bucket["messages"] if message["_id"] not in ids]
+            # Matching the count retries the bucket if a message was appended meanwhile
+            if remaining:
+                await db.message_buckets.update_one(
+                    {"_id": bucket["_id"], "count": bucket["count"]},
+                    {"$set": {"messages": remaining, "count": len(remaining)}},
+                )
+            else:
+                await db.message_buckets.delete_one(
+                    {"_id": bucket["_id"], "count": bucket["count"]}
+                )
+
+    async def insert_bucket(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, messages: list[dict]):
+        await db.message_buckets.insert_one(
+            {
+                "chat_room_id": chat_room_id,
+                "count": len(messages),
+                "first_at": messages[0]["created_at"],
+                "last_at": messages[-1]["created_at"],
+                "last_seq": max(message.get("sync_seq", 0) for message in messages),
+                "messages": messages,
+            }
+        )
+
+
+@lru_cache
+def get_message_stores() -> dict[str, DocumentMessageStore | BucketMessageStore]:
+    return {
+        "documents": DocumentMessageStore(),
+        "buckets": BucketMessageStore(
+            bucket_size=settings.message_bucket_size,
+            bucket_span=timedelta(seconds=settings.message_bucket_span_seconds),
+        ),
+    }
+
+
+@lru_cache
+def get_partitioned_message_store(name: str) -> PartitionedMessageStore:
+    return PartitionedMessageStore(get_message_stores()[name], get_router())
+
+
+def get_message_store() -> DocumentMessageStore | BucketMessageStore | PartitionedMessageStore:
+    if get_router().partitions:
+        return get_partitioned_message_store(settings.message_storage)
+    return get_message_stores()[settings.message_storage]
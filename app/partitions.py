@@ -0,0 +1,442 @@
+"""Spread message storage over several Mongo databases by chat room.
+
+Each chat room's messages live in exactly one partition, recorded in
+`chat_room_partitions` (in the main database). A room without a record is
+pinned to a stable hash of its id the first time it is used, so adding
+partitions later does not move existing rooms. Rooms from before pinning
+are only placed by the hash, and `check_layout` refuses to start on a
+changed partition list while any remain; `pin_chat_rooms` pins them.
+`PartitionedMessageStore` wraps a message store so every read and write is
+sent to the room's partition; everything else stays in the main database.
+
+A room is moved online by `move_chat_room`: new writes go to the target at
+once while reads merge both partitions until the copy has caught up.
+"""
+import asyncio
+import hashlib
+import heapq
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.cache import TTLCache
+from app.config import settings
+from app.helpers import next_sync_seq
+
+
+class PartitionRouter:
+    """Maps chat rooms to one of `partitions`.
+
+    With no partitions configured every room is stored in the database the
+    caller passes in, exactly as without a router.
+    """
+
+    def __init__(
+        self,
+        partitions: list[AsyncIOMotorDatabase],
+        cache_ttl: float = 5,
+        uris: list[str] | None = None,
+    ):
+        self.partitions = partitions
+        self.cache_ttl = cache_ttl
+        self.uris = uris or []
+        self.assignments = TTLCache(max_size=100_000, ttl=cache_ttl)
+
+    def hash_partition(self, chat_room_id: ObjectId) -> int:
+        # Not hash(), which is salted per process
+        digest = hashlib.md5(ObjectId(chat_room_id).binary).digest()
+        return int.from_bytes(digest[:8], "big") % len(self.partitions)
+
+    async def get_assignment(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId) -> dict:
+        assignment = self.assignments.get(chat_room_id)
+        if assignment is None:
+            assignment = await db.chat_room_partitions.find_one(
+                {"_id": chat_room_id}
+            ) or await self.pin(db, chat_room_id)
+            self.assignments.set(chat_room_id, assignment)
+        return assignment
+
+    async def pin(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId) -> dict:
+        # Recorded so a later change of the partition list leaves the room be
+        try:
+            return await db.chat_room_partitions.find_one_and_update(
+                {"_id": chat_room_id},
+                {"$setOnInsert": {"partition": self.hash_partition(chat_room_id)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return await db.chat_room_partitions.find_one({"_id": chat_room_id})
+
+    async def get_databases(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId
+    ) -> list[AsyncIOMotorDatabase]:
+        """The room's partition, followed by the one it is moving from, if any."""
+        if not self.partitions:
+            return [db]
+        assignment = await self.get_assignment(db, chat_room_id)
+        indexes = [assignment["partition"]]
+        if assignment.get("moving_from") is not None:
+            indexes.append(assignment["moving_from"])
+        # Reads keep the caller's preference, e.g. secondaries for history
+        return [
+            with_read_preference(self.partitions[i], db.read_preference) for i in indexes
+        ]
+
+    async def get_database(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+        return (await self.get_databases(db, chat_room_id))[0]
+
+
+def with_read_preference(db: AsyncIOMotorDatabase, read_preference):
+    if db.read_preference == read_preference:
+        return db
+    return db.with_options(read_preference=read_preference)
+
+
+def session_for(db: AsyncIOMotorDatabase, session):
+    # A session only works on the client that started it
+    return session if session is not None and session.client is db.client else None
+
+
+def unique_by_id(messages):
+    seen = set()
+    for message in messages:
+        if message["_id"] not in seen:
+            seen.add(message["_id"])
+            yield message
+
+
+class PartitionedMessageStore:
+    """Routes each call of the wrapped store to the chat room's partition.
+
+    `db` is still the main database, it holds the partition assignments.
+    """
+
+    def __init__(self, store, router: PartitionRouter):
+        self.store = store
+        self.router = router
+
+    async def create_indexes(self, db: AsyncIOMotorDatabase):
+        for partition in self.router.partitions:
+            await self.store.create_indexes(partition)
+
+    async def insert_message(self, db: AsyncIOMotorDatabase, message: dict, session=None) -> dict:
+        partition = await self.router.get_database(db, message["chat_room_id"])
+        return await self.store.insert_message(partition, message, session_for(partition, session))
+
+    async def insert_messages(self, db: AsyncIOMotorDatabase, messages: list[dict]) -> int:
+        by_chat_room = {}
+        for message in messages:
+            by_chat_room.setdefault(message["chat_room_id"], []).append(message)
+        inserted = 0
+        for chat_room_id, chat_room_messages in by_chat_room.items():
+            partition = await self.router.get_database(db, chat_room_id)
+            inserted += await self.store.insert_messages(partition, chat_room_messages)
+        return inserted
+
+    async def find_by_client_message_id(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        user_id: ObjectId,
+        client_message_id: str,
+    ) -> dict | None:
+        for partition in await self.router.get_databases(db, chat_room_id):
+            message = await self.store.find_by_client_message_id(
+                partition, chat_room_id, user_id, client_message_id
+            )
+            if message:
+                return message
+        return None
+
+    async def find_message(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_id: ObjectId
+    ) -> dict | None:
+        for partition in await self.router.get_databases(db, chat_room_id):
+            message = await self.store.find_message(partition, chat_room_id, message_id)
+            if message:
+                return message
+        return None
+
+    async def update_message(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        message_id: ObjectId,
+        update: dict,
+        match: dict | None = None,
+    ) -> dict | None:
+        # Mid-move the copy in the target wins, the source copy is dropped later
+        for partition in await self.router.get_databases(db, chat_room_id):
+            message = await self.store.update_message(
+                partition, chat_room_id, message_id, update, match
+            )
+            if message:
+                return message
+        return None
+
+    async def get_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        skip: int = 0,
+        limit: int = 25,
+        before: datetime | None = None,
+        session=None,
+    ) -> list[dict]:
+        partitions = await self.router.get_databases(db, chat_room_id)
+        if len(partitions) == 1:
+            return await self.store.get_messages(
+                partitions[0], chat_room_id, skip, limit, before, session_for(partitions[0], session)
+            )
+        # Mid-move: page over both partitions, which overlap where already copied
+        pages = await asyncio.gather(
+            *(
+                self.store.get_messages(partition, chat_room_id, 0, skip + limit, before)
+                for partition in partitions
+            )
+        )
+        merged = heapq.merge(*pages, key=lambda message: message["created_at"], reverse=True)
+        return list(unique_by_id(merged))[skip : skip + limit]
+
+    async def get_messages_since(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, since_seq: int, limit: int
+    ) -> list[dict]:
+        partitions = await self.router.get_databases(db, chat_room_id)
+        pages = await asyncio.gather(
+            *(
+                self.store.get_messages_since(partition, chat_room_id, since_seq, limit)
+                for partition in partitions
+            )
+        )
+        merged = heapq.merge(*pages, key=lambda message: message.get("sync_seq", 0))
+        return list(unique_by_id(merged))[:limit]
+
+    async def get_messages_by_seq(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        from_seq: int,
+        to_seq: int,
+        limit: int,
+        session=None,
+    ) -> list[dict]:
+        partitions = await self.router.get_databases(db, chat_room_id)
+        if len(partitions) == 1:
+            return await self.store.get_messages_by_seq(
+                partitions[0], chat_room_id, from_seq, to_seq, limit, session_for(partitions[0], session)
+            )
+        pages = await asyncio.gather(
+            *(
+                self.store.get_messages_by_seq(partition, chat_room_id, from_seq, to_seq, limit)
+                for partition in partitions
+            )
+        )
+        merged = heapq.merge(*pages, key=lambda message: message["seq"])
+        return list(unique_by_id(merged))[:limit]
+
+    async def count_messages(
+        self,
+        db: AsyncIOMotorDatabase,
+        chat_room_id: ObjectId,
+        before: datetime | None = None,
+        session=None,
+    ) -> int:
+        # Mid-move the partitions overlap, the larger count is the closer one
+        return max(
+            [
+                await self.store.count_messages(
+                    partition, chat_room_id, before, session_for(partition, session)
+                )
+                for partition in await self.router.get_databases(db, chat_room_id)
+            ]
+        )
+
+    async def iter_messages(self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+        seen = set()
+        for partition in reversed(await self.router.get_databases(db, chat_room_id)):
+            async for message in self.store.iter_messages(partition, chat_room_id):
+                if message["_id"] not in seen:
+                    seen.add(message["_id"])
+                    yield message
+
+    async def iter_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        seen = set()
+        for partition in reversed(await self.router.get_databases(db, chat_room_id)):
+            async for message in self.store.iter_messages_before(partition, chat_room_id, cutoff):
+                if message["_id"] not in seen:
+                    seen.add(message["_id"])
+                    yield message
+
+    async def delete_messages_before(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, cutoff: datetime
+    ):
+        for partition in await self.router.get_databases(db, chat_room_id):
+            await self.store.delete_messages_before(partition, chat_room_id, cutoff)
+
+    async def delete_messages(
+        self, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, message_ids: list[ObjectId]
+    ):
+        for partition in await self.router.get_databases(db, chat_room_id):
+            await self.store.delete_messages(partition, chat_room_id, message_ids)
+
+
+def layout_fingerprint(uris: list[str]) -> str:
+    # Credentials may be rotated without moving any data
+    return hashlib.sha256(
+        json.dumps([re.sub(r"//[^@/]*@", "//", uri) for uri in uris]).encode()
+    ).hexdigest()
+
+
+async def iter_unpinned_chat_room_ids(db: AsyncIOMotorDatabase, batch_size: int = 1000):
+    async def unpinned(batch: list[ObjectId]) -> list[ObjectId]:
+        pinned = set(await db.chat_room_partitions.distinct("_id", {"_id": {"$in": batch}}))
+        return [chat_room_id for chat_room_id in batch if chat_room_id not in pinned]
+
+    batch = []
+    async for chat_room in db.chat_rooms.find({}, {"_id": 1}):
+        batch.append(chat_room["_id"])
+        if len(batch) >= batch_size:
+            for chat_room_id in await unpinned(batch):
+                yield chat_room_id
+            batch = []
+    for chat_room_id in await unpinned(batch) if batch else []:
+        yield chat_room_id
+
+
+async def check_layout(db: AsyncIOMotorDatabase, router: PartitionRouter):
+    """Record the partition list, refusing a changed one while rooms are
+    still placed by hash alone: their history would silently vanish."""
+    fingerprint = layout_fingerprint(router.uris)
+    layout = await db.partition_layout.find_one({"_id": "message_partitions"})
+    if layout and layout["fingerprint"] != fingerprint:
+        async for chat_room_id in iter_unpinned_chat_room_ids(db):
+            raise RuntimeError(
+                f"MESSAGE_PARTITIONS changed while chat room {chat_room_id} is not "
+                "pinned to a partition, its messages would no longer be found. "
+                "Restore the previous MESSAGE_PARTITIONS and run "
+                "`python -m app.scripts.pin_partitions` first."
+            )
+    await db.partition_layout.update_one(
+        {"_id": "message_partitions"}, {"$set": {"fingerprint": fingerprint}}, upsert=True
+    )
+
+
+async def pin_chat_rooms(db: AsyncIOMotorDatabase, router: PartitionRouter) -> int:
+    """Pin every room that is only placed by hash, return how many."""
+    if not router.partitions:
+        return 0  # Every room is in the main database, there is nothing to pin
+    pinned = 0
+    async for chat_room_id in iter_unpinned_chat_room_ids(db):
+        await router.pin(db, chat_room_id)
+        pinned += 1
+    return pinned
+
+
+async def copy_messages(store, source, target, chat_room_id: ObjectId):
+    """Copy all the room's messages, the stores skip ids already present."""
+    batch = []
+    async for message in store.iter_messages(source, chat_room_id):
+        batch.append(message)
+        if len(batch) >= settings.message_import_batch_size:
+            await store.insert_messages(target, batch)
+            batch = []
+    if batch:
+        await store.insert_messages(target, batch)
+
+
+async def copy_changed_messages(store, source, target, chat_room_id: ObjectId, since_seq: int):
+    """Bring the target up to date with messages written or edited on the
+    source after `since_seq`: missing ones are inserted, and copies older
+    than the source's are overwritten unless the target changed meanwhile."""
+    batch = []
+    async for message in iter_messages_since(store, source, chat_room_id, since_seq):
+        copy = await store.find_message(target, chat_room_id, message["_id"])
+        if copy is None:
+            batch.append(message)
+        elif copy.get("sync_seq", 0) < message.get("sync_seq", 0):
+            fields = {key: value for key, value in message.items() if key != "_id"}
+            await store.update_message(
+                target,
+                chat_room_id,
+                message["_id"],
+                {"$set": fields},
+                match={"sync_seq": copy.get("sync_seq")},
+            )
+    if batch:
+        await store.insert_messages(target, batch)
+
+
+async def iter_messages_since(store, db, chat_room_id: ObjectId, since_seq: int):
+    while True:
+        messages = await store.get_messages_since(
+            db, chat_room_id, since_seq, settings.message_import_batch_size
+        )
+        for message in messages:
+            yield message
+        if len(messages) < settings.message_import_batch_size:
+            return
+        since_seq = messages[-1]["sync_seq"]
+
+
+async def move_chat_room(
+    db: AsyncIOMotorDatabase,
+    partitioned_store: PartitionedMessageStore,
+    chat_room_id: ObjectId,
+    target: int,
+):
+    """Move a room's messages to partition `target` without stopping writes.
+
+    Other workers learn about the move within the router's cache TTL, so
+    each step waits that long before relying on it. Until then they may
+    still insert into or edit the source, so the final pass re-copies every
+    message changed since the move started, from a settle window earlier to
+    catch writes stamped out of order.
+    """
+    router, store = partitioned_store.router, partitioned_store.store
+    source = (await router.get_assignment(db, chat_room_id))["partition"]
+    if source == target:
+        return
+    started_seq = next_sync_seq()
+    # 1. New writes go to the target, reads merge both partitions
+    await db.chat_room_partitions.update_one(
+        {"_id": chat_room_id},
+        {"$set": {"partition": target, "moving_from": source}},
+        upsert=True,
+    )
+    router.assignments.pop(chat_room_id)
+    source_db, target_db = router.partitions[source], router.partitions[target]
+    await copy_messages(store, source_db, target_db, chat_room_id)
+    # 2. Catch up with writes and edits by workers that still routed to the source
+    await asyncio.sleep(router.cache_ttl)
+    settle = int(settings.sync_settle_seconds * 1_000_000)
+    await copy_changed_messages(
+        store, source_db, target_db, chat_room_id, max(started_seq - settle, 0)
+    )
+    # 3. Reads switch to the target alone, then the source copy is dropped
+    await db.chat_room_partitions.update_one(
+        {"_id": chat_room_id}, {"$unset": {"moving_from": ""}}
+    )
+    router.assignments.pop(chat_room_id)
+    await asyncio.sleep(router.cache_ttl)
+    await store.delete_messages_before(source_db, chat_room_id, datetime.max)
+
+
+@lru_cache
+def get_router() -> PartitionRouter:
+    return PartitionRouter(
+        [
+            AsyncIOMotorClient(uri).get_default_database()
+            for uri in settings.message_partitions
+        ],
+        cache_ttl=settings.partition_cache_ttl_seconds,
+        uris=settings.message_partitions,
+    )
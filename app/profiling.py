@@ -0,0 +1,336 @@
+"""Opt-in diagnostics: request profiles, slow Mongo commands and loop lag.
+
+Profiles are collected by a stdlib sampler thread that snapshots the event
+loop thread's stack and writes them in the folded format read by
+flamegraph.pl and speedscope. Because the loop interleaves requests, a
+profile also contains samples of whatever else was running at the time.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from fastapi import Header, HTTPException, status
+from pymongo import monitoring
+
+from app.cache import TTLCache
+from app.config import settings
+
+logger = logging.getLogger("app.profiling")
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled every `interval` seconds."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+class ProfilingMiddleware:
+    """Profiles a sampled fraction of HTTP requests, plus any carrying
+    `X-Profile: <profile_token>`, into `profile_dir`.
+
+    Only one request is profiled at a time, others pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.active = False
+
+    def should_profile(self, scope) -> bool:
+        if scope["type"] != "http" or self.active:
+            return False
+        if settings.profile_token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile" and hmac.compare_digest(
+                    value, settings.profile_token.encode()
+                ):
+                    return True
+        return random.random() < settings.profile_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if not self.should_profile(scope):
+            return await self.app(scope, receive, send)
+        self.active = True
+        started = time.perf_counter()
+        try:
+            with StackSampler(
+                threading.get_ident(), settings.profile_interval_seconds
+            ) as sampler:
+                await self.app(scope, receive, send)
+        finally:
+            self.active = False
+        elapsed = time.perf_counter() - started
+        path = write_profile(scope["method"], scope["path"], sampler.folded())
+        logger.info(
+            json.dumps(
+                {
+                    "event": "profile",
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "samples": sum(sampler.stacks.values()),
+                    "file": path,
+                }
+            )
+        )
+
+
+def require_profile_token(x_profile: str | None = Header(None)):
+    """Guards diagnostics that show other users' activity. Disabled without
+    a `profile_token`."""
+    if not settings.profile_token or not hmac.compare_digest(
+        x_profile or "", settings.profile_token
+    ):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+
+def write_profile(method: str, path: str, folded: str) -> str:
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    name = "-".join(
+        [
+            datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%f"),
+            method,
+            path.strip("/").replace("/", "_") or "root",
+        ]
+    )
+    file_path = os.path.join(settings.profile_dir, f"{name}.folded")
+    with open(file_path, "w") as f:
+        f.write(folded)
+    return file_path
+
+
+def iter_plan_stages(plan: dict):
+    """Every stage of a winning plan, top down."""
+    plan = plan.get("queryPlan", plan)  # Slot-based plans nest the tree
+    stack = [plan] if plan else []
+    while stack:
+        stage = stack.pop()
+        yield stage
+        if stage.get("inputStage"):
+            stack.append(stage["inputStage"])
+        stack.extend(reversed(stage.get("inputStages") or []))
+
+
+def summarize_plan(plan: dict) -> str:
+    """Collapse a winning plan into e.g. 'LIMIT > FETCH > IXSCAN {chat_room_id: 1}'."""
+    stages = []
+    for stage in iter_plan_stages(plan):
+        name = stage.get("stage", "?")
+        if "keyPattern" in stage:
+            name += " " + json.dumps(stage["keyPattern"], default=str)
+        stages.append(name)
+    return " > ".join(stages)
+
+
+def iter_explained_queries(explain: dict):
+    """(queryPlanner, executionStats) of each query in an explain result.
+
+    Aggregations pushed into the query layer report at the top level, older
+    servers nest them under a `$cursor` stage, sharded ones per shard.
+    """
+    if "queryPlanner" in explain:
+        yield explain["queryPlanner"], explain.get("executionStats", {})
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            yield from iter_explained_queries(stage["$cursor"])
+    for shard in explain.get("shards", {}).values():
+        yield from iter_explained_queries(shard)
+
+
+def plan_problems(explain: dict, max_docs_examined_ratio: float) -> list[str]:
+    """What an `executionStats` explain shows would not scale: collection
+    scans, blocking sorts and examining many more documents than returned."""
+    problems = []
+    for query_planner, execution_stats in iter_explained_queries(explain):
+        winning_plan = query_planner.get("winningPlan", {})
+        stages = [stage.get("stage") for stage in iter_plan_stages(winning_plan)]
+        if "COLLSCAN" in stages:
+            problems.append("collection scan")
+        if "SORT" in stages:
+            problems.append("in-memory sort")
+        examined = execution_stats.get("totalDocsExamined", 0)
+        returned = max(execution_stats.get("nReturned", 0), 1)
+        if examined / returned > max_docs_examined_ratio:
+            problems.append(f"examined {examined} documents for {execution_stats.get('nReturned', 0)} returned")
+    if any("$sort" in stage for stage in explain.get("stages", [])):
+        problems.append("in-memory sort")
+    # Several queries or stages can show the same problem, report it once
+    return list(dict.fromkeys(problems))
+
+
+async def explain_command(db, command: dict, verbosity: str = "queryPlanner") -> dict:
+    command = {
+        key: value
+        for key, value in command.items()
+        if key not in ("lsid", "$db", "$clusterTime", "txnNumber", "$readPreference")
+    }
+    return await db.command({"explain": command, "verbosity": verbosity})
+
+
+class SlowOperationListener(monitoring.CommandListener):
+    """Logs Mongo commands slower than `threshold_ms`, with an explain summary.
+
+    Driver events arrive on driver threads, so explains are scheduled back on
+    the event loop once `attach` has been called. Each command shape is
+    explained at most once per `explain_ttl` seconds.
+    """
+
+    # Commands that explain can describe
+    explainable = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+
+    def __init__(self, threshold_ms: float, explain_ttl: float = 600):
+        self.threshold_ms = threshold_ms
+        self.commands: dict[int, dict] = {}
+        self.explained = TTLCache(max_size=1000, ttl=explain_ttl)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.client = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop, client):
+        self.loop = loop
+        self.client = client
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in self.explainable:
+            self.commands[event.request_id] = event.command
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.finished(event)
+
+    def finished(self, event):
+        command = self.commands.pop(event.request_id, None)
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms:
+            return
+        collection = command.get(event.command_name) if command else None
+        record = {
+            "event": "slow_op",
+            "command": event.command_name,
+            "database": event.database_name,
+            "collection": collection if isinstance(collection, str) else None,
+            "duration_ms": round(duration_ms, 2),
+            "filter": query_filter(command) if command else None,
+        }
+        if command and self.loop and self.client:
+            shape = (
+                event.database_name,
+                event.command_name,
+                record["collection"],
+                shape_of(record["filter"]),
+            )
+            if not self.explained.get(shape):
+                self.explained.set(shape, True)
+                self.loop.call_soon_threadsafe(
+                    self.loop.create_task, self.explain(event.database_name, command, record)
+                )
+                return
+        logger.warning(json.dumps(record, default=str))
+
+    async def explain(self, database_name: str, command: dict, record: dict):
+        try:
+            result = await explain_command(self.client[database_name], command)
+            record["plan"] = summarize_plan(
+                result.get("queryPlanner", {}).get("winningPlan", {})
+            )
+        except Exception as e:
+            record["plan_error"] = str(e)
+        logger.warning(json.dumps(record, default=str))
+
+
+def query_filter(command: dict):
+    if "filter" in command or "query" in command:
+        return command.get("filter", command.get("query"))
+    if "pipeline" in command:
+        return command["pipeline"][:1]
+    for key in ("updates", "deletes"):
+        if command.get(key):
+            return command[key][0].get("q")
+    return None
+
+
+def shape_of(value):
+    """The filter with its values blanked, so similar queries share a shape."""
+    if isinstance(value, dict):
+        return tuple((key, shape_of(item)) for key, item in sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(shape_of(item) for item in value[:1])
+    return None
+
+
+@lru_cache
+def get_slow_op_listener() -> SlowOperationListener:
+    return SlowOperationListener(settings.slow_op_threshold_ms)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a timer set for `interval`."""
+
+    def __init__(self, interval: float, warn_after: float):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.last = 0.0
+        self.max = 0.0
+        self.samples = 0
+
+    def record(self, lag: float):
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.samples += 1
+        if lag >= self.warn_after:
+            logger.warning(json.dumps({"event": "loop_lag", "lag_ms": round(lag * 1000, 2)}))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - started - self.interval))
+
+    def stats(self) -> dict:
+        return {
+            "last_ms": round(self.last * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+            "samples": self.samples,
+        }
+
+
+@lru_cache
+def get_loop_lag_monitor() -> LoopLagMonitor:
+    return LoopLagMonitor(settings.loop_lag_interval_seconds, settings.loop_lag_warn_seconds)
@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from fastapi import HTTPException, status
+
+from app.config import settings
+
+
+class RateLimiter:
+    """Token buckets keyed by an arbitrary string, kept in process memory.
+
+    `hit` never awaits, so on the event loop each check-and-take is atomic
+    without locks. Only the `max_keys` most recently used buckets are kept.
+    """
+
+    def __init__(
+        self, rate: float, burst: int, max_keys: int = 100_000, clock=time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def hit(self, key: str) -> float:
+        """Take a token for `key`; return 0 if allowed, else seconds to wait."""
+        now = self.clock()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return retry_after
+
+    def peek(self, key: str) -> float:
+        """Like `hit`, but leaves the token in place."""
+        now = self.clock()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def reset(self):
+        self.buckets.clear()
+
+
+@lru_cache
+def get_limiters() -> dict[str, RateLimiter]:
+    return {
+        "user_message": RateLimiter(
+            settings.message_rate_per_user, settings.message_burst_per_user
+        ),
+        "room_message": RateLimiter(
+            settings.message_rate_per_room, settings.message_burst_per_room
+        ),
+        "user_login": RateLimiter(
+            settings.login_rate_per_user, settings.login_burst_per_user
+        ),
+        "host_login": RateLimiter(
+            settings.login_rate_per_host, settings.login_burst_per_host
+        ),
+    }
+
+
+def too_many_requests(retry_after: float, detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, round(retry_after)))},
+    )
+
+
+def check_message_rate(user_id, chat_room_id):
+    limiters = get_limiters()
+    # Both are checked before either is charged, a send refused by the room
+    # limit does not cost the sender
+    retry_after = limiters["user_message"].peek(str(user_id)) or limiters[
+        "room_message"
+    ].peek(str(chat_room_id))
+    if retry_after:
+        raise too_many_requests(retry_after, "Too many messages")
+    limiters["user_message"].hit(str(user_id))
+    limiters["room_message"].hit(str(chat_room_id))
+
+
+def login_key(username: str, client_host: str | None) -> str:
+    # Per host, so failures sent from elsewhere can't lock the owner out
+    return f"{username}|{client_host}"
+
+
+def check_login_rate(username: str, client_host: str | None):
+    limiters = get_limiters()
+    retry_after = limiters["user_login"].peek(
+        login_key(username, client_host)
+    ) or limiters["host_login"].peek(str(client_host))
+    if retry_after:
+        raise too_many_requests(retry_after, "Too many login attempts")
+
+
+def record_login_failure(username: str, client_host: str | None):
+    limiters = get_limiters()
+    limiters["user_login"].hit(login_key(username, client_host))
+    limiters["host_login"].hit(str(client_host))
@@ -0,0 +1,86 @@
+"""Read-replica routing for read-heavy endpoints.
+
+Routes opt in by depending on `get_secondary_db` (or `get_secondary_fs`) and
+`get_read_session`. With `read_from_secondaries` off both fall back to the
+primary and no session, which is also what a standalone mongod needs.
+
+Reads stay causally consistent with a client's own writes: a write made in
+a session returns its operation time as `X-Causal-Token`, and a read that
+sends the token back waits until the secondary has caught up to it. Sends
+over the websocket get the token in an `ack` frame instead.
+Secondaries lagging more than `read_max_staleness_seconds` are skipped in
+favour of the primary.
+"""
+from contextlib import asynccontextmanager
+
+from bson import Timestamp
+from fastapi import Depends, HTTPException, Request, Response
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo.read_preferences import SecondaryPreferred
+
+from app.config import settings
+from app.database import get_db
+
+CAUSAL_TOKEN_HEADER = "X-Causal-Token"
+
+
+async def get_secondary_db(db=Depends(get_db)) -> AsyncIOMotorDatabase:
+    if not settings.read_from_secondaries:
+        return db
+    # Falls back to the primary when no secondary is within the staleness bound
+    return db.with_options(
+        read_preference=SecondaryPreferred(max_staleness=settings.read_max_staleness_seconds)
+    )
+
+
+async def get_secondary_fs(db=Depends(get_secondary_db)) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db)
+
+
+def encode_causal_token(operation_time: Timestamp) -> str:
+    return f"{operation_time.time}.{operation_time.inc}"
+
+
+def decode_causal_token(token: str) -> Timestamp:
+    try:
+        time, inc = token.split(".")
+        return Timestamp(int(time), int(inc))
+    except (ValueError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid causal token")
+
+
+async def get_read_session(request: Request, db=Depends(get_db)):
+    if not settings.read_from_secondaries:
+        yield None
+        return
+    async with await db.client.start_session(causal_consistency=True) as session:
+        token = request.headers.get(CAUSAL_TOKEN_HEADER)
+        if token:
+            session.advance_operation_time(decode_causal_token(token))
+        yield session
+
+
+@asynccontextmanager
+async def write_session(db: AsyncIOMotorDatabase):
+    if not settings.read_from_secondaries:
+        yield None
+        return
+    async with await db.client.start_session(causal_consistency=True) as session:
+        yield session
+
+
+async def get_write_session(db=Depends(get_db)):
+    async with write_session(db) as session:
+        yield session
+
+
+def causal_token(session) -> str | None:
+    if session is None or session.operation_time is None:
+        return None
+    return encode_causal_token(session.operation_time)
+
+
+def set_causal_token(response: Response, session):
+    token = causal_token(session)
+    if token:
+        response.headers[CAUSAL_TOKEN_HEADER] = token
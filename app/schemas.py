@@ -45,10 +45,31 @@ class UserDisplayResponse(BaseModel):
     display_name: str
 
 
+class UserSummaryResponse(BaseModel):
+    id: str = Field(..., alias="_id")
+    display_name: str
+    avatar_file_id: str | None = None
+
+    @field_validator("id", "avatar_file_id", mode="before")
+    def validate_object_id(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)  # Convert to string if it's an ObjectId
+        return value
+
+    @pydantic.computed_field
+    @property
+    def avatar_url(self) -> str:
+        return utils.get_avatar_url(self.avatar_file_id, self.display_name)
+
+
 class UsersListResponse(BaseModel):
     users: list[UserResponse]
 
 
+class UserSummariesListResponse(BaseModel):
+    users: list[UserSummaryResponse]
+
+
 class ChatRoomTypeEnum(str, Enum):
     DIRECT = "direct"
     GROUP = "group"
@@ -58,12 +79,25 @@ class DirectChatRoomCreate(BaseModel):
     user_ids: list[str] = Field(..., min_length=2, max_length=2)
 
 
+class GroupChatRoomCreate(BaseModel):
+    name: str = Field(..., min_length=1, max_length=100)
+    user_ids: list[str] = Field(default_factory=list, max_length=500)
+    # Anyone may join a public room, others only on a member's invite
+    public: bool = False
+
+
+class ChatRoomInviteCreate(BaseModel):
+    user_id: str
+
+
 class ChatRoomResponse(BaseModel):
     id: str = Field(..., alias="_id")
     name: str
     avatar_url: str
     type: ChatRoomTypeEnum
-    user_ids: list[str]
+    user_ids: list[str] = []
+    member_count: int | None = None
+    public: bool = False
 
     @field_validator("id", mode="before")
     def validate_object_id(cls, value):
@@ -86,10 +120,70 @@ class ChatRoomsListResponse(BaseModel):
     chat_rooms: list[ChatRoomResponse]
 
 
+class ChatRoomMemberResponse(BaseModel):
+    user_id: str
+    display_name: str
+    avatar_url: str
+    joined_at: datetime
+
+    @field_validator("user_id", mode="before")
+    def validate_object_id(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)  # Convert to string if it's an ObjectId
+        return value
+
+
+class ChatRoomMembersListResponse(BaseModel):
+    members: list[ChatRoomMemberResponse]
+
+
+class UploadSessionCreate(BaseModel):
+    chat_room_id: str
+    filename: str = Field(..., min_length=1, max_length=255)
+    content_type: str = "application/octet-stream"
+    length: int = Field(..., gt=0)
+
+
+class UploadSessionResponse(BaseModel):
+    id: str = Field(..., alias="_id")
+    chat_room_id: str
+    filename: str
+    content_type: str
+    length: int
+    chunk_size: int
+    received: int
+
+    @field_validator("id", "chat_room_id", mode="before")
+    def validate_object_id(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)  # Convert to string if it's an ObjectId
+        return value
+
+
+class AttachmentResponse(BaseModel):
+    id: str = Field(..., alias="_id")
+    filename: str
+    content_type: str
+    size: int
+
+    @field_validator("id", mode="before")
+    def validate_object_id(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)  # Convert to string if it's an ObjectId
+        return value
+
+    @pydantic.computed_field
+    @property
+    def url(self) -> str:
+        return utils.get_attachment_url(self.id)
+
+
 class MessageCreate(BaseModel):
     chat_room_id: str
     content: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    client_message_id: str | None = Field(None, min_length=1, max_length=64)
+    attachment_ids: list[str] = Field([], max_length=10)
 
 
 class MessageResponse(BaseModel):
@@ -98,6 +192,17 @@ class MessageResponse(BaseModel):
     chat_room_id: str
     user_id: str
     created_at: datetime
+    seq: int | None = None
+    client_message_id: str | None = None
+    attachments: list[AttachmentResponse] = []
+    version: int = 0
+    edited_at: datetime | None = None
+    deleted: bool = False
+    reactions: dict[str, int] = {}
+
+    @field_validator("reactions", mode="after")
+    def drop_empty_reactions(cls, value):
+        return {emoji: count for emoji, count in value.items() if count > 0}
 
     @field_validator("id", "chat_room_id", "user_id", mode="before")
     def validate_object_id(cls, value):
@@ -112,10 +217,69 @@ class MessageResponse(BaseModel):
         json_encoders = {ObjectId: str}
 
 
+class MessageEdit(BaseModel):
+    chat_room_id: str
+    content: str
+
+
+class ReactionCreate(BaseModel):
+    chat_room_id: str
+    emoji: str = Field(..., min_length=1, max_length=32)
+
+
+class MessagePatch(BaseModel):
+    type: str = "message_patch"
+    message_id: str
+    chat_room_id: str
+    version: int
+    patch: dict[str, Any]
+
+
+class MessageImport(BaseModel):
+    content: str
+    user_id: str | None = None
+    created_at: datetime
+
+
 class MessagesListResponse(BaseModel):
     messages: list[MessageResponse]
+    users: list[UserSummaryResponse] | None = None
+    # The room's latest sequence number when the page was read
+    last_seq: int = 0
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+
+
+class SyncChatRoomMessages(BaseModel):
+    chat_room_id: str
+    messages: list[MessageResponse]
+    has_more: bool
+
+
+class SyncResponse(BaseModel):
+    next_token: str
+    chat_room_ids: list[str]
+    chat_rooms: list[ChatRoomResponse]
+    messages: list[SyncChatRoomMessages]
+    me: UserResponse | None = None
+
+
+class JobResponse(BaseModel):
+    id: str = Field(..., alias="_id")
+    type: str
+    status: str
+    attempts: int
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    result: dict[str, Any] | None = None
+    error: str | None = None
+
+    @field_validator("id", mode="before")
+    def validate_object_id(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)  # Convert to string if it's an ObjectId
+        return value
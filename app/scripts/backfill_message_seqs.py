@@ -0,0 +1,174 @@
+"""Number the messages stored before chat rooms had sequence numbers.
+
+Run with `python -m app.scripts.backfill_message_seqs` once after deploying
+per-room sequence numbers. In each room the unnumbered history, archived
+segments included, takes the numbers 1 to n in `(created_at, _id)` order,
+and messages numbered since the deploy move up by n, so a room's numbers
+follow its history again. Clients see those newer numbers change once.
+
+Progress is kept in the chat room's `seq_backfill` field, so an interrupted
+run can simply be started again.
+"""
+import argparse
+import asyncio
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+from app import archive
+from app.config import settings
+from app.database import get_main_db
+from app.message_store import get_message_store
+
+BATCH_SIZE = 500
+
+
+def in_order(messages: list[dict]) -> list[dict]:
+    return sorted(messages, key=lambda message: (message["created_at"], message["_id"]))
+
+
+async def iter_hot_messages(message_store, db: AsyncIOMotorDatabase, chat_room_id: ObjectId):
+    # The store yields by created_at, ties are put in _id order here
+    same_time = []
+    async for message in message_store.iter_messages(db, chat_room_id):
+        if same_time and message["created_at"] != same_time[0]["created_at"]:
+            for earlier in in_order(same_time):
+                yield earlier
+            same_time = []
+        same_time.append(message)
+    for earlier in in_order(same_time):
+        yield earlier
+
+
+async def count_unnumbered(
+    message_store, db: AsyncIOMotorDatabase, chat_room_id: ObjectId
+) -> int:
+    count = 0
+    async for message in archive.iter_archived_messages(db, chat_room_id):
+        count += "seq" not in message
+    async for message in message_store.iter_messages(db, chat_room_id):
+        count += "seq" not in message
+    return count
+
+
+async def reserve(db: AsyncIOMotorDatabase, chat_room_id: ObjectId, count: int) -> dict:
+    """Move the room's counter past the backfilled range, recording `base`,
+    the numbers handed out before, which must move up by `count`."""
+    while True:
+        chat_room = await db.chat_rooms.find_one({"_id": chat_room_id})
+        base = chat_room.get("last_message_seq", 0)
+        state = {"count": count, "base": base, "shift_below": base + 1}
+        updated = await db.chat_rooms.find_one_and_update(
+            {"_id": chat_room_id, "last_message_seq": chat_room.get("last_message_seq")},
+            {"$set": {"last_message_seq": base + count, "seq_backfill": state}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if updated:
+            return state
+
+
+async def shift(message_store, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, state: dict):
+    # Top down: a moved message lands above every number still to be read
+    count, below = state["count"], state["shift_below"]
+    while below > 1:
+        low = max(1, below - BATCH_SIZE)
+        messages = await message_store.get_messages_by_seq(
+            db, chat_room_id, low, below - 1, BATCH_SIZE
+        )
+        await asyncio.gather(
+            *(
+                message_store.update_message(
+                    db,
+                    chat_room_id,
+                    message["_id"],
+                    {"$set": {"seq": message["seq"] + count}},
+                    match={"seq": message["seq"]},
+                )
+                for message in messages
+            )
+        )
+        below = low
+        await db.chat_rooms.update_one(
+            {"_id": chat_room_id}, {"$set": {"seq_backfill.shift_below": below}}
+        )
+
+
+async def number_history(
+    message_store, db: AsyncIOMotorDatabase, chat_room_id: ObjectId, count: int
+):
+    """Give unnumbered messages their position in the history. Messages at or
+    below `count` were numbered by an earlier, interrupted run."""
+    position = 0
+    async for segment in db.message_segments.find({"chat_room_id": chat_room_id}).sort(
+        "last_at", 1
+    ):
+        messages = in_order(
+            [message async for message in archive.read_segment(db, segment["file_id"])]
+        )
+        changed = False
+        for message in messages:
+            if "seq" not in message or message["seq"] <= count:
+                position += 1
+            if "seq" not in message:
+                message["seq"] = position
+                changed = True
+        if changed:
+            await archive.rewrite_segment(db, segment, messages)
+
+    async def set_seqs(batch: list[tuple[ObjectId, int]]):
+        await asyncio.gather(
+            *(
+                message_store.update_message(
+                    db, chat_room_id, message_id, {"$set": {"seq": seq}}, match={"seq": None}
+                )
+                for message_id, seq in batch
+            )
+        )
+
+    batch = []
+    async for message in iter_hot_messages(message_store, db, chat_room_id):
+        if "seq" not in message or message["seq"] <= count:
+            position += 1
+        if "seq" not in message:
+            batch.append((message["_id"], position))
+            if len(batch) >= BATCH_SIZE:
+                await set_seqs(batch)
+                batch = []
+    if batch:
+        await set_seqs(batch)
+
+
+async def backfill_chat_room(message_store, db: AsyncIOMotorDatabase, chat_room: dict) -> int:
+    state = chat_room.get("seq_backfill")
+    if state is None:
+        count = await count_unnumbered(message_store, db, chat_room["_id"])
+        if not count:
+            await db.chat_rooms.update_one(
+                {"_id": chat_room["_id"]}, {"$set": {"seq_backfilled": True}}
+            )
+            return 0
+        state = await reserve(db, chat_room["_id"], count)
+        # Numbers taken just before the reservation may still be in flight
+        await asyncio.sleep(settings.sync_settle_seconds)
+    await shift(message_store, db, chat_room["_id"], state)
+    await number_history(message_store, db, chat_room["_id"], state["count"])
+    await db.chat_rooms.update_one(
+        {"_id": chat_room["_id"]},
+        {"$set": {"seq_backfilled": True}, "$unset": {"seq_backfill": ""}},
+    )
+    return state["count"]
+
+
+async def backfill(db: AsyncIOMotorDatabase, message_store=None) -> int:
+    message_store = message_store or get_message_store()
+    numbered = 0
+    async for chat_room in db.chat_rooms.find({"seq_backfilled": {"$ne": True}}):
+        numbered += await backfill_chat_room(message_store, db, chat_room)
+    return numbered
+
+
+if __name__ == "__main__":
+    argparse.ArgumentParser(description=__doc__.splitlines()[0]).parse_args()
+    count = asyncio.run(backfill(get_main_db()))
+    print(f"Numbered {count} messages")
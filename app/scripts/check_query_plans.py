@@ -0,0 +1,180 @@
+"""Fail when an endpoint's queries stop using indexes.
+
+Run against a seeded database, e.g. after `app.scripts.seed`, with
+`python -m app.scripts.check_query_plans --db livechat_seed`. It sends a
+representative read request to each endpoint as one of the busiest seeded
+users, records every query the app and its auth dependency issue, and
+explains each distinct query shape with execution stats. Nothing is written:
+sending a message is covered by running its reads directly and explaining
+its counter update, which does not apply it. Collection scans, in-memory sorts
+and queries examining more than `--max-docs-examined-ratio` documents per
+document returned are reported and make the exit status non-zero.
+"""
+import argparse
+import asyncio
+import copy
+import sys
+
+from bson import ObjectId
+from httpx import ASGITransport, AsyncClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import monitoring
+
+from app import oauth2, profiling
+from app.config import settings
+from app.database import get_db, get_fs
+from app.main import app
+from app.message_store import get_message_store
+from app.scripts.seed import SEED_PASSWORD
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Keeps the first command of each shape sent to `database_name`, with
+    the request that sent it."""
+
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.request = None
+        self.commands: dict[tuple, tuple[str, dict]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if (
+            self.request is None
+            or event.database_name != self.database_name
+            or event.command_name not in profiling.SlowOperationListener.explainable
+        ):
+            return
+        command = event.command
+        shape = (
+            event.command_name,
+            command.get(event.command_name),
+            profiling.shape_of(profiling.query_filter(command)),
+        )
+        if shape not in self.commands:
+            self.commands[shape] = (self.request, copy.deepcopy(dict(command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def pick_subject(db) -> dict:
+    """The member of the largest group room, along with rooms to query."""
+    group = await db.chat_rooms.find_one({"type": "group"}, sort=[("member_count", -1)])
+    member = await db.chat_room_members.find_one({"chat_room_id": group["_id"]})
+    user = await db.users.find_one({"_id": member["user_id"]})
+    direct = await db.chat_rooms.find_one({"type": "direct", "user_ids": user["_id"]})
+    return {"user": user, "group": group, "direct": direct}
+
+
+def requests_for(subject: dict) -> list[tuple[str, str, dict]]:
+    user, group, direct = subject["user"], subject["group"], subject["direct"]
+    requests = [
+        (
+            "POST",
+            "/auth/login",
+            {"data": {"username": user["email"], "password": SEED_PASSWORD}},
+        ),
+        ("GET", "/auth/me", {}),
+        ("GET", "/users", {"params": {"search": user["email"][:6]}}),
+        ("GET", "/users", {"params": {"ids": str(user["_id"])}}),
+        ("GET", f"/users/{user['_id']}", {}),
+        ("GET", "/chat_rooms", {}),
+        ("GET", f"/chat_rooms/{group['_id']}", {}),
+        ("GET", f"/chat_rooms/{group['_id']}/members", {}),
+        (
+            "GET",
+            f"/chat_rooms/{group['_id']}/members",
+            {"params": {"after": str(user["_id"])}},
+        ),
+        ("GET", "/messages", {"params": {"chat_room_id": str(group["_id"])}}),
+        ("GET", "/messages", {"params": {"chat_room_id": str(group["_id"]), "page": 5}}),
+        (
+            "GET",
+            "/messages",
+            {"params": {"chat_room_id": str(group["_id"]), "before": "2020-01-01T00:00:00Z"}},
+        ),
+        (
+            "GET",
+            "/messages",
+            {"params": {"chat_room_id": str(group["_id"]), "from_seq": 100, "to_seq": 124}},
+        ),
+        ("GET", "/sync", {}),
+    ]
+    if direct:
+        partner_id = next(uid for uid in direct["user_ids"] if uid != user["_id"])
+        requests += [
+            ("GET", "/chat_rooms/direct", {"params": {"partner_id": str(partner_id)}}),
+            ("GET", "/messages", {"params": {"chat_room_id": str(direct["_id"])}}),
+        ]
+    return requests
+
+
+async def record_send_path(db, recorder: CommandRecorder, subject: dict):
+    """The queries of `POST /messages` that the read requests do not cover."""
+    user, group = subject["user"], subject["group"]
+    recorder.request = "POST /messages"
+    await get_message_store().find_by_client_message_id(
+        db, group["_id"], user["_id"], f"query-plan-check-{ObjectId()}"
+    )
+    # Only explained: `helpers.allocate_message_seqs` would take a number
+    query = {"_id": group["_id"]}
+    recorder.commands[("findAndModify", "chat_rooms", profiling.shape_of(query))] = (
+        recorder.request,
+        {
+            "findAndModify": "chat_rooms",
+            "query": query,
+            "update": {"$inc": {"last_message_seq": 1}},
+            "fields": {"last_message_seq": 1},
+            "new": True,
+        },
+    )
+    recorder.request = None
+
+
+async def check(database_name: str, max_docs_examined_ratio: float) -> int:
+    recorder = CommandRecorder(database_name)
+    client = AsyncIOMotorClient(settings.mongo_uri, event_listeners=[recorder])
+    db = client[database_name]
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_fs] = lambda: AsyncIOMotorGridFSBucket(db)
+
+    subject = await pick_subject(db)
+    token = await oauth2.create_access_token(data={"email": subject["user"]["email"]})
+    async with AsyncClient(
+        transport=ASGITransport(app=app),
+        base_url="http://check",
+        headers={"Authorization": f"Bearer {token}"},
+    ) as http:
+        for method, path, kwargs in requests_for(subject):
+            recorder.request = f"{method} {path}"
+            response = await http.request(method, path, **kwargs)
+            if response.status_code >= 400:
+                print(f"{recorder.request}: HTTP {response.status_code} {response.text}")
+    await record_send_path(db, recorder, subject)
+
+    failures = 0
+    for (command_name, collection, _), (request, command) in recorder.commands.items():
+        explain = await profiling.explain_command(db, command, "executionStats")
+        problems = profiling.plan_problems(explain, max_docs_examined_ratio)
+        plans = [
+            profiling.summarize_plan(query_planner.get("winningPlan", {}))
+            for query_planner, _ in profiling.iter_explained_queries(explain)
+        ]
+        status = "FAIL" if problems else "ok"
+        print(f"{status:4} {request}: {command_name} {collection} [{'; '.join(plans)}]")
+        for problem in problems:
+            print(f"       {problem}")
+        failures += bool(problems)
+    print(f"{len(recorder.commands)} queries checked, {failures} failed")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="seeded database to check against")
+    parser.add_argument("--max-docs-examined-ratio", type=float, default=10)
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(check(args.db, args.max_docs_examined_ratio)) else 0)
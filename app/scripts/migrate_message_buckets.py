@@ -0,0 +1,60 @@
+"""Convert the one-document-per-message `messages` collection into buckets.
+
+Run with `python -m app.scripts.migrate_message_buckets [--drop-source]`, then
+set `MESSAGE_STORAGE=buckets`. Each room resumes after the last message of
+its newest bucket, so an interrupted run can simply be started again.
+"""
+import argparse
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.database import get_main_db
+from app.message_store import get_message_stores
+
+
+async def migrate(db: AsyncIOMotorDatabase, drop_source: bool = False) -> int:
+    store = get_message_stores()["buckets"]
+    await store.create_indexes(db)
+    migrated = 0
+    for chat_room_id in await db.messages.distinct("chat_room_id"):
+        query = {"chat_room_id": chat_room_id}
+        last_bucket = await db.message_buckets.find_one(
+            {"chat_room_id": chat_room_id},
+            {"messages": {"$slice": -1}},
+            sort=[("last_at", -1), ("_id", -1)],
+        )
+        if last_bucket:
+            last = last_bucket["messages"][-1]
+            query["$or"] = [
+                {"created_at": {"$gt": last["created_at"]}},
+                {"created_at": last["created_at"], "_id": {"$gt": last["_id"]}},
+            ]
+        bucket = []
+        cursor = db.messages.find(query).sort([("created_at", 1), ("_id", 1)])
+        async for message in cursor.batch_size(store.bucket_size):
+            if bucket and (
+                len(bucket) >= store.bucket_size
+                or message["created_at"] - bucket[0]["created_at"] >= store.bucket_span
+            ):
+                await store.insert_bucket(db, chat_room_id, bucket)
+                bucket = []
+            bucket.append(message)
+            migrated += 1
+        if bucket:
+            await store.insert_bucket(db, chat_room_id, bucket)
+        if drop_source:
+            await db.messages.delete_many({"chat_room_id": chat_room_id})
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--drop-source",
+        action="store_true",
+        help="delete each room's documents from `messages` once it is bucketed",
+    )
+    args = parser.parse_args()
+    count = asyncio.run(migrate(get_main_db(), drop_source=args.drop_source))
+    print(f"Migrated {count} messages")
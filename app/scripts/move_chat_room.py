@@ -0,0 +1,45 @@
+"""Move a chat room's messages to another message partition while it is live.
+
+Run with `python -m app.scripts.move_chat_room <chat_room_id> <partition>`,
+where `partition` indexes `MESSAGE_PARTITIONS`. Several databases on one
+mongod work as partitions for local testing, e.g.
+MESSAGE_PARTITIONS='["mongodb://localhost/chat_p0", "mongodb://localhost/chat_p1"]'.
+With `--enqueue` the move is left to a job worker and the job id is printed.
+"""
+import argparse
+import asyncio
+
+from bson import ObjectId
+
+from app import jobs
+from app.database import get_main_db
+from app.message_store import get_message_store
+from app.partitions import PartitionedMessageStore, move_chat_room
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("chat_room_id")
+    parser.add_argument("partition", type=int)
+    parser.add_argument("--enqueue", action="store_true", help="run it as a background job")
+    args = parser.parse_args()
+    store = get_message_store()
+    if not isinstance(store, PartitionedMessageStore):
+        parser.error("MESSAGE_PARTITIONS is not configured")
+    if not 0 <= args.partition < len(store.router.partitions):
+        parser.error(f"partition must be below {len(store.router.partitions)}")
+    if args.enqueue:
+        job = asyncio.run(
+            jobs.enqueue(
+                get_main_db(),
+                "move_chat_room",
+                {"chat_room_id": args.chat_room_id, "partition": args.partition},
+                key=f"move_chat_room:{args.chat_room_id}",
+            )
+        )
+        print(f"Enqueued job {job['_id']}")
+    else:
+        asyncio.run(
+            move_chat_room(get_main_db(), store, ObjectId(args.chat_room_id), args.partition)
+        )
+        print(f"Moved {args.chat_room_id} to partition {args.partition}")
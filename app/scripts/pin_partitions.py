@@ -0,0 +1,24 @@
+"""Pin every chat room to the message partition it currently uses.
+
+Rooms created before partition assignments were recorded are only placed by
+a hash over the partition list, so they must be pinned before
+`MESSAGE_PARTITIONS` changes. Run `python -m app.scripts.pin_partitions`
+with the current, unchanged setting; the app refuses to start on a changed
+list until this has been done.
+"""
+import argparse
+import asyncio
+
+from app.database import get_main_db
+from app.partitions import get_router, pin_chat_rooms
+
+
+async def main():
+    db = get_main_db()
+    pinned = await pin_chat_rooms(db, get_router())
+    print(f"Pinned {pinned} chat rooms")
+
+
+if __name__ == "__main__":
+    argparse.ArgumentParser(description=__doc__.splitlines()[0]).parse_args()
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""Run background job workers outside the web processes.
+
+Run with `python -m app.scripts.run_jobs [--workers N] [--processes P]`,
+which starts P processes of N worker coroutines each. Set `JOB_WORKERS=0`
+for the web processes to leave all jobs to these.
+"""
+import argparse
+import asyncio
+import multiprocessing
+
+from app import jobs
+from app.config import settings
+from app.database import create_indexes, get_main_db
+
+
+async def run(workers: int):
+    db = get_main_db()
+    await create_indexes(db)
+    await asyncio.gather(*jobs.get_runner(db, workers).start())
+
+
+def main(workers: int):
+    try:
+        asyncio.run(run(workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=max(settings.job_workers, 1))
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+    processes = [
+        multiprocessing.Process(target=main, args=(args.workers,))
+        for _ in range(args.processes - 1)
+    ]
+    for process in processes:
+        process.start()
+    main(args.workers)
+    for process in processes:
+        process.join()
@@ -0,0 +1,240 @@
+"""Fill a database with synthetic users, chat rooms and messages.
+
+Run with `python -m app.scripts.seed --db livechat_seed --users 200000
+--rooms 50000 --messages 5000000`. Room sizes and activity follow a power
+law, so a few rooms are huge and busy while most are small and quiet, and
+roughly `--direct-fraction` of the rooms are direct chats. Every seeded user
+has the password `SEED_PASSWORD`. Messages go through the configured message
+store, so bucketed and partitioned storage are seeded the same way.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from app import utils
+from app.database import create_indexes, get_client
+from app.message_store import get_message_store
+
+SEED_PASSWORD = "Seedpass1!"
+
+WORDS = (
+    "ok sure thanks lol see you tomorrow meeting at noon did you get the file "
+    "sounds good let me check running late on my way great idea what time works"
+).split()
+
+
+def power_law(rng: random.Random, alpha: float, upper: int) -> int:
+    return min(upper, int(rng.paretovariate(alpha)))
+
+
+def make_users(count: int) -> list[dict]:
+    # One hash for everyone, bcrypt would otherwise take most of the run
+    password_hash = utils.hash(SEED_PASSWORD)
+    return [
+        {
+            "_id": ObjectId(),
+            "email": f"user_{i}@seed.example",
+            "password_hash": password_hash,
+            "display_name": f"Seed User {i}",
+        }
+        for i in range(count)
+    ]
+
+
+def make_chat_rooms(
+    rng: random.Random,
+    user_ids: list[ObjectId],
+    count: int,
+    direct_fraction: float,
+    max_group_size: int,
+    now: datetime,
+) -> tuple[list[dict], list[dict]]:
+    """Chat rooms and group memberships. Popular users (low indexes) join
+    more rooms, as the same power law picks them."""
+    chat_rooms, members = [], []
+    sync_seq = int(now.timestamp() * 1_000_000)
+    for i in range(count):
+        if rng.random() < direct_fraction:
+            first, second = rng.sample(range(len(user_ids)), 2)
+            chat_rooms.append(
+                {
+                    "_id": ObjectId(),
+                    "type": "direct",
+                    "user_ids": [user_ids[first], user_ids[second]],
+                    "sync_seq": sync_seq + i,
+                }
+            )
+            continue
+        size = max(3, power_law(rng, 1.2, min(max_group_size, len(user_ids))))
+        member_ids = {
+            user_ids[power_law(rng, 0.8, len(user_ids)) - 1] for _ in range(size)
+        }
+        while len(member_ids) < size:
+            member_ids.add(rng.choice(user_ids))
+        chat_room = {
+            "_id": ObjectId(),
+            "type": "group",
+            "name": f"Seed Group {i}",
+            "owner_id": next(iter(member_ids)),
+            "member_count": size,
+            "created_at": now,
+            "sync_seq": sync_seq + i,
+        }
+        chat_rooms.append(chat_room)
+        members.extend(
+            {"chat_room_id": chat_room["_id"], "user_id": user_id, "joined_at": now}
+            for user_id in member_ids
+        )
+    return chat_rooms, members
+
+
+def iter_messages(
+    rng: random.Random,
+    chat_rooms: list[dict],
+    members: list[dict],
+    count: int,
+    days: int,
+    now: datetime,
+):
+    senders = {}
+    for member in members:
+        senders.setdefault(member["chat_room_id"], []).append(member["user_id"])
+    for chat_room in chat_rooms:
+        if chat_room["type"] == "direct":
+            senders[chat_room["_id"]] = chat_room["user_ids"]
+    # Busy rooms are busy out of proportion to their size
+    weights = [
+        len(senders[chat_room["_id"]]) * rng.paretovariate(1.5) for chat_room in chat_rooms
+    ]
+    cum_weights = list(itertools.accumulate(weights))
+    span = days * 24 * 60 * 60
+    for _ in range(count):
+        [chat_room] = rng.choices(chat_rooms, cum_weights=cum_weights)
+        created_at = now - timedelta(seconds=rng.random() * span)
+        chat_room["last_message_seq"] = chat_room.get("last_message_seq", 0) + 1
+        yield {
+            "_id": ObjectId(),
+            "chat_room_id": chat_room["_id"],
+            "user_id": rng.choice(senders[chat_room["_id"]]),
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+            "created_at": created_at,
+            "sync_seq": int(created_at.timestamp() * 1_000_000),
+            "seq": chat_room["last_message_seq"],
+        }
+
+
+async def insert_batches(insert, documents, batch_size: int, concurrency: int = 4) -> int:
+    """Bulk insert `documents` with up to `concurrency` batches in flight."""
+    iterator = iter(documents)
+    pending = set()
+    inserted = 0
+    while batch := list(itertools.islice(iterator, batch_size)):
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        pending.add(asyncio.create_task(insert(batch)))
+        inserted += len(batch)
+    await asyncio.gather(*pending)
+    return inserted
+
+
+async def set_last_message_seqs(db, chat_rooms: list[dict]):
+    await asyncio.gather(
+        *(
+            db.chat_rooms.update_one(
+                {"_id": chat_room["_id"]},
+                {"$set": {"last_message_seq": chat_room["last_message_seq"]}},
+            )
+            for chat_room in chat_rooms
+        )
+    )
+
+
+async def seed(
+    db,
+    users: int,
+    rooms: int,
+    messages: int,
+    direct_fraction: float = 0.6,
+    max_group_size: int = 5000,
+    days: int = 365,
+    batch_size: int = 10_000,
+    seed: int = 0,
+) -> dict:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    await create_indexes(db)
+    user_docs = make_users(users)
+    await insert_batches(
+        lambda batch: db.users.insert_many(batch, ordered=False), user_docs, batch_size
+    )
+    chat_rooms, members = make_chat_rooms(
+        rng, [user["_id"] for user in user_docs], rooms, direct_fraction, max_group_size, now
+    )
+    await insert_batches(
+        lambda batch: db.chat_rooms.insert_many(batch, ordered=False), chat_rooms, batch_size
+    )
+    await insert_batches(
+        lambda batch: db.chat_room_members.insert_many(batch, ordered=False), members, batch_size
+    )
+    store = get_message_store()
+    inserted = await insert_batches(
+        lambda batch: store.insert_messages(db, batch),
+        iter_messages(rng, chat_rooms, members, messages, days, now),
+        batch_size,
+    )
+    # The rooms were inserted before their messages were numbered
+    await insert_batches(
+        lambda batch: set_last_message_seqs(db, batch),
+        (chat_room for chat_room in chat_rooms if "last_message_seq" in chat_room),
+        batch_size,
+    )
+    return {
+        "users": len(user_docs),
+        "chat_rooms": len(chat_rooms),
+        "members": len(members),
+        "messages": inserted,
+    }
+
+
+async def main(args):
+    client = get_client()
+    if args.drop:
+        await client.drop_database(args.db)
+    started = time.perf_counter()
+    counts = await seed(
+        client[args.db],
+        args.users,
+        args.rooms,
+        args.messages,
+        direct_fraction=args.direct_fraction,
+        max_group_size=args.max_group_size,
+        days=args.days,
+        batch_size=args.batch_size,
+        seed=args.seed,
+    )
+    print(
+        ", ".join(f"{count} {name}" for name, count in counts.items())
+        + f" in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="database to fill")
+    parser.add_argument("--drop", action="store_true", help="drop the database first")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--rooms", type=int, default=20_000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--direct-fraction", type=float, default=0.6)
+    parser.add_argument("--max-group-size", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=365, help="spread messages over")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
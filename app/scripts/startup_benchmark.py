@@ -0,0 +1,87 @@
+"""Check cold start against the configured budgets.
+
+Run with `python -m app.scripts.startup_benchmark [--runs N]`. Import time is
+measured in fresh interpreters; time to first request starts a uvicorn
+worker and polls `GET /` until it answers, so it needs a reachable Mongo.
+Exits non-zero when either median is over budget.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from app.config import settings
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def measure_import() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_request(timeout: float = 60) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env={**os.environ, "HEARTBEAT_INTERVAL_SECONDS": "0"},
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1):
+                    return time.perf_counter() - started
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("Server exited before answering")
+                time.sleep(0.02)
+        raise TimeoutError(f"No response within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--skip-server", action="store_true", help="only measure import time")
+    args = parser.parse_args()
+    results = [
+        (
+            "import",
+            statistics.median(measure_import() for _ in range(args.runs)),
+            settings.startup_import_budget_seconds,
+        )
+    ]
+    if not args.skip_server:
+        results.append(
+            (
+                "first request",
+                statistics.median(measure_first_request() for _ in range(args.runs)),
+                settings.startup_ready_budget_seconds,
+            )
+        )
+    over_budget = False
+    for name, seconds, budget in results:
+        verdict = "ok" if seconds <= budget else "OVER BUDGET"
+        over_budget |= seconds > budget
+        print(f"{name}: {seconds:.3f}s (budget {budget:.3f}s) {verdict}")
+    sys.exit(1 if over_budget else 0)
@@ -0,0 +1,89 @@
+"""Production entry point: `python -m app.server`.
+
+Runs uvicorn with `server_workers` processes (0 means one per available
+core) on uvloop and httptools when they are installed. Each worker builds its
+database pool and caches in the lifespan hook, which uvicorn finishes before
+the worker accepts connections. The default is a single worker, as websocket
+broadcasts only reach clients connected to the same process.
+
+With several workers and `server_max_requests` set, each worker exits after
+that many HTTP requests plus a random share of `server_max_requests_jitter`,
+draining its websockets like on SIGTERM, and the supervisor starts a fresh
+one. The jitter keeps workers from recycling all at once.
+"""
+import importlib.util
+import os
+import random
+import signal
+
+from app.config import settings
+
+
+def worker_count() -> int:
+    if settings.server_workers:
+        return settings.server_workers
+    # Honours CPU affinity, e.g. a container limited to some cores
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def uvicorn_options() -> dict:
+    return {
+        "host": settings.server_host,
+        "port": settings.server_port,
+        "workers": worker_count(),
+        "loop": settings.server_loop if installed(settings.server_loop) else "auto",
+        "http": settings.server_http if installed(settings.server_http) else "auto",
+        "backlog": settings.server_backlog,
+        "timeout_keep_alive": settings.server_keep_alive_seconds,
+        "ws_ping_interval": settings.server_ws_ping_interval_seconds or None,
+        "ws_ping_timeout": settings.server_ws_ping_timeout_seconds or None,
+        "access_log": settings.server_access_log,
+    }
+
+
+class MaxRequestsMiddleware:
+    """Stops this worker once it has served its request budget.
+
+    Only enabled with more than one worker, where uvicorn's supervisor
+    replaces workers that exit; a lone server would just stop.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.served = 0
+        self.limit = None
+
+    def request_limit(self) -> int:
+        if not settings.server_max_requests or worker_count() < 2:
+            return 0
+        return settings.server_max_requests + random.randint(
+            0, settings.server_max_requests_jitter
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self.limit is None:
+            self.limit = self.request_limit()
+        self.served += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if self.served == self.limit:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run():
+    import uvicorn
+
+    uvicorn.run("app.main:app", **uvicorn_options())
+
+
+if __name__ == "__main__":
+    run()
@@ -1,9 +1,16 @@
 import re
+from functools import lru_cache
+from urllib.parse import quote
 from bson import ObjectId
-from passlib.context import CryptContext
 from app.config import settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+@lru_cache
+def get_pwd_context():
+    # passlib pulls in bcrypt, which only login and registration need
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 def is_strong_password(password):
@@ -13,14 +20,18 @@ def is_strong_password(password):
 
 
 def hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify(plain_password: str, password_hash: str) -> bool:
-    return pwd_context.verify(plain_password, password_hash)
+    return get_pwd_context().verify(plain_password, password_hash)
 
 
 def get_avatar_url(file_id: ObjectId | str | None, name: str | None) -> str:
     if file_id:
         return f"{settings.api_url}/images/{str(file_id)}"
-    return f"https://ui-avatars.com/api/?name={name.replace(' ', '+')}"
\ No newline at end of file
+    return f"{settings.api_url}/avatars/initials?name={quote(name or '')}"
+
+
+def get_attachment_url(file_id: ObjectId | str) -> str:
+    return f"{settings.api_url}/attachments/{str(file_id)}"
@@ -1,4 +1,5 @@
 import pytest
+from datetime import datetime, timezone
 from typing import AsyncGenerator
 from fastapi import status
 from motor.motor_asyncio import (
@@ -6,9 +7,9 @@ from motor.motor_asyncio import (
     AsyncIOMotorDatabase,
     AsyncIOMotorGridFSBucket,
 )
-from app import oauth2, schemas, utils
+from app import oauth2, rate_limiter, schemas, utils
 from app.config import settings
-from app.database import get_db, get_fs
+from app.database import create_indexes, get_db, get_fs
 from app.main import app
 from httpx import ASGITransport, AsyncClient
 
@@ -27,6 +28,7 @@ async def testdb() -> AsyncGenerator[AsyncIOMotorDatabase, None]:
     db = client[settings.mongo_testdb]
 
     await client.drop_database(settings.mongo_testdb)
+    await create_indexes(db)
     return db
 
 
@@ -45,6 +47,8 @@ async def client(testdb, testfs):
 
     app.dependency_overrides[get_db] = override_get_db
     app.dependency_overrides[get_fs] = override_get_fs
+    for limiter in rate_limiter.get_limiters().values():
+        limiter.reset()
 
     yield AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
 
@@ -102,3 +106,24 @@ async def get_direct_chat_room(testdb):
         return await testdb.chat_rooms.find_one({"_id": res.inserted_id})
 
     return _direct_chat_room
+
+
+@pytest.fixture
+async def get_group_chat_room(testdb):
+    async def _group_chat_room(users, name="Group", **fields):
+        res = await testdb.chat_rooms.insert_one(
+            {"type": "group", "name": name, "member_count": len(users), **fields}
+        )
+        await testdb.chat_room_members.insert_many(
+            [
+                {
+                    "chat_room_id": res.inserted_id,
+                    "user_id": user["_id"],
+                    "joined_at": datetime.now(timezone.utc),
+                }
+                for user in users
+            ]
+        )
+        return await testdb.chat_rooms.find_one({"_id": res.inserted_id})
+
+    return _group_chat_room
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from bson import ObjectId
+from fastapi import status
+
+from app import archive
+from app.message_store import BucketMessageStore, DocumentMessageStore
+
+
+@pytest.mark.anyio
+async def test_archive_messages(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    base_time = datetime.now(timezone.utc).replace(microsecond=0)
+    await testdb.messages.insert_many(
+        [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": direct_chat_room["_id"],
+                "user_id": users[i % 2]["_id"],
+                "created_at": base_time - timedelta(days=1000 - i),
+            }
+            for i in range(5)
+        ]
+        + [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": direct_chat_room["_id"],
+                "user_id": users[i % 2]["_id"],
+                "created_at": base_time + timedelta(seconds=i),
+            }
+            for i in range(5, 8)
+        ]
+    )
+
+    archived = await archive.archive_messages(testdb, DocumentMessageStore())
+    assert archived == 5
+    assert await testdb.messages.count_documents({}) == 3
+    assert await testdb.message_segments.count_documents({}) == 1
+
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    response = await client.get(
+        f"/messages?chat_room_id={str(direct_chat_room['_id'])}&page=2&page_size=4"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    messages = response.json().get("messages")
+    assert [m.get("content") for m in messages] == [
+        "Message 3",
+        "Message 2",
+        "Message 1",
+        "Message 0",
+    ]
+
+    response = await client.get(
+        f"/messages?chat_room_id={str(direct_chat_room['_id'])}&page_size=10"
+    )
+    assert len(response.json().get("messages")) == 8
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("store", [DocumentMessageStore(), BucketMessageStore(bucket_size=3)])
+async def test_archive_resumes_after_a_crash(testdb, store, monkeypatch):
+    chat_room = await testdb.chat_rooms.insert_one({"type": "group", "name": "Old"})
+    base_time = datetime.now(timezone.utc).replace(microsecond=0)
+    await store.insert_messages(
+        testdb,
+        [
+            {
+                "_id": ObjectId(),
+                "content": f"Message {i}",
+                "chat_room_id": chat_room.inserted_id,
+                "user_id": ObjectId(),
+                "created_at": base_time - timedelta(days=1000 - i),
+            }
+            for i in range(4)
+        ],
+    )
+
+    async def crash(*args):
+        raise RuntimeError("stopped before deleting")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(store, "delete_messages", crash)
+        with pytest.raises(RuntimeError):
+            await archive.archive_messages(testdb, store)
+    assert await testdb.message_segments.count_documents({}) == 1
+
+    # A message stamped in the past arrives before the next run
+    await store.insert_messages(
+        testdb,
+        [
+            {
+                "_id": ObjectId(),
+                "content": "Late",
+                "chat_room_id": chat_room.inserted_id,
+                "user_id": ObjectId(),
+                "created_at": base_time - timedelta(days=999),
+            }
+        ],
+    )
+    write_segment = archive.write_segment
+
+    async def write_then_receive(db, chat_room_id, messages):
+        await write_segment(db, chat_room_id, messages)
+        # Stamped before the cutoff but never read by this run
+        await store.insert_messages(
+            db,
+            [
+                {
+                    "_id": ObjectId(),
+                    "content": "During",
+                    "chat_room_id": chat_room_id,
+                    "user_id": ObjectId(),
+                    "created_at": base_time - timedelta(days=998),
+                }
+            ],
+        )
+
+    monkeypatch.setattr(archive, "write_segment", write_then_receive)
+    assert await archive.archive_messages(testdb, store) == 1
+    assert await testdb.message_segments.count_documents({}) == 2
+    remaining = await store.get_messages(testdb, chat_room.inserted_id)
+    assert [message["content"] for message in remaining] == ["During"]
+    archived = await archive.get_archived_messages(testdb, chat_room.inserted_id, limit=10)
+    assert sorted(message["content"] for message in archived) == [
+        "Late",
+        "Message 0",
+        "Message 1",
+        "Message 2",
+        "Message 3",
+    ]
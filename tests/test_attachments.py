@@ -0,0 +1,114 @@
+import hashlib
+import pytest
+from bson import ObjectId
+from fastapi import status
+
+from app import attachments
+
+
+@pytest.mark.anyio
+async def test_resumable_attachment_upload(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room, monkeypatch
+):
+    monkeypatch.setattr(attachments, "CHUNK_SIZE", 4)
+    users = await sample_users(3)
+    tokens = await access_tokens(users)
+    chat_room = await get_direct_chat_room(users[0], users[1])
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    body = b"0123456789"
+
+    response = await client.post(
+        "/uploads",
+        json={
+            "chat_room_id": str(chat_room["_id"]),
+            "filename": "notes.txt",
+            "content_type": "text/plain",
+            "length": len(body),
+        },
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    upload = response.json()
+    assert upload["chunk_size"] == 4
+    assert upload["received"] == 0
+
+    # The trailing partial chunk is dropped, the client resumes from `received`
+    response = await client.put(f"/uploads/{upload['_id']}?offset=0", content=body[:6])
+    assert response.json()["received"] == 4
+    response = await client.put(f"/uploads/{upload['_id']}?offset=0", content=body)
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+    response = await client.put(
+        f"/uploads/{upload['_id']}?offset=4",
+        content=body[4:],
+        headers={"X-Chunk-Sha256": hashlib.sha256(b"wrong").hexdigest()},
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = await client.put(
+        f"/uploads/{upload['_id']}?offset=4",
+        content=body[4:],
+        headers={"X-Chunk-Sha256": hashlib.sha256(body[4:]).hexdigest()},
+    )
+    assert response.json()["received"] == len(body)
+    assert await testdb["fs.chunks"].count_documents({"files_id": chat_room["_id"]}) == 0
+
+    response = await client.post(f"/uploads/{upload['_id']}/complete")
+    assert response.status_code == status.HTTP_201_CREATED
+    attachment = response.json()
+    assert attachment["size"] == len(body)
+    assert attachment["url"].endswith(f"/attachments/{upload['_id']}")
+
+    response = await client.post(
+        "/messages",
+        json={
+            "content": "",
+            "chat_room_id": str(chat_room["_id"]),
+            "attachment_ids": [attachment["_id"]],
+        },
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["attachments"] == [attachment]
+
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+    response = await client.get(f"/attachments/{attachment['_id']}")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == body
+    assert response.headers["content-type"].startswith("text/plain")
+
+    # The public image route must not bypass the membership check
+    client.headers = {"Authorization": f"Bearer {tokens[2]}"}
+    response = await client.get(f"/attachments/{attachment['_id']}")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    response = await client.get(f"/images/{attachment['_id']}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.anyio
+async def test_upload_size_cap(client, sample_users, access_tokens, get_direct_chat_room, monkeypatch):
+    monkeypatch.setattr(attachments.settings, "attachment_max_bytes", 5)
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    chat_room = await get_direct_chat_room(users[0], users[1])
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post(
+        "/uploads",
+        json={"chat_room_id": str(chat_room["_id"]), "filename": "big.bin", "length": 6},
+    )
+    assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+
+@pytest.mark.anyio
+async def test_upload_session_lookups(client, testdb, sample_users, access_tokens):
+    users = await sample_users(1)
+    tokens = await access_tokens(users)
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post("/uploads/not-an-id/complete")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    # Two completions racing for one session both get the file
+    session = await attachments.create_upload_session(
+        testdb, users[0]["_id"], ObjectId(), "notes.txt", "text/plain", 0
+    )
+    first = await attachments.complete_upload(testdb, session)
+    second = await attachments.complete_upload(testdb, session)
+    assert second["_id"] == first["_id"]
+    assert await testdb["fs.files"].count_documents({}) == 1
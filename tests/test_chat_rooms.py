@@ -131,3 +131,155 @@ async def test_get_single_chat_room_unauthorized(
     response = await client.get(f"/chat_rooms/{str(insert_room.inserted_id)}")
     data = response.json()
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.anyio
+async def test_create_group_chat_room(client, testdb, sample_users, access_tokens):
+    users = await sample_users(3)
+    tokens = await access_tokens(users)
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post(
+        "/chat_rooms/group",
+        json={"name": "Team", "user_ids": [str(users[1]["_id"])]},
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    chat_room = response.json()
+    assert chat_room.get("type") == "group"
+    assert chat_room.get("name") == "Team"
+    assert chat_room.get("member_count") == 2
+    assert chat_room.get("user_ids") == []
+    assert await testdb.chat_room_members.count_documents({}) == 2
+
+    response = await client.get("/chat_rooms")
+    chat_rooms = response.json().get("chat_rooms", [])
+    assert [room.get("name") for room in chat_rooms] == ["Team"]
+
+    client.headers = {"Authorization": f"Bearer {tokens[2]}"}
+    response = await client.get(f"/chat_rooms/{chat_room['_id']}")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.anyio
+async def test_join_and_leave_group_chat_room(
+    client, testdb, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room([users[0]])
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    response = await client.post(
+        f"/chat_rooms/{group_chat_room['_id']}/invites",
+        json={"user_id": str(users[1]["_id"])},
+    )
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post(
+        f"/chat_rooms/{group_chat_room['_id']}/invites",
+        json={"user_id": str(users[1]["_id"])},
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+    assert response.status_code == status.HTTP_200_OK
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+    assert response.status_code == status.HTTP_200_OK
+    chat_room = await testdb.chat_rooms.find_one({"_id": group_chat_room["_id"]})
+    assert chat_room.get("member_count") == 2
+
+    response = await client.get(f"/chat_rooms/{group_chat_room['_id']}")
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/leave")
+    assert response.status_code == status.HTTP_200_OK
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/leave")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    chat_room = await testdb.chat_rooms.find_one({"_id": group_chat_room["_id"]})
+    assert chat_room.get("member_count") == 1
+    # The invite was used up by joining
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.anyio
+async def test_join_public_group_chat_room(
+    client, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room([users[0]], public=True)
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+
+    response = await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.anyio
+async def test_get_group_chat_room_members(
+    client, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(3)
+    tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room(users)
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+
+    response = await client.get(
+        f"/chat_rooms/{group_chat_room['_id']}/members?page_size=2"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    members = response.json().get("members")
+    assert len(members) == 2
+
+    response = await client.get(
+        f"/chat_rooms/{group_chat_room['_id']}/members?after={members[-1]['user_id']}"
+    )
+    assert len(response.json().get("members")) == 1
+
+
+@pytest.mark.anyio
+async def test_get_chat_rooms_conditional_get(
+    client, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room([users[0]], public=True)
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+
+    response = await client.get("/chat_rooms")
+    etag = response.headers.get("etag")
+    response = await client.get("/chat_rooms", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+    await client.post(f"/chat_rooms/{group_chat_room['_id']}/join")
+
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.get("/chat_rooms", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["chat_rooms"][0].get("member_count") == 2
+
+
+@pytest.mark.anyio
+async def test_get_chat_room_conditional_get(
+    client, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room([users[0]], public=True)
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    url = f"/chat_rooms/{group_chat_room['_id']}"
+
+    etag = (await client.get(url)).headers.get("etag")
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+    await client.post(f"{url}/join")
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json().get("member_count") == 2
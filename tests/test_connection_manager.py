@@ -0,0 +1,153 @@
+import asyncio
+import json
+import pytest
+
+from app.connection_manager import (
+    GOING_AWAY,
+    PING,
+    SERVICE_RESTART,
+    ConnectionManager,
+)
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000, reason=None):
+        self.closed_with = (code, reason)
+
+
+@pytest.mark.anyio
+async def test_broadcast_only_reaches_channel():
+    manager = ConnectionManager()
+    websockets = [FakeWebSocket() for _ in range(3)]
+    await manager.connect(websockets[0], "a")
+    await manager.connect(websockets[1], "a")
+    await manager.connect(websockets[2], "b")
+
+    await manager.broadcast("hello", "a")
+    assert [websocket.sent for websocket in websockets] == [["hello"], ["hello"], []]
+
+
+@pytest.mark.anyio
+async def test_accepted_socket_waits_for_subscribe():
+    manager = ConnectionManager()
+    websocket = FakeWebSocket()
+    assert await manager.accept(websocket)
+    await manager.broadcast("hello", "a")
+    assert websocket.sent == []
+
+    manager.subscribe(websocket, "a")
+    manager.subscribe(websocket, "a")
+    await manager.broadcast("hello", "a")
+    assert websocket.sent == ["hello"]
+
+
+@pytest.mark.anyio
+async def test_drain_closes_connections_with_reconnect_delay():
+    manager = ConnectionManager()
+    websockets = [FakeWebSocket() for _ in range(5)]
+    for i, websocket in enumerate(websockets):
+        await manager.connect(websocket, f"chat_room_{i % 2}")
+    unauthenticated = FakeWebSocket()
+    await manager.accept(unauthenticated)
+    websockets.append(unauthenticated)
+
+    await manager.drain(deadline=0.1, batch_size=2, max_reconnect_delay=5)
+    for websocket in websockets:
+        code, reason = websocket.closed_with
+        assert code == SERVICE_RESTART
+        assert 0 <= json.loads(reason)["reconnect_after_ms"] <= 5000
+
+    late = FakeWebSocket()
+    assert not await manager.connect(late, "chat_room_0")
+    assert late.closed_with[0] == SERVICE_RESTART
+    assert late not in manager.active_connections["chat_room_0"]
+
+
+@pytest.mark.anyio
+async def test_heartbeat_reaps_silent_connections():
+    now = [0.0]
+    manager = ConnectionManager(wheel_size=2, clock=lambda: now[0])
+    silent, chatty = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(silent, "chat_room_0")
+    await manager.connect(chatty, "chat_room_0")
+
+    now[0] = 100
+    manager.touch(chatty)
+    for _ in range(2):  # One full turn of the wheel
+        await manager.check_heartbeats(timeout=10)
+
+    assert chatty.sent == [PING]
+    assert silent.closed_with[0] == GOING_AWAY
+    assert manager.active_connections["chat_room_0"] == [chatty]
+    assert manager.stats() == {"connections": 1, "channels": 1, "reaped_total": 1}
+
+
+@pytest.mark.anyio
+async def test_heartbeat_skips_sockets_disconnected_while_reaping():
+    manager = ConnectionManager(wheel_size=1)
+    first, second = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(first, "chat_room_0")
+    await manager.connect(second, "chat_room_0")
+
+    def closer(other):
+        async def close(code):
+            # The other socket's handler notices its disconnect meanwhile
+            manager.disconnect(other, "chat_room_0")
+
+        return close
+
+    first.close, second.close = closer(second), closer(first)
+    manager.last_seen[first] -= 100
+    manager.last_seen[second] -= 100
+    await manager.check_heartbeats(timeout=10)
+    assert manager.stats() == {"connections": 0, "channels": 0, "reaped_total": 1}
+
+
+@pytest.mark.anyio
+async def test_hot_channel_switches_to_batches_and_back():
+    now = [0.0]
+    manager = ConnectionManager(
+        batch_threshold=10, batch_interval=0.01, clock=lambda: now[0]
+    )
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, "a", batch=True)
+    legacy = FakeWebSocket()
+    await manager.connect(legacy, "a")
+
+    events = [json.dumps({"type": "message", "n": n}) for n in range(20)]
+    for event in events:
+        now[0] += 0.01  # 100 messages a second
+        await manager.broadcast(event, "a")
+    # The first ones go out alone until the rate crosses the threshold
+    direct = len(websocket.sent)
+    assert 0 < direct < 20
+    assert websocket.sent == events[:direct]
+    assert manager.channel_stats()["a"]["batching"]
+
+    await asyncio.sleep(0.05)
+    assert len(websocket.sent) == direct + 1
+    batch = json.loads(websocket.sent[-1])
+    assert batch["type"] == "batch"
+    assert batch["events"] == [json.loads(event) for event in events[direct:]]
+    stats = manager.channel_stats()["a"]
+    assert stats["messages"] == 20
+    assert stats["frames"] == direct + 1
+    assert stats["max_batch"] == 20 - direct
+    # Clients that did not opt in get the same messages one frame each
+    assert legacy.sent == events
+
+    # Once calm, messages go out on their own again
+    now[0] += 10
+    await manager.broadcast(events[0], "a")
+    assert websocket.sent[-1] == events[0]
+    assert not manager.channel_stats()["a"]["batching"]
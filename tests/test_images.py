@@ -1,6 +1,8 @@
 import pytest
 from fastapi import status
 
+from app import utils
+
 
 @pytest.mark.anyio
 async def test_show_image(client, testfs):
@@ -13,4 +15,31 @@ async def test_show_image(client, testfs):
     assert response.status_code == status.HTTP_200_OK
     assert response.headers.get("content-type") == "image/jpeg"
 
-    assert response.content
\ No newline at end of file
+    assert response.content
+
+@pytest.mark.anyio
+async def test_show_initials_avatar(client):
+    response = await client.get("/avatars/initials?name=Jane%20Doe")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers.get("content-type") == "image/svg+xml"
+    assert "immutable" in response.headers.get("cache-control")
+    assert b">JD</text>" in response.content
+
+    etag = response.headers.get("etag")
+    response = await client.get(
+        "/avatars/initials?name=Jane%20Doe", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+
+    response = await client.get(
+        "/avatars/initials?name=Jane%20Doe",
+        headers={"If-None-Match": f'"other", W/{etag}'},
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+
+def test_get_avatar_url_encodes_name():
+    assert utils.get_avatar_url(None, "A&B C").endswith(
+        "/avatars/initials?name=A%26B%20C"
+    )
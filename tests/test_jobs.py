@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from fastapi import status
+
+from app import jobs
+
+
+@pytest.mark.anyio
+async def test_enqueue_with_key_is_idempotent(testdb):
+    first = await jobs.enqueue(testdb, "noop", {"n": 1}, key="noop:1")
+    second = await jobs.enqueue(testdb, "noop", {"n": 2}, key="noop:1")
+    assert first["_id"] == second["_id"]
+    assert second["payload"] == {"n": 1}
+
+    # Once started the key is free again
+    await jobs.lease_job(testdb, "worker", 60)
+    third = await jobs.enqueue(testdb, "noop", {"n": 3}, key="noop:1")
+    assert third["_id"] != first["_id"]
+
+
+@pytest.mark.anyio
+async def test_exclusive_job_is_not_queued_while_running(testdb):
+    first = await jobs.enqueue(testdb, "sweep", key="sweep", exclusive=True)
+    job = await jobs.lease_job(testdb, "worker", 60)
+    again = await jobs.enqueue(testdb, "sweep", key="sweep", exclusive=True)
+    assert again["_id"] == first["_id"]
+    assert await jobs.lease_job(testdb, "other", 60) is None
+
+    await jobs.complete_job(testdb, job, None)
+    second = await jobs.enqueue(testdb, "sweep", key="sweep", exclusive=True)
+    assert second["_id"] != first["_id"]
+
+
+@pytest.mark.anyio
+async def test_lease_by_priority_and_expiry(testdb):
+    low = await jobs.enqueue(testdb, "noop", priority=0)
+    high = await jobs.enqueue(testdb, "noop", priority=5)
+    await jobs.enqueue(testdb, "noop", priority=9, delay=60)
+
+    assert (await jobs.lease_job(testdb, "a", 60))["_id"] == high["_id"]
+    assert (await jobs.lease_job(testdb, "a", 60))["_id"] == low["_id"]
+    assert await jobs.lease_job(testdb, "a", 60) is None
+
+    # A worker that stops renewing its lease loses the job
+    await testdb.jobs.update_one(
+        {"_id": low["_id"]},
+        {"$set": {"run_at": datetime.now(timezone.utc) - timedelta(seconds=1)}},
+    )
+    job = await jobs.lease_job(testdb, "b", 60)
+    assert job["_id"] == low["_id"]
+    assert job["attempts"] == 2
+
+
+@pytest.mark.anyio
+async def test_runner_retries_then_fails(testdb):
+    calls = []
+
+    async def flaky(db, payload):
+        calls.append(payload)
+        if len(calls) < 2:
+            raise RuntimeError("try again")
+        return {"calls": len(calls)}
+
+    async def broken(db, payload):
+        raise RuntimeError("always")
+
+    runner = jobs.JobRunner(testdb, {"flaky": flaky, "broken": broken}, 1)
+    flaky_job = await jobs.enqueue(testdb, "flaky", {"x": 1})
+    broken_job = await jobs.enqueue(testdb, "broken", max_attempts=1)
+
+    assert await runner.run_once("w")
+    assert await runner.run_once("w")
+    job = await jobs.get_job(testdb, flaky_job["_id"])
+    assert job["status"] == jobs.QUEUED
+    assert job["error"] == "RuntimeError('try again')"
+    # Stored dates come back naive, in UTC
+    assert job["run_at"] > datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=1)
+    job = await jobs.get_job(testdb, broken_job["_id"])
+    assert job["status"] == jobs.FAILED
+
+    await testdb.jobs.update_one(
+        {"_id": flaky_job["_id"]}, {"$set": {"run_at": datetime.now(timezone.utc)}}
+    )
+    assert await runner.run_once("w")
+    job = await jobs.get_job(testdb, flaky_job["_id"])
+    assert job["status"] == jobs.DONE
+    assert job["result"] == {"calls": 2}
+    assert not await runner.run_once("w")
+
+
+@pytest.mark.anyio
+async def test_runner_rate_limits_by_type(testdb):
+    ran = []
+
+    async def handler(db, payload):
+        ran.append(payload["n"])
+
+    runner = jobs.JobRunner(testdb, {"slow": handler}, 1, rate_limits={"slow": 0.01})
+    for n in range(2):
+        await jobs.enqueue(testdb, "slow", {"n": n})
+
+    assert await runner.run_once("w")
+    assert await runner.run_once("w")  # Released, not run
+    assert ran == [0]
+    assert runner.limited_types() == ["slow"]
+    assert not await runner.run_once("w")
+    job = await testdb.jobs.find_one({"status": jobs.QUEUED})
+    assert job["attempts"] == 0
+
+
+@pytest.mark.anyio
+async def test_display_name_change_job(
+    authorized_client, testdb, access_tokens, get_direct_chat_room
+):
+    client, user = authorized_client["client"], authorized_client["current_user"]
+    res = await testdb.users.insert_one({"email": "other@foobar.com", "display_name": "Other"})
+    other = await testdb.users.find_one({"_id": res.inserted_id})
+    chat_room = await get_direct_chat_room(user, other)
+
+    response = await client.put("/users/me/display_name", json={"display_name": "Jobbed"})
+    assert response.status_code == status.HTTP_200_OK
+    job_id = response.json()["job_id"]
+
+    response = await client.get(f"/jobs/{job_id}")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["type"] == "bump_direct_chat_rooms"
+    assert response.json()["status"] == jobs.QUEUED
+
+    assert await jobs.get_runner(testdb).run_once("w")
+    response = await client.get(f"/jobs/{job_id}")
+    assert response.json()["status"] == jobs.DONE
+    chat_room = await testdb.chat_rooms.find_one({"_id": chat_room["_id"]})
+    assert chat_room["version"] == 1
+
+    token = (await access_tokens([other]))[0]
+    response = await client.get(
+        f"/jobs/{job_id}", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = await client.get("/jobs/not-an-id")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
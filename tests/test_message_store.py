@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from bson import ObjectId
+from fastapi import status
+from pymongo.errors import DuplicateKeyError
+
+from app.main import app
+from app.message_store import BucketMessageStore, get_message_store
+from app.scripts.migrate_message_buckets import migrate
+
+
+@pytest.mark.anyio
+async def test_bucket_store_pages(testdb):
+    store = BucketMessageStore(bucket_size=3)
+    await store.create_indexes(testdb)
+    chat_room_id = ObjectId()
+    base_time = datetime.now(timezone.utc).replace(microsecond=0)
+    for i in range(10):
+        await store.insert_message(
+            testdb,
+            {
+                "content": f"Message {i}",
+                "chat_room_id": chat_room_id,
+                "user_id": ObjectId(),
+                "created_at": base_time + timedelta(seconds=i),
+                "seq": i + 1,
+            },
+        )
+    assert await testdb.message_buckets.count_documents({}) == 4
+
+    messages = await store.get_messages(testdb, chat_room_id, skip=0, limit=4)
+    assert [m["content"] for m in messages] == [f"Message {i}" for i in (9, 8, 7, 6)]
+
+    messages = await store.get_messages(testdb, chat_room_id, skip=8, limit=4)
+    assert [m["content"] for m in messages] == ["Message 1", "Message 0"]
+
+    messages = await store.get_messages(
+        testdb, chat_room_id, limit=2, before=base_time + timedelta(seconds=5)
+    )
+    assert [m["content"] for m in messages] == ["Message 4", "Message 3"]
+
+    messages = await store.get_messages_by_seq(testdb, chat_room_id, 2, 7, limit=4)
+    assert [m["seq"] for m in messages] == [2, 3, 4, 5]
+
+
+@pytest.mark.anyio
+async def test_migrate_to_buckets(testdb):
+    chat_room_id = ObjectId()
+    base_time = datetime.now(timezone.utc)
+    await testdb.messages.insert_many(
+        [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": chat_room_id,
+                "user_id": ObjectId(),
+                "created_at": base_time + timedelta(seconds=i),
+            }
+            for i in range(5)
+        ]
+    )
+    assert await migrate(testdb, drop_source=True) == 5
+    assert await testdb.messages.count_documents({}) == 0
+    bucket = await testdb.message_buckets.find_one({"chat_room_id": chat_room_id})
+    assert bucket["count"] == 5
+
+
+@pytest.mark.anyio
+async def test_migrate_resumes_a_partly_bucketed_room(testdb):
+    chat_room_id = ObjectId()
+    base_time = datetime.now(timezone.utc).replace(microsecond=0)
+    messages = [
+        {
+            "_id": ObjectId(),
+            "content": f"Message {i}",
+            "chat_room_id": chat_room_id,
+            "user_id": ObjectId(),
+            # Two messages share a timestamp across the interruption point
+            "created_at": base_time + timedelta(seconds=min(i, 2)),
+        }
+        for i in range(5)
+    ]
+    await testdb.messages.insert_many(messages)
+    store = BucketMessageStore()
+    await store.insert_bucket(testdb, chat_room_id, messages[:3])
+
+    assert await migrate(testdb) == 2
+    contents = [
+        message["content"]
+        async for bucket in testdb.message_buckets.find({"chat_room_id": chat_room_id})
+        for message in bucket["messages"]
+    ]
+    assert sorted(contents) == [f"Message {i}" for i in range(5)]
+
+
+@pytest.mark.anyio
+async def test_messages_api_with_bucket_store(
+    client, sample_users, access_tokens, get_direct_chat_room
+):
+    store = BucketMessageStore()
+    app.dependency_overrides[get_message_store] = lambda: store
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+
+    for i in range(3):
+        response = await client.post(
+            "/messages",
+            json={"content": f"Message {i}", "chat_room_id": str(direct_chat_room["_id"])},
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+    response = await client.get(
+        f"/messages?chat_room_id={str(direct_chat_room['_id'])}&page=1&page_size=2"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    messages = response.json().get("messages")
+    assert [m.get("content") for m in messages] == ["Message 2", "Message 1"]
+    assert messages[0].get("user_id") == str(users[0]["_id"])
+
+
+@pytest.mark.anyio
+async def test_bucket_store_rejects_duplicate_client_message_id(testdb):
+    store = BucketMessageStore()
+    await store.create_indexes(testdb)
+    message = {
+        "content": "hello",
+        "chat_room_id": ObjectId(),
+        "user_id": ObjectId(),
+        "created_at": datetime.now(timezone.utc),
+        "client_message_id": "7f7e5c1a",
+    }
+    stored = await store.insert_message(testdb, dict(message))
+    with pytest.raises(DuplicateKeyError):
+        await store.insert_message(testdb, dict(message))
+
+    found = await store.find_by_client_message_id(
+        testdb, message["chat_room_id"], message["user_id"], "7f7e5c1a"
+    )
+    assert found["_id"] == stored["_id"]
+
+
+@pytest.mark.anyio
+async def test_bucket_store_updates_message_in_place(testdb):
+    store = BucketMessageStore(bucket_size=3)
+    await store.create_indexes(testdb)
+    chat_room_id = ObjectId()
+    user_id = ObjectId()
+    messages = [
+        await store.insert_message(
+            testdb,
+            {
+                "content": f"Message {i}",
+                "chat_room_id": chat_room_id,
+                "user_id": user_id,
+                "created_at": datetime.now(timezone.utc),
+            },
+        )
+        for i in range(2)
+    ]
+    message = await store.update_message(
+        testdb,
+        chat_room_id,
+        messages[1]["_id"],
+        {"$set": {"content": "edited", "sync_seq": 7}, "$inc": {"version": 1}},
+        match={"user_id": user_id},
+    )
+    assert message["content"] == "edited"
+    assert message["version"] == 1
+    assert (await store.find_message(testdb, chat_room_id, messages[0]["_id"]))[
+        "content"
+    ] == "Message 0"
+    bucket = await testdb.message_buckets.find_one({"chat_room_id": chat_room_id})
+    assert bucket["last_seq"] == 7
+
+    assert (
+        await store.update_message(
+            testdb,
+            chat_room_id,
+            messages[0]["_id"],
+            {"$set": {"content": "edited"}},
+            match={"user_id": ObjectId()},
+        )
+        is None
+    )
@@ -1,7 +1,13 @@
+import json
 from datetime import datetime, timedelta, timezone
 import pytest
 from fastapi import status
 
+from app import archive, helpers
+from app.config import settings
+from app.message_store import DocumentMessageStore
+from app.scripts import backfill_message_seqs
+
 
 @pytest.mark.anyio
 async def test_create_message(
@@ -104,3 +110,357 @@ async def test_get_messages_in_wrong_chat_room(
         f"/messages?chat_room_id={str(direct_chat_room.inserted_id)}"
     )
     assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.anyio
+async def test_create_message_in_group_chat_room(
+    client, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(3)
+    access_tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room(users[:2])
+
+    client.headers = {"Authorization": f"Bearer {access_tokens[1]}"}
+    response = await client.post(
+        "/messages",
+        json={"content": "hello", "chat_room_id": str(group_chat_room["_id"])},
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+
+    client.headers = {"Authorization": f"Bearer {access_tokens[2]}"}
+    response = await client.post(
+        "/messages",
+        json={"content": "hello", "chat_room_id": str(group_chat_room["_id"])},
+    )
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.anyio
+async def test_export_and_import_messages(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    base_time = datetime.now(timezone.utc)
+    await testdb.messages.insert_many(
+        [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": direct_chat_room["_id"],
+                "user_id": users[i % 2]["_id"],
+                "created_at": base_time + timedelta(seconds=i),
+            }
+            for i in range(3)
+        ]
+    )
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+
+    response = await client.get(
+        f"/chat_rooms/{str(direct_chat_room['_id'])}/messages/export"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers.get("content-type") == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0]).get("content") == "Message 0"
+
+    own_lines = [
+        line for line in lines if json.loads(line)["user_id"] == str(users[0]["_id"])
+    ]
+    response = await client.post(
+        f"/chat_rooms/{str(direct_chat_room['_id'])}/messages/import",
+        content="\n".join(own_lines).encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"imported": 2, "skipped": 0}
+    imported = await testdb.messages.find({"seq": {"$exists": True}}).to_list(None)
+    assert {message["content"] for message in imported} == {"Message 0", "Message 2"}
+    # Exported ids are not reused, the copies are new messages
+    assert not {str(message["_id"]) for message in imported} & {
+        json.loads(line)["_id"] for line in own_lines
+    }
+
+    response = await client.post(
+        f"/chat_rooms/{str(direct_chat_room['_id'])}/messages/import",
+        content=b'{"content": "no author"}\n',
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_import_as_another_user(
+    client, testdb, sample_users, access_tokens, get_group_chat_room
+):
+    users = await sample_users(3)
+    access_tokens = await access_tokens(users)
+    group_chat_room = await get_group_chat_room(users[:2])
+    await testdb.chat_rooms.update_one(
+        {"_id": group_chat_room["_id"]}, {"$set": {"owner_id": users[0]["_id"]}}
+    )
+
+    def ndjson(user):
+        return json.dumps(
+            {
+                "content": "hello",
+                "user_id": str(user["_id"]),
+                "created_at": "2020-01-01T00:00:00Z",
+            }
+        ).encode()
+
+    url = f"/chat_rooms/{group_chat_room['_id']}/messages/import"
+    client.headers = {"Authorization": f"Bearer {access_tokens[1]}"}
+    response = await client.post(url, content=ndjson(users[0]))
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert await testdb.messages.count_documents({}) == 0
+
+    # The owner may import for members, but not for outsiders
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    response = await client.post(url, content=ndjson(users[1]))
+    assert response.json() == {"imported": 1, "skipped": 0}
+    response = await client.post(url, content=ndjson(users[2]))
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.anyio
+async def test_create_message_is_idempotent(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    payload = {
+        "content": "hello",
+        "chat_room_id": str(direct_chat_room["_id"]),
+        "client_message_id": "7f7e5c1a",
+    }
+
+    first = await client.post("/messages", json=payload)
+    assert first.status_code == status.HTTP_201_CREATED
+    assert first.json().get("client_message_id") == "7f7e5c1a"
+
+    helpers.get_message_dedupe_cache().clear()  # Force the unique index path
+    second = await client.post("/messages", json=payload)
+    third = await client.post("/messages", json=payload)
+    assert second.json().get("_id") == first.json().get("_id")
+    assert third.json().get("_id") == first.json().get("_id")
+    assert await testdb.messages.count_documents({}) == 1
+    # Retries take no number, the next message follows on
+    chat_room = await testdb.chat_rooms.find_one({"_id": direct_chat_room["_id"]})
+    assert chat_room["last_message_seq"] == 1
+
+
+@pytest.mark.anyio
+async def test_client_message_id_reused_in_another_room(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room, get_group_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    group_chat_room = await get_group_chat_room(users)
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    payload = {"content": "hello", "client_message_id": "7f7e5c1a"}
+
+    response = await client.post(
+        "/messages", json={**payload, "chat_room_id": str(direct_chat_room["_id"])}
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    response = await client.post(
+        "/messages", json={**payload, "chat_room_id": str(group_chat_room["_id"])}
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+    helpers.get_message_dedupe_cache().clear()
+    response = await client.post(
+        "/messages", json={**payload, "chat_room_id": str(group_chat_room["_id"])}
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert await testdb.messages.count_documents({}) == 1
+
+
+@pytest.mark.anyio
+async def test_get_messages_with_users(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    await testdb.messages.insert_many(
+        [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": direct_chat_room["_id"],
+                "user_id": users[i % 2]["_id"],
+                "created_at": datetime.now(timezone.utc),
+            }
+            for i in range(4)
+        ]
+    )
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+
+    response = await client.get(
+        f"/messages?chat_room_id={str(direct_chat_room['_id'])}&include_users=true"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    senders = response.json().get("users")
+    assert sorted(user.get("display_name") for user in senders) == ["User 0", "User 1"]
+    assert all("avatar_url" in user for user in senders)
+
+
+@pytest.mark.anyio
+async def test_edit_delete_and_react(
+    client, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    tokens = await access_tokens(users)
+    chat_room_id = str((await get_direct_chat_room(users[0], users[1]))["_id"])
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post(
+        "/messages", json={"content": "helo", "chat_room_id": chat_room_id}
+    )
+    message_id = response.json()["_id"]
+
+    response = await client.patch(
+        f"/messages/{message_id}", json={"content": "hello", "chat_room_id": chat_room_id}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    patch = response.json()
+    assert patch["version"] == 1
+    assert patch["patch"]["content"] == "hello"
+
+    # Only the author may edit
+    client.headers = {"Authorization": f"Bearer {tokens[1]}"}
+    response = await client.patch(
+        f"/messages/{message_id}", json={"content": "nope", "chat_room_id": chat_room_id}
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    for _ in range(2):  # Reacting twice counts once
+        response = await client.post(
+            f"/messages/{message_id}/reactions",
+            json={"emoji": "👍", "chat_room_id": chat_room_id},
+        )
+        assert response.json()["patch"] == {"reactions": {"👍": 1}}
+    client.headers = {"Authorization": f"Bearer {tokens[0]}"}
+    response = await client.post(
+        f"/messages/{message_id}/reactions", json={"emoji": "👍", "chat_room_id": chat_room_id}
+    )
+    assert response.json()["patch"] == {"reactions": {"👍": 2}}
+    assert response.json()["version"] == 3
+    response = await client.delete(
+        f"/messages/{message_id}/reactions/👍", params={"chat_room_id": chat_room_id}
+    )
+    assert response.json()["patch"] == {"reactions": {"👍": 1}}
+
+    response = await client.get("/messages", params={"chat_room_id": chat_room_id})
+    [message] = response.json()["messages"]
+    assert message["content"] == "hello"
+    assert message["reactions"] == {"👍": 1}
+    assert message["version"] == 4
+    assert message["edited_at"] is not None
+
+    response = await client.delete(
+        f"/messages/{message_id}", params={"chat_room_id": chat_room_id}
+    )
+    assert response.json()["patch"]["deleted"] is True
+    response = await client.get("/messages", params={"chat_room_id": chat_room_id})
+    [message] = response.json()["messages"]
+    assert message["deleted"] is True
+    assert message["content"] == ""
+
+
+@pytest.mark.anyio
+async def test_messages_get_room_sequence_numbers(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room
+):
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    chat_room_id = str(direct_chat_room["_id"])
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+
+    seqs = []
+    for i in range(4):
+        response = await client.post(
+            "/messages", json={"content": f"Message {i}", "chat_room_id": chat_room_id}
+        )
+        seqs.append(response.json().get("seq"))
+    assert seqs == [1, 2, 3, 4]
+
+    response = await client.get(
+        f"/messages?chat_room_id={chat_room_id}&from_seq=2&to_seq=3"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert [message["seq"] for message in response.json()["messages"]] == [2, 3]
+    assert response.json()["last_seq"] == 4
+
+    # A failed write leaves a hole, the range read shows it is not coming
+    await testdb.messages.delete_one({"seq": 3})
+    response = await client.get(
+        f"/messages?chat_room_id={chat_room_id}&from_seq=2&page_size=10"
+    )
+    assert [message["seq"] for message in response.json()["messages"]] == [2, 4]
+
+    response = await client.post(
+        f"/chat_rooms/{chat_room_id}/messages/import",
+        content=b"".join(
+            json.dumps(
+                {"content": f"Imported {i}", "created_at": "2020-01-01T00:00:00Z"}
+            ).encode()
+            + b"\n"
+            for i in range(2)
+        ),
+    )
+    assert response.status_code == status.HTTP_200_OK
+    imported = await testdb.messages.find({"content": {"$regex": "^Imported"}}).to_list(None)
+    assert sorted(message["seq"] for message in imported) == [5, 6]
+
+
+@pytest.mark.anyio
+async def test_backfill_numbers_earlier_history(
+    client, testdb, sample_users, access_tokens, get_direct_chat_room, monkeypatch
+):
+    monkeypatch.setattr(settings, "sync_settle_seconds", 0)
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    direct_chat_room = await get_direct_chat_room(users[0], users[1])
+    chat_room_id = str(direct_chat_room["_id"])
+    base_time = datetime.now(timezone.utc)
+    await testdb.messages.insert_many(
+        [
+            {
+                "content": f"Message {i}",
+                "chat_room_id": direct_chat_room["_id"],
+                "user_id": users[0]["_id"],
+                # The first two are old enough to be archived
+                "created_at": base_time - timedelta(days=1000 if i < 2 else 1, seconds=-i),
+            }
+            for i in range(4)
+        ]
+    )
+    await archive.archive_messages(testdb, DocumentMessageStore())
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    response = await client.post(
+        "/messages", json={"content": "Message 4", "chat_room_id": chat_room_id}
+    )
+    assert response.json()["seq"] == 1
+
+    assert await backfill_message_seqs.backfill(testdb) == 4
+    assert await backfill_message_seqs.backfill(testdb) == 0
+    response = await client.get(f"/messages?chat_room_id={chat_room_id}&from_seq=1")
+    messages = response.json()["messages"]
+    assert [message["seq"] for message in messages] == [1, 2, 3, 4, 5]
+    assert [message["content"] for message in messages] == [f"Message {i}" for i in range(5)]
+    assert response.json()["last_seq"] == 5
+
+
+@pytest.mark.anyio
+async def test_release_message_seqs_only_the_last(testdb, sample_users, get_group_chat_room):
+    chat_room = await get_group_chat_room(await sample_users(1))
+    first = await helpers.allocate_message_seqs(testdb, chat_room["_id"])
+    assert await helpers.release_message_seqs(testdb, chat_room["_id"], first)
+    assert await helpers.allocate_message_seqs(testdb, chat_room["_id"]) == first
+
+    await helpers.allocate_message_seqs(testdb, chat_room["_id"])
+    assert not await helpers.release_message_seqs(testdb, chat_room["_id"], first)
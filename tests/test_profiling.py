@@ -0,0 +1,94 @@
+import os
+import pytest
+from fastapi import status
+
+from app import profiling
+from app.config import Settings, settings
+
+
+@pytest.mark.anyio
+async def test_profile_requested_by_header(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "profile_token", "secret")
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "profile_interval_seconds", 0.001)
+
+    response = await client.get("/")
+    assert response.status_code == status.HTTP_200_OK
+    assert os.listdir(tmp_path) == []
+
+    response = await client.get("/", headers={"X-Profile": "secret"})
+    assert response.status_code == status.HTTP_200_OK
+    [name] = os.listdir(tmp_path)
+    assert name.endswith("-GET-root.folded")
+    for line in (tmp_path / name).read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+
+def test_summarize_plan():
+    plan = {
+        "stage": "LIMIT",
+        "inputStage": {
+            "stage": "FETCH",
+            "inputStage": {"stage": "IXSCAN", "keyPattern": {"chat_room_id": 1}},
+        },
+    }
+    assert profiling.summarize_plan(plan) == 'LIMIT > FETCH > IXSCAN {"chat_room_id": 1}'
+
+
+def test_filters_with_different_values_share_a_shape():
+    assert profiling.shape_of({"chat_room_id": 1, "created_at": {"$lt": 2}}) == (
+        profiling.shape_of({"created_at": {"$lt": 3}, "chat_room_id": 4})
+    )
+    assert profiling.shape_of({"a": 1}) != profiling.shape_of({"b": 1})
+
+
+def test_loop_lag_monitor_keeps_max():
+    monitor = profiling.LoopLagMonitor(interval=1, warn_after=1)
+    monitor.record(0.2)
+    monitor.record(0.05)
+    assert monitor.stats() == {"last_ms": 50.0, "max_ms": 200.0, "samples": 2}
+
+
+def test_plan_problems():
+    indexed = {
+        "queryPlanner": {
+            "winningPlan": {
+                "stage": "LIMIT",
+                "inputStage": {
+                    "stage": "FETCH",
+                    "inputStage": {"stage": "IXSCAN", "keyPattern": {"chat_room_id": 1}},
+                },
+            }
+        },
+        "executionStats": {"nReturned": 25, "totalDocsExamined": 25},
+    }
+    assert profiling.plan_problems(indexed, max_docs_examined_ratio=10) == []
+
+    scanned = {
+        "stages": [
+            {
+                "$cursor": {
+                    "queryPlanner": {
+                        "winningPlan": {
+                            "queryPlan": {
+                                "stage": "SORT",
+                                "inputStage": {"stage": "COLLSCAN"},
+                            }
+                        }
+                    },
+                    "executionStats": {"nReturned": 1, "totalDocsExamined": 500},
+                }
+            },
+            {"$sort": {"created_at": -1}},
+        ]
+    }
+    assert profiling.plan_problems(scanned, max_docs_examined_ratio=10) == [
+        "collection scan",
+        "in-memory sort",
+        "examined 500 documents for 1 returned",
+    ]
+
+
+def test_slow_op_listener_is_opt_in():
+    assert Settings.model_fields["slow_op_threshold_ms"].default == 0
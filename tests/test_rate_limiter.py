@@ -0,0 +1,101 @@
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException, status
+
+from app import rate_limiter
+from app.rate_limiter import RateLimiter
+from .conftest import password
+
+
+def test_token_bucket_refills():
+    now = [0.0]
+    limiter = RateLimiter(rate=1, burst=2, clock=lambda: now[0])
+    assert limiter.hit("foo") == 0
+    assert limiter.hit("foo") == 0
+    assert limiter.hit("foo") == pytest.approx(1)
+    assert limiter.hit("bar") == 0
+
+    now[0] = 1.5
+    assert limiter.hit("foo") == 0
+    assert limiter.hit("foo") > 0
+
+
+def test_token_bucket_evicts_least_recent_keys():
+    limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.hit(key)
+    assert list(limiter.buckets) == ["b", "c"]
+
+
+@pytest.mark.anyio
+async def test_login_rate_limited(client, sample_users):
+    user = (await sample_users(1))[0]
+    for _ in range(5):
+        response = await client.post(
+            "/auth/login", data={"username": user["email"], "password": "invalid"}
+        )
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    response = await client.post(
+        "/auth/login", data={"username": user["email"], "password": password}
+    )
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert "Retry-After" in response.headers
+
+
+@pytest.mark.anyio
+async def test_login_rate_charges_failures_per_host(client, sample_users):
+    user = (await sample_users(1))[0]
+    for _ in range(10):
+        response = await client.post(
+            "/auth/login", data={"username": user["email"], "password": password}
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+    for _ in range(5):
+        rate_limiter.record_login_failure(user["email"], "203.0.113.7")
+    with pytest.raises(HTTPException):
+        rate_limiter.check_login_rate(user["email"], "203.0.113.7")
+    response = await client.post(
+        "/auth/login", data={"username": user["email"], "password": password}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.anyio
+async def test_message_rate_not_charged_for_missing_rooms(
+    client, sample_users, access_tokens, monkeypatch
+):
+    monkeypatch.setitem(
+        rate_limiter.get_limiters(), "user_message", RateLimiter(rate=0.01, burst=1)
+    )
+    users = await sample_users(1)
+    access_tokens = await access_tokens(users)
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    for _ in range(3):
+        response = await client.post(
+            "/messages", json={"content": "Hello", "chat_room_id": str(ObjectId())}
+        )
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_login_host_limit_charged_only_on_failures(monkeypatch):
+    monkeypatch.setitem(
+        rate_limiter.get_limiters(), "host_login", RateLimiter(rate=0.01, burst=2)
+    )
+    for _ in range(5):
+        rate_limiter.check_login_rate("someone@example.com", "198.51.100.1")
+    rate_limiter.record_login_failure("a@example.com", "198.51.100.1")
+    rate_limiter.record_login_failure("b@example.com", "198.51.100.1")
+    with pytest.raises(HTTPException):
+        rate_limiter.check_login_rate("someone@example.com", "198.51.100.1")
+
+
+def test_message_rate_refused_by_room_keeps_user_budget(monkeypatch):
+    limiters = rate_limiter.get_limiters()
+    monkeypatch.setitem(limiters, "user_message", RateLimiter(rate=0.01, burst=1))
+    monkeypatch.setitem(limiters, "room_message", RateLimiter(rate=0.01, burst=1))
+    rate_limiter.check_message_rate("other", "room")
+    with pytest.raises(HTTPException):
+        rate_limiter.check_message_rate("user", "room")
+    rate_limiter.check_message_rate("user", "another room")
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+import pytest
+from bson import Timestamp
+from fastapi import HTTPException, Response
+
+from app import replicas
+from app.config import settings
+
+
+@pytest.mark.anyio
+async def test_read_session_follows_causal_token(monkeypatch):
+    monkeypatch.setattr(settings, "read_from_secondaries", True)
+    started = []
+
+    class FakeSession:
+        operation_time = None
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        def advance_operation_time(self, operation_time):
+            self.operation_time = operation_time
+
+    async def start_session(causal_consistency):
+        started.append(causal_consistency)
+        return FakeSession()
+
+    db = SimpleNamespace(client=SimpleNamespace(start_session=start_session))
+    request = SimpleNamespace(headers={"X-Causal-Token": "1700000000.3"})
+    sessions = replicas.get_read_session(request, db)
+    session = await anext(sessions)
+    assert started == [True]
+    assert session.operation_time == Timestamp(1700000000, 3)
+
+    response = Response()
+    replicas.set_causal_token(response, session)
+    assert response.headers["X-Causal-Token"] == "1700000000.3"
+    with pytest.raises(HTTPException):
+        replicas.decode_causal_token("latest")
+
+
+@pytest.mark.anyio
+async def test_write_session_without_secondaries(monkeypatch):
+    monkeypatch.setattr(settings, "read_from_secondaries", False)
+    async with replicas.write_session(SimpleNamespace()) as session:
+        assert session is None
+    assert replicas.causal_token(session) is None
@@ -1,5 +1,6 @@
 from fastapi.testclient import TestClient
 import pytest
+from app.config import settings
 from app.main import app
 
 
@@ -13,3 +14,36 @@ async def test_root(client):
 async def test_db(client):
     response = await client.get("/db")
     assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_connection_stats(client, monkeypatch, tmp_path):
+    response = await client.get("/stats/connections")
+    assert response.status_code == 403
+
+    monkeypatch.setattr(settings, "profile_token", "secret")
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path))
+    response = await client.get("/stats/connections", headers={"X-Profile": "secret"})
+    assert response.status_code == 200
+    assert "reaped_total" in response.json()
+
+
+@pytest.mark.anyio
+async def test_cors_exposes_response_headers(client):
+    response = await client.get("/", headers={"Origin": "http://localhost:5173"})
+    exposed = response.headers["Access-Control-Expose-Headers"]
+    assert "X-Causal-Token" in exposed
+    assert "Retry-After" in exposed
+
+
+@pytest.mark.anyio
+async def test_channel_stats_need_profile_token(client, monkeypatch, tmp_path):
+    response = await client.get("/stats/channels")
+    assert response.status_code == 403
+
+    monkeypatch.setattr(settings, "profile_token", "secret")
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path))
+    response = await client.get("/stats/channels", headers={"X-Profile": "wrong"})
+    assert response.status_code == 403
+    response = await client.get("/stats/channels", headers={"X-Profile": "secret"})
+    assert response.status_code == 200
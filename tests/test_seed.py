@@ -0,0 +1,29 @@
+import pytest
+
+from app.scripts import seed
+
+
+@pytest.mark.anyio
+async def test_seed(testdb):
+    counts = await seed.seed(testdb, users=50, rooms=20, messages=300, batch_size=40)
+    assert counts["users"] == await testdb.users.count_documents({})
+    assert counts["chat_rooms"] == await testdb.chat_rooms.count_documents({})
+    assert counts["members"] == await testdb.chat_room_members.count_documents({})
+    assert counts["messages"] == 300 == await testdb.messages.count_documents({})
+
+    senders = {}
+    async for chat_room in testdb.chat_rooms.find():
+        if chat_room["type"] == "direct":
+            senders[chat_room["_id"]] = set(chat_room["user_ids"])
+        else:
+            members = await testdb.chat_room_members.find(
+                {"chat_room_id": chat_room["_id"]}
+            ).to_list(length=None)
+            assert len(members) == chat_room["member_count"]
+            senders[chat_room["_id"]] = {member["user_id"] for member in members}
+    async for message in testdb.messages.find():
+        assert message["user_id"] in senders[message["chat_room_id"]]
+
+    async for chat_room in testdb.chat_rooms.find({"last_message_seq": {"$exists": True}}):
+        seqs = await testdb.messages.distinct("seq", {"chat_room_id": chat_room["_id"]})
+        assert sorted(seqs) == list(range(1, chat_room["last_message_seq"] + 1))
@@ -0,0 +1,43 @@
+import os
+import signal
+import pytest
+
+from app import server
+from app.config import Settings, settings
+
+
+def test_uvicorn_options_fall_back_when_not_installed(monkeypatch):
+    monkeypatch.setattr(settings, "server_workers", 3)
+    monkeypatch.setattr(settings, "server_loop", "not_an_installed_loop")
+    monkeypatch.setattr(settings, "server_http", "h11")
+    options = server.uvicorn_options()
+    assert options["workers"] == 3
+    assert options["loop"] == "auto"
+    assert options["http"] == "h11"
+
+
+@pytest.mark.anyio
+async def test_worker_recycles_after_max_requests(monkeypatch):
+    monkeypatch.setattr(settings, "server_workers", 2)
+    monkeypatch.setattr(settings, "server_max_requests", 2)
+    monkeypatch.setattr(settings, "server_max_requests_jitter", 0)
+    kills = []
+    monkeypatch.setattr(server.os, "kill", lambda pid, sig: kills.append((pid, sig)))
+    served = []
+
+    async def app(scope, receive, send):
+        served.append(scope["type"])
+
+    middleware = server.MaxRequestsMiddleware(app)
+    await middleware({"type": "websocket"}, None, None)
+    await middleware({"type": "http"}, None, None)
+    assert kills == []
+    await middleware({"type": "http"}, None, None)
+    await middleware({"type": "http"}, None, None)
+    assert served == ["websocket", "http", "http", "http"]
+    assert kills == [(os.getpid(), signal.SIGTERM)]
+
+
+def test_single_worker_by_default():
+    # Broadcasts are per process, more workers would split the rooms
+    assert Settings.model_fields["server_workers"].default == 1
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+from app.scripts.startup_benchmark import measure_import
+
+
+def test_import_defers_settings_and_heavy_modules():
+    # A bare environment: importing must not read settings or connect
+    snippet = (
+        "import sys, app.main\n"
+        "from app.config import get_settings\n"
+        "from app.database import get_client\n"
+        "assert get_settings.cache_info().currsize == 0\n"
+        "assert get_client.cache_info().currsize == 0\n"
+        "assert 'passlib' not in sys.modules\n"
+        "assert 'uvicorn' not in sys.modules\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", snippet], capture_output=True, text=True, env={}
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_measure_import():
+    assert measure_import() > 0
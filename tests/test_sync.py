@@ -0,0 +1,74 @@
+import pytest
+from fastapi import status
+
+from app.config import settings
+
+
+@pytest.mark.anyio
+async def test_sync_returns_only_changes_since_token(
+    client, sample_users, access_tokens, monkeypatch
+):
+    monkeypatch.setattr(settings, "sync_settle_seconds", 0)
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    response = await client.post(
+        "/chat_rooms/group",
+        json={"name": "Team", "user_ids": [str(users[1]["_id"])]},
+    )
+    chat_room_id = response.json()["_id"]
+    await client.post("/messages", json={"content": "first", "chat_room_id": chat_room_id})
+
+    response = await client.get("/sync")
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["chat_room_ids"] == [chat_room_id]
+    assert [chat_room["_id"] for chat_room in data["chat_rooms"]] == [chat_room_id]
+    assert [m["content"] for m in data["messages"][0]["messages"]] == ["first"]
+    assert data["me"]["_id"] == str(users[0]["_id"])
+
+    response = await client.get("/sync", params={"since": data["next_token"]})
+    data = response.json()
+    assert data["chat_rooms"] == []
+    assert data["messages"] == []
+    assert data["me"] is None
+
+    await client.post("/messages", json={"content": "second", "chat_room_id": chat_room_id})
+    response = await client.get("/sync", params={"since": data["next_token"]})
+    data = response.json()
+    assert data["messages"][0]["chat_room_id"] == chat_room_id
+    assert [m["content"] for m in data["messages"][0]["messages"]] == ["second"]
+    assert data["messages"][0]["has_more"] is False
+
+
+@pytest.mark.anyio
+async def test_sync_rejects_invalid_token(authorized_client):
+    client = authorized_client["client"]
+    response = await client.get("/sync", params={"since": "not-a-token"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_sync_resumes_truncated_rooms(client, sample_users, access_tokens, monkeypatch):
+    monkeypatch.setattr(settings, "sync_settle_seconds", 0)
+    users = await sample_users(2)
+    access_tokens = await access_tokens(users)
+    client.headers = {"Authorization": f"Bearer {access_tokens[0]}"}
+    response = await client.post(
+        "/chat_rooms/group",
+        json={"name": "Team", "user_ids": [str(users[1]["_id"])]},
+    )
+    chat_room_id = response.json()["_id"]
+    token = (await client.get("/sync")).json()["next_token"]
+
+    for i in range(5):
+        await client.post("/messages", json={"content": f"m{i}", "chat_room_id": chat_room_id})
+    received = []
+    for _ in range(5):
+        data = (await client.get("/sync", params={"since": token, "message_limit": 2})).json()
+        token = data["next_token"]
+        for room in data["messages"]:
+            received += [m["content"] for m in room["messages"] if m["content"] not in received]
+        if not any(room["has_more"] for room in data["messages"]):
+            break
+    assert received == [f"m{i}" for i in range(5)]
@@ -1,6 +1,12 @@
+from types import SimpleNamespace
 import pytest
+from bson import ObjectId
 from fastapi import status
 
+from app import avatar_store
+from app.config import settings
+from app.loaders import UserLoader
+
 
 @pytest.mark.anyio
 async def test_change_avatar(authorized_client, testdb):
@@ -19,6 +25,56 @@ async def test_change_avatar(authorized_client, testdb):
     assert str(user.get("avatar_file_id")) == file_id
 
 
+@pytest.mark.anyio
+async def test_avatars_are_deduplicated_and_swept(
+    client, testdb, testfs, sample_users, access_tokens, monkeypatch
+):
+    users = await sample_users(3)
+    tokens = await access_tokens(users)
+
+    async def change_avatar(token, content):
+        response = await client.put(
+            "/users/me/avatar",
+            files={"file": ("avatar.jpeg", content, "image/jpeg")},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.status_code == status.HTTP_200_OK
+        return ObjectId(response.json()["file_id"])
+
+    with open("tests/sample_avatar.jpeg", "rb") as f:
+        sample = f.read()
+    first = await change_avatar(tokens[0], sample)
+    assert await change_avatar(tokens[1], sample) == first
+    assert await testdb["fs.files"].count_documents({}) == 1
+    blob = await testdb.avatar_blobs.find_one({"file_id": first})
+    assert blob["refs"] == 2
+
+    second = await change_avatar(tokens[0], b"another picture")
+    assert second != first
+    assert (await testdb.avatar_blobs.find_one({"file_id": first}))["refs"] == 1
+
+    # An avatar from before hashing is swept once replaced, other files never
+    orphan = await testfs.upload_from_stream(
+        "old.jpeg", b"old", metadata={"content_type": "image/jpeg"}
+    )
+    await testdb.users.update_one(
+        {"_id": users[2]["_id"]}, {"$set": {"avatar_file_id": orphan}}
+    )
+    unrelated = await testfs.upload_from_stream(
+        "sample.jpeg", b"sample", metadata={"content_type": "image/jpeg"}
+    )
+    await change_avatar(tokens[1], b"another picture")
+    await change_avatar(tokens[2], b"another picture")
+    assert (await testdb.avatar_blobs.find_one({"file_id": second}))["refs"] == 3
+
+    assert await avatar_store.sweep_avatars(testdb, testfs, batch_size=1) == 0
+    monkeypatch.setattr(settings, "avatar_gc_grace_seconds", 0)
+    assert await avatar_store.sweep_avatars(testdb, testfs, batch_size=1) == 2
+    remaining = await testdb["fs.files"].distinct("_id")
+    assert sorted(remaining) == sorted([second, unrelated])
+    assert await testdb["fs.chunks"].count_documents({"files_id": {"$in": [first, orphan]}}) == 0
+
+
 # @pytest.mark.anyio
 # async def test_change_avatar_unauthorized(client, sample_user, sample_user_token):
 #     pass
@@ -61,4 +117,66 @@ async def test_search_users(client, sample_users):
     search_users = response.json().get("users")
     print(response.json())
     assert len(search_users) == 1
-    assert search_users[0].get("email") == users[0].get("email")
\ No newline at end of file
+    assert search_users[0].get("email") == users[0].get("email")
+
+@pytest.mark.anyio
+async def test_show_user_conditional_get(client, sample_users, access_tokens):
+    user = (await sample_users(1))[0]
+    response = await client.get(f"/users/{user.get('_id')}")
+    etag = response.headers.get("etag")
+    assert etag
+
+    response = await client.get(
+        f"/users/{user.get('_id')}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    token = (await access_tokens([user]))[0]
+    await client.put(
+        "/users/me/display_name",
+        json={"display_name": "Renamed"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    response = await client.get(
+        f"/users/{user.get('_id')}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json().get("display_name") == "Renamed"
+
+
+@pytest.mark.anyio
+async def test_get_users_by_ids(client, sample_users, access_tokens):
+    users = await sample_users(3)
+    ids = f"{users[0]['_id']},{users[2]['_id']},{users[0]['_id']}"
+    response = await client.get(f"/users?ids={ids}")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    token = (await access_tokens([users[1]]))[0]
+    client.headers = {"Authorization": f"Bearer {token}"}
+    response = await client.get(f"/users?ids={ids}")
+    assert response.status_code == status.HTTP_200_OK
+    found = response.json().get("users")
+    assert sorted(user["_id"] for user in found) == sorted(
+        [str(users[0]["_id"]), str(users[2]["_id"])]
+    )
+    assert all("email" not in user for user in found)
+
+    response = await client.get("/users?ids=foo")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_user_loader_batches_lookups(testdb, sample_users):
+    users = await sample_users(3)
+    finds = []
+
+    class CountingUsers:
+        def find(self, *args, **kwargs):
+            finds.append(args)
+            return testdb.users.find(*args, **kwargs)
+
+    loader = UserLoader(SimpleNamespace(users=CountingUsers()))
+    loaded = await loader.load_many([users[0]["_id"], users[1]["_id"], users[0]["_id"]])
+    assert [user["display_name"] for user in loaded] == ["User 0", "User 1", "User 0"]
+    assert await loader.load(users[1]["_id"]) == loaded[1]
+    assert len(finds) == 1